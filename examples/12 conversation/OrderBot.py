@@ -0,0 +1,27 @@
+from samt import Bot, Answer, Conversation
+
+bot = Bot()
+order = Conversation("order")
+
+
+@bot.answer("/order")
+def start():
+    return order.start("size", Answer("Which size?", choices=[["Small", "Large"]]))
+
+
+@order.step("size")
+def size(text, data):
+    if text not in ("Small", "Large"):
+        return "Please choose one of the sizes"
+
+    data["size"] = text
+    return order.goto("address", "Where shall it be delivered to?")
+
+
+@order.step("address")
+def address(text, data):
+    return order.end(f"Your {data['size'].lower()} pizza is on its way to {text}")
+
+
+if __name__ == "__main__":
+    bot.listen()
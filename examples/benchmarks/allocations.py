@@ -0,0 +1,93 @@
+"""
+Compares the memory allocated per update by the slotted, lazily decoded wrappers with the eager ones used before.
+Run `python examples/benchmarks/allocations.py` from the repository's root
+"""
+
+import argparse
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Tuple
+
+from samt import helper
+
+_UPDATE = {
+    "message_id": 5,
+    "date": 1700000000,
+    "text": "hi",
+    "from": {"id": 1, "is_bot": False, "first_name": "Ada", "last_name": "Lovelace", "username": "ada",
+             "language_code": "en"},
+    "chat": {"id": 1, "type": "private"},
+}
+
+
+class EagerUser(object):
+    """
+    The user wrapper as it was before, copying every field into its __dict__
+    """
+
+    def __init__(self, user: dict):
+        self.id = user.get("id")
+        self.is_bot = user.get('is_bot')
+        self.first_name = user.get('first_name')
+        self.last_name = user.get('last_name', "")
+        self.username = user.get('username', "")
+        self.language_code = user.get('language_code', "")
+
+
+class EagerMessage(object):
+    """
+    The message wrapper as it was before, decoding the date as soon as it is created
+    """
+
+    def __init__(self, msg: dict):
+        self.date = datetime.fromtimestamp(msg['date'])
+        self.text = msg.get('text', None)
+        self.id = msg['message_id']
+
+
+def _eager(update: dict) -> Tuple:
+    # The update was wrapped for `message` and `init_message` separately and once more for the history
+    return EagerUser(update["from"]), EagerMessage(update), EagerMessage(update), EagerMessage(update)
+
+
+def _lazy(update: dict) -> Tuple:
+    # The update is wrapped once and shared by `message` and `init_message`
+    message = helper.Message(update)
+    return helper.User(update["from"]), message, message, helper.Message(update)
+
+
+def measure(wrap: Callable[[dict], Tuple], updates: int) -> Tuple[float, float]:
+    """
+    Wraps the given number of updates and keeps the wrappers, like the sessions' histories do
+    :param wrap: The function wrapping a single update
+    :param updates: The number of updates to wrap
+    :return: The allocated blocks and bytes per update
+    """
+
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(updates):
+        kept.append(wrap(_UPDATE))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    statistics = after.compare_to(before, "filename")
+    blocks = sum(statistic.count_diff for statistic in statistics)
+    size = sum(statistic.size_diff for statistic in statistics)
+    return blocks / updates, size / updates
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compares the allocations per update of the message wrappers")
+    parser.add_argument("--updates", type=int, default=10000, help="The number of updates to wrap")
+    args = parser.parse_args()
+
+    print(f"{'wrappers':>8}  {'blocks':>8}  {'bytes':>8}")
+    for name, wrap in (("eager", _eager), ("lazy", _lazy)):
+        blocks, size = measure(wrap, args.updates)
+        print(f"{name:>8}  {blocks:>8.1f}  {size:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures how responsive a bot stays for the other chats while some run a slow synchronous handler, by executor.
+Run `python examples/benchmarks/executors.py` from the repository's root
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+import toml
+
+from samt.simulator import Benchmark
+
+_BOT = """
+import time
+
+from samt import Bot
+
+bot = Bot()
+
+
+@bot.answer("/slow")
+def slow():
+    # Block like a database query or rendering a document
+    time.sleep({seconds})
+    return "done"
+
+
+@bot.answer("/ping")
+async def ping():
+    return "pong"
+
+
+if __name__ == "__main__":
+    bot.listen()
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measures the latency of fast handlers next to slow synchronous ones")
+    parser.add_argument("--executors", nargs="+", default=["loop", "thread", "process"],
+                        help="The executors to run the slow handler by")
+    parser.add_argument("--chats", type=int, default=100, help="The number of users writing to the bot")
+    parser.add_argument("--slow", type=int, default=10, help="Every how many users run the slow handler")
+    parser.add_argument("--seconds", type=float, default=0.5, help="The seconds the slow handler blocks")
+    args = parser.parse_args()
+
+    print(f"{'executor':>8}  {'p50':>10}  {'p99':>10}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "Slow.py")
+        os.makedirs(os.path.join(directory, "config"))
+        with open(script, "w") as file:
+            file.write(_BOT.format(seconds=args.seconds))
+
+        for executor in args.executors:
+            with open(os.path.join(directory, "config", "config.toml"), "w") as file:
+                toml.dump({"bot": {"executor": executor}}, file)
+
+            # Most updates are answered at once, so the median shows the latency of the fast handler. Blocking the
+            # loop delays all answers until the slow handlers are done, so wait as long for the first one
+            benchmark = Benchmark(script, chats=args.chats, texts=["/slow"] + ["/ping"] * (args.slow - 1),
+                                  settle=args.seconds * args.chats / args.slow + 5)
+            results = asyncio.run(benchmark.run())
+            p50, p99 = (f"{value * 1000:>7.1f} ms" if value is not None else f"{'-':>10}"
+                        for value in (results['p50_latency'], results['p99_latency']))
+            print(f"{executor:>8}  {p50}  {p99}")
+
+
+if __name__ == "__main__":
+    main()
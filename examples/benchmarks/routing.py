@@ -0,0 +1,93 @@
+"""
+Compares the compiled route matchers with testing every route one after another, as done before.
+Run `python examples/benchmarks/routing.py` from the repository's root
+"""
+
+import argparse
+import re
+import time
+from typing import Callable, List
+
+import parse
+
+from samt.helper import RegExDict, ParsingDict
+
+
+def _measure(lookup: Callable[[str], object], messages: List[str], repeat: int) -> float:
+    """
+    :return: The microseconds per lookup
+    """
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            lookup(message)
+    return (time.perf_counter() - started) / (repeat * len(messages)) * 1e6
+
+
+def _regex_routes(count: int) -> List[str]:
+    return [rf"/command{index} (?P<value{index}>\d+)" for index in range(count)]
+
+
+def _parse_routes(count: int) -> List[str]:
+    return [f"/order{index} {{amount:d}} {{item}}" for index in range(count)]
+
+
+def benchmark(count: int, repeat: int) -> dict:
+    """
+    Looks up messages matching the first, the middle and the last route and one matching none
+    :param count: The number of routes of each kind
+    :param repeat: How often the messages are looked up
+    :return: The microseconds per lookup by matcher
+    """
+
+    regexes = _regex_routes(count)
+    patterns = _parse_routes(count)
+    regex_messages = [f"/command{index} 42" for index in (0, count // 2, count - 1)] + ["nothing"]
+    parse_messages = [f"/order{index} 3 tea" for index in (0, count // 2, count - 1)] + ["nothing"]
+
+    # The linear scan tests every route in the order of registration
+    compiled_regexes = [re.compile(regex) for regex in regexes]
+    compiled_patterns = [parse.compile(pattern) for pattern in patterns]
+
+    def scan_regexes(message):
+        return next((regex for regex in compiled_regexes if regex.match(message)), None)
+
+    def scan_patterns(message):
+        return next((pattern for pattern in compiled_patterns if pattern.parse(message)), None)
+
+    # The results are not cached, so every lookup is matched
+    regex_dict, parsing_dict = RegExDict(cache_size=0), ParsingDict(cache_size=0)
+    for index, regex in enumerate(regexes):
+        regex_dict[regex] = index
+    for index, pattern in enumerate(patterns):
+        parsing_dict[pattern] = index
+
+    # Compile before measuring, as it happens only once per bot
+    regex_dict.compile()
+    parsing_dict.compile()
+
+    return {
+        "regex scan": _measure(scan_regexes, regex_messages, repeat),
+        "regex compiled": _measure(regex_dict.lookup, regex_messages, repeat),
+        "parse scan": _measure(scan_patterns, parse_messages, repeat),
+        "parse compiled": _measure(parsing_dict.lookup, parse_messages, repeat),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compares the compiled route matchers with a linear scan")
+    parser.add_argument("--routes", type=int, nargs="+", default=[10, 100, 500],
+                        help="The numbers of routes of each kind to measure")
+    parser.add_argument("--repeat", type=int, default=200, help="How often the messages are looked up")
+    args = parser.parse_args()
+
+    print(f"{'routes':>6}  {'regex scan':>12}  {'regex compiled':>14}  {'parse scan':>12}  {'parse compiled':>14}")
+    for count in args.routes:
+        results = benchmark(count, args.repeat)
+        print(f"{count:>6}  {results['regex scan']:>9.1f} µs  {results['regex compiled']:>11.1f} µs  "
+              f"{results['parse scan']:>9.1f} µs  {results['parse compiled']:>11.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Measures how the throughput of a bot with a CPU-heavy handler scales with the number of worker processes.
+Run `python examples/benchmarks/sharding.py` from the repository's root, the results depend on the available cores
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+
+from samt.simulator import Benchmark
+
+_BOT = """
+from samt import Bot
+
+bot = Bot()
+
+
+@bot.answer("/work")
+def work():
+    # Keep the core busy like parsing a large input or rendering a report
+    total = 0
+    for value in range({iterations}):
+        total += value * value
+    return str(total)
+
+
+if __name__ == "__main__":
+    bot.listen()
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measures the throughput of a CPU-heavy bot by number of workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="The numbers of worker processes to measure")
+    parser.add_argument("--chats", type=int, default=200, help="The number of users writing to the bot")
+    parser.add_argument("--iterations", type=int, default=200000,
+                        help="The loop iterations of the handler per message")
+    args = parser.parse_args()
+
+    print(f"Cores: {os.cpu_count()}")
+    print(f"{'workers':>7}  {'updates/s':>10}  {'p50':>10}  {'p99':>10}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "Work.py")
+        os.makedirs(os.path.join(directory, "config"))
+        with open(script, "w") as file:
+            file.write(_BOT.format(iterations=args.iterations))
+
+        for workers in args.workers:
+            benchmark = Benchmark(script, chats=args.chats, texts=["/work"], workers=workers)
+            results = asyncio.run(benchmark.run())
+            p50, p99 = (f"{value * 1000:>7.1f} ms" if value is not None else f"{'-':>10}"
+                        for value in (results['p50_latency'], results['p99_latency']))
+            print(f"{workers:>7}  {results['updates_per_second']:>10.1f}  {p50}  {p99}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,3 @@
-from .samt import Bot, Answer, logger
+from .samt import Bot, Answer, Keyboard, logger
+from .conversation import Conversation
 from .helper import *
@@ -1,39 +1,319 @@
-from typing import Union
+import asyncio
+import json
+import logging
+import os
+from typing import Union, Optional, Dict, Any, AsyncIterator, Iterable, List, Callable
 
-from requests import Session, Response
+import aiohttp
+
+from samt.helper import User
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramError(Exception):
+    """
+    An error reported by the Bot API. The subclasses distinguish the error codes
+    """
+
+    def __init__(self, description: str, error_code: int, json: dict = None):
+        """
+        :param description: The human readable description telegram sent
+        :param error_code: The error code, which equals the HTTP status
+        :param json: The whole response, if it could be decoded
+        """
+
+        super().__init__(description, error_code, json)
+        self.description = description
+        self.error_code = error_code
+        self.json = json if json is not None else dict()
+        self.parameters = self.json.get('parameters') or dict()
+
+
+class BadRequest(TelegramError):
+    """
+    The request was malformed, e.g. a message was empty or a chat was not found
+    """
+
+
+class Unauthorized(TelegramError):
+    """
+    The token is not valid
+    """
+
+
+class Forbidden(TelegramError):
+    """
+    The bot may not send to the chat, e.g. as the user blocked it
+    """
+
+
+class NotFound(TelegramError):
+    """
+    The method does not exist, which usually means the token is malformed
+    """
+
+
+class Conflict(TelegramError):
+    """
+    Another process is receiving the updates or a webhook is set while polling
+    """
+
+
+class RetryAfter(TelegramError):
+    """
+    The flood control was triggered, the request may be repeated after the given time
+    """
+
+    @property
+    def retry_after(self) -> float:
+        """
+        :return: The seconds to wait before the next request
+        """
+
+        return self.parameters.get('retry_after', 1)
+
+
+class ServerError(TelegramError):
+    """
+    Telegram failed to handle the request, it may be repeated
+    """
+
+
+class NetworkError(Exception):
+    """
+    Telegram could not be reached or did not answer in time
+    """
+
+
+# The error types by their codes
+_ERRORS = {
+    400: BadRequest,
+    401: Unauthorized,
+    403: Forbidden,
+    404: NotFound,
+    409: Conflict,
+    429: RetryAfter,
+}
+
+
+def _error(error_code: int, description: str, response: dict = None) -> TelegramError:
+    """
+    Creates the error of the matching type
+    :param error_code: The error code or HTTP status
+    :param description: The error's description
+    :param response: The whole response
+    :return: The error to raise
+    """
+
+    if error_code >= 500:
+        return ServerError(description, error_code, response)
+    return _ERRORS.get(error_code, TelegramError)(description, error_code, response)
+
+
+def _encode(value: Any) -> str:
+    """
+    Encodes a parameter as form value, nested objects are serialized as JSON
+    """
+
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, separators=(',', ':'))
+    return str(value)
 
 
 class LowerBot:
-    BASE_URL = "https://api.telegram.org/bot{}/"
+    """
+    An asynchronous client of the Bot API. All requests share a pool of keep-alive connections, files are streamed in
+    chunks and errors are raised as subclasses of TelegramError
+    """
+
+    BASE_URL = "https://api.telegram.org"
+
+    def __init__(self, token: str, base_url: str = None, connections: int = 100, timeout: float = 60):
+        """
+        :param token: The bot token
+        :param base_url: The server to send the requests to, e.g. a local Bot API server. Defaults to telegram
+        :param connections: The maximal number of connections open at once
+        :param timeout: The seconds a request may take, long polls are granted their polling time in addition
+        """
 
-    def __init__(self, token: str):
         self.token = token
-        self.url = self.BASE_URL.format(token)
-        self.session = Session()
-
-    def _make_request(self, method: str, data=None) -> dict:
-        req: Response = self.session.post(self.url + method, data=data)
-        if req.ok:
-            try:
-                json = req.json()
-                if json['ok']:
-                    return json['result']
-                else:
-                    pass
-            except:
-                pass
-        else:
-            pass
-
-    def get_me(self):
-        return User(self._make_request("getMe"))
-
-    def send_message(self, chat_id: Union[int, str],
-                     text: str, parse_mode: str = None,
-                     disable_web_page_preview: bool = None,
-                     disable_notification: bool = None,
-                     reply_to_message_id: int = None,
-                     reply_markup=None):
+        self.url = f"{(base_url or self.BASE_URL).rstrip('/')}/bot{token}/"
+        self.connections = connections
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+
+        # The session is bound to the running loop, so it is created by the first request
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        return self.session
+
+    async def close(self) -> None:
+        """
+        Closes the pooled connections
+        """
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _make_request(self, method: str, data: Dict[str, Any] = None, files: Dict[str, Any] = None,
+                            timeout: float = None) -> Any:
+        """
+        Calls a method of the Bot API
+        :param method: The method's name
+        :param data: The parameters, None values are left out
+        :param files: The files to upload by their parameter names, either as file-like object, as bytes, as async
+            iterator of bytes or as tuple of a file name and one of these
+        :param timeout: The seconds the request may take, by default the client's timeout
+        :return: The result of the call
+        :raises TelegramError: If telegram reports an error
+        :raises NetworkError: If telegram could not be reached
+        """
+
+        data = {key: _encode(value) for key, value in (data or dict()).items() if value is not None}
+
+        # Files are sent as multipart form, which streams them, everything else as plain form
+        if files:
+            form = aiohttp.FormData()
+            for key, value in data.items():
+                form.add_field(key, value)
+            for key, file in files.items():
+                filename, content = file if isinstance(file, tuple) else \
+                    (os.path.basename(getattr(file, 'name', None) or key), file)
+                form.add_field(key, content, filename=filename)
+            data = form
+
+        try:
+            async with self._get_session().post(self.url + method, data=data,
+                                                timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as req:
+                try:
+                    response = await req.json(content_type=None)
+                except ValueError:
+                    raise _error(req.status, f"{req.status} {req.reason}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise NetworkError(f"The request {method} failed: {e!r}") from e
+
+        if response.get('ok'):
+            return response['result']
+        raise _error(response.get('error_code', req.status), response.get('description', ""), response)
+
+    async def get_me(self) -> User:
+        return User(await self._make_request("getMe"))
+
+    async def get_updates(self, offset: int = None, limit: int = None, timeout: int = None,
+                          allowed_updates: Iterable[str] = None) -> List[dict]:
+        """
+        Fetches the next updates
+        :param offset: The ID of the first update to return, all previous ones are confirmed
+        :param limit: The maximal number of updates to return
+        :param timeout: The seconds to wait for an update, if there are none
+        :param allowed_updates: The types of updates to receive
+        :return: The updates
+        """
+
+        return await self._make_request("getUpdates", dict(
+            offset=offset,
+            limit=limit,
+            timeout=timeout,
+            allowed_updates=list(allowed_updates) if allowed_updates is not None else None
+        ), timeout=self.timeout + (timeout or 0))
+
+    async def updates(self, offset: int = None, timeout: int = 20, limit: int = None,
+                      allowed_updates: Iterable[str] = None, prefetch: bool = True,
+                      confirmed: Callable[[], Optional[int]] = None) -> AsyncIterator[dict]:
+        """
+        Receives the updates by long polling, forever. Failed polls are repeated, after the time demanded by the flood
+        control or with a growing delay of up to a minute
+        :param offset: The ID of the first update to receive
+        :param timeout: The seconds a single poll waits for updates
+        :param limit: The maximal number of updates per poll
+        :param allowed_updates: The types of updates to receive
+        :param prefetch: If the next poll is sent while the updates of the previous one are being consumed. This
+            confirms the updates to telegram before they are consumed, unless only the processed ones are confirmed
+        :param confirmed: Returns the ID of the last update, up to which all are processed. If given, only these are
+            confirmed to telegram, so the others are delivered again after a crash. Updates delivered again while
+            running are skipped, so at most one poll's limit of updates is received ahead of the processed ones
+        :return: The updates in their order
+        :raises Unauthorized: If the token is not valid, as retrying is of no use
+        """
+
+        delay = 0
+        idle = 0
+        pending: Optional[asyncio.Future] = None
+        requested = start = offset
+
+        def confirm() -> Optional[int]:
+            if confirmed is None:
+                return offset
+
+            # Until an update is processed, only the ones confirmed before are, e.g. up to the checkpoint
+            processed = confirmed()
+            if processed is None:
+                return start
+            return processed + 1 if offset is None else min(offset, processed + 1)
+
+        try:
+            while True:
+                try:
+                    if pending is None:
+                        requested = confirm()
+                    batch = await (pending or self.get_updates(requested, limit, timeout, allowed_updates))
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except (Unauthorized, NotFound):
+                    raise
+                except (TelegramError, NetworkError) as e:
+                    delay = min(60, delay * 2 or 0.5)
+                    logger.warning(f"Polling the updates failed, retrying in {delay} s:\n\t{e!r}")
+                    await asyncio.sleep(delay)
+                    continue
+                finally:
+                    pending = None
+
+                # Only the updates received already, but not confirmed, are delivered again. Others with lower IDs
+                # are new, as telegram starts over with a random ID after a week without updates
+                delay = 0
+                if offset is not None and requested != offset:
+                    first = requested if requested is not None else 0
+                    batch = [update for update in batch if not first <= update['update_id'] < offset]
+
+                # Polls returning only updates, which were received already but are not processed yet, are repeated
+                # once more of them are processed, but at least after a growing delay to receive new ones
+                if not batch and offset is not None and confirm() != offset:
+                    idle = min(1.0, idle * 2 or 0.05)
+                    last, waited = confirm(), 0.0
+                    while confirm() == last and waited < idle:
+                        await asyncio.sleep(0.01)
+                        waited += 0.01
+                    continue
+
+                idle = 0
+                if batch:
+                    offset = batch[-1]['update_id'] + 1
+
+                    # The next poll travels while this batch is consumed
+                    if prefetch:
+                        requested = confirm()
+                        pending = asyncio.ensure_future(self.get_updates(requested, limit, timeout, allowed_updates))
+
+                for update in batch:
+                    yield update
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def send_message(self, chat_id: Union[int, str],
+                           text: str, parse_mode: str = None,
+                           disable_web_page_preview: bool = None,
+                           disable_notification: bool = None,
+                           reply_to_message_id: int = None,
+                           reply_markup=None) -> dict:
 
         data = dict(
             chat_id=chat_id,
@@ -45,18 +325,70 @@ class LowerBot:
             reply_markup=reply_markup
         )
 
-        return self._make_request("sendMessage", data)
+        return await self._make_request("sendMessage", data)
+
+    async def edit_message_text(self, chat_id: Union[int, str], message_id: int,
+                                text: str, parse_mode: str = None,
+                                disable_web_page_preview: bool = None,
+                                reply_markup=None) -> dict:
+
+        data = dict(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+            reply_markup=reply_markup
+        )
+
+        return await self._make_request("editMessageText", data)
+
+    async def answer_callback_query(self, callback_query_id: str, text: str = None, show_alert: bool = None) -> bool:
+        return await self._make_request("answerCallbackQuery", dict(
+            callback_query_id=callback_query_id,
+            text=text,
+            show_alert=show_alert
+        ))
+
+    async def send_media(self, media_type: str, chat_id: Union[int, str], media: Any, **kwargs) -> dict:
+        """
+        Sends a media file
+        :param media_type: The name of the type as used by the API, e.g. "photo"
+        :param chat_id: The recipient
+        :param media: Either a file ID or URL or the file to upload as accepted by `_make_request`
+        :param kwargs: The further parameters of the method
+        :return: The sent message
+        """
+
+        method = "send" + media_type.capitalize()
+        if isinstance(media, str):
+            return await self._make_request(method, dict(chat_id=chat_id, **{media_type: media}, **kwargs))
+        return await self._make_request(method, dict(chat_id=chat_id, **kwargs), files={media_type: media})
+
+    async def send_photo(self, chat_id: Union[int, str], photo: Any, **kwargs) -> dict:
+        return await self.send_media("photo", chat_id, photo, **kwargs)
+
+    async def send_audio(self, chat_id: Union[int, str], audio: Any, **kwargs) -> dict:
+        return await self.send_media("audio", chat_id, audio, **kwargs)
+
+    async def send_document(self, chat_id: Union[int, str], document: Any, **kwargs) -> dict:
+        return await self.send_media("document", chat_id, document, **kwargs)
+
+    async def send_video(self, chat_id: Union[int, str], video: Any, **kwargs) -> dict:
+        return await self.send_media("video", chat_id, video, **kwargs)
 
+    async def send_voice(self, chat_id: Union[int, str], voice: Any, **kwargs) -> dict:
+        return await self.send_media("voice", chat_id, voice, **kwargs)
 
-class User:
+    async def send_sticker(self, chat_id: Union[int, str], sticker: Any, **kwargs) -> dict:
+        return await self.send_media("sticker", chat_id, sticker, **kwargs)
 
-    def __init__(self, json: dict):
-        self.id = json['id']
-        self.is_bot = json['is_bot']
-        self.first_name = json['first_name']
-        self.last_name = json.get('last_name', "")
-        self.username = json.get('username', "")
-        self.language_code = json.get('language_code', "")
+    async def set_webhook(self, url: str, secret_token: str = None, allowed_updates: Iterable[str] = None) -> bool:
+        return await self._make_request("setWebhook", dict(
+            url=url,
+            secret_token=secret_token,
+            allowed_updates=list(allowed_updates) if allowed_updates is not None else None
+        ))
 
-    def __str__(self):
-        return "User[{}:{}]".format(self.first_name, self.id)
+    async def delete_webhook(self, drop_pending_updates: bool = None) -> bool:
+        return await self._make_request("deleteWebhook", dict(drop_pending_updates=drop_pending_updates))
@@ -0,0 +1,114 @@
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+# The key of the conversation state in a user's storage
+STATE_KEY = "_<[conversation]>_"
+
+
+class Transition(NamedTuple):
+    """
+    The result of a handler or a step, which starts, continues or ends a conversation. The answer is sent as if it was
+    returned by itself
+    """
+
+    # The name of the conversation and of its next step, both are None if it ends
+    conversation: Optional[str]
+    step: Optional[str]
+
+    # The answer to send
+    answer: Any = None
+
+    # The data replacing the conversation's data or None to keep it
+    data: Optional[Dict[str, Any]] = None
+
+
+class Conversation(object):
+    """
+    A dialog of several messages declared as named steps. Instead of a suspended generator, only a small record of the
+    conversation's name, its current step and its data is kept. It is stored in the user's storage, so with a
+    persistent storage, conversations survive the eviction of the session, restarts and moving between workers.
+    The data has to be serializable as JSON.
+
+    A step is called with the text of the next message, or the data of a pressed inline button, and the
+    conversation's data, which it may change. It returns a transition by `goto` or `end` or any other answer to stay
+    at the step, e.g. to ask again. A conversation is entered by returning `start` from a handler
+    """
+
+    # The conversations by their names
+    registry: Dict[str, "Conversation"] = dict()
+
+    def __init__(self, name: str):
+        """
+        :param name: The unique name of the conversation, by which it is stored
+        """
+
+        if name in Conversation.registry:
+            raise ValueError(f"A conversation named {name!r} exists already")
+
+        self.name = name
+        self.steps: Dict[str, Callable] = dict()
+        Conversation.registry[name] = self
+
+    def step(self, name: str) -> Callable:
+        """
+        The wrapper for the inner decorator
+        :param name: The name of the step, unique within the conversation
+        :return: The decorator
+        """
+
+        def decorator(func: Callable) -> Callable:
+            """
+            Adds the function as step
+            :param func: A function receiving the message's text and the conversation's data
+            :return: The function unchanged
+            """
+
+            self.steps[name] = func
+            return func
+
+        return decorator
+
+    def start(self, step: str, answer: Any = None, **data) -> Transition:
+        """
+        Enters the conversation, a running conversation or generator is left
+        :param step: The step to process the next message
+        :param answer: The answer to send
+        :param data: The initial data of the conversation
+        :return: The transition to return
+        """
+
+        if step not in self.steps:
+            raise KeyError(f"The conversation {self.name!r} has no step {step!r}")
+        return Transition(self.name, step, answer, dict(data))
+
+    def goto(self, step: str, answer: Any = None) -> Transition:
+        """
+        Continues the conversation with another step, keeping its data
+        :param step: The step to process the next message
+        :param answer: The answer to send
+        :return: The transition to return
+        """
+
+        if step not in self.steps:
+            raise KeyError(f"The conversation {self.name!r} has no step {step!r}")
+        return Transition(self.name, step, answer)
+
+    @staticmethod
+    def end(answer: Any = None) -> Transition:
+        """
+        Ends the conversation, the following messages are routed as usual again
+        :param answer: The answer to send
+        :return: The transition to return
+        """
+
+        return Transition(None, None, answer)
+
+    @staticmethod
+    def lookup(state: Dict[str, Any]) -> Optional[Callable]:
+        """
+        Finds the step a stored conversation is at
+        :param state: The stored record of the conversation
+        :return: The step or None, if the conversation or the step does not exist anymore
+        """
+
+        conversation = Conversation.registry.get(state.get('conversation'))
+        return conversation.steps.get(state.get('step')) if conversation is not None else None
@@ -0,0 +1,187 @@
+import asyncio
+import multiprocessing
+import sys
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.context import SpawnContext, SpawnProcess
+from typing import Callable, Any, Optional, Generator, Tuple
+
+from samt.helper import call_with_context, current_context
+
+# The ways a synchronous handler can be run
+LOOP = "loop"
+THREAD = "thread"
+PROCESS = "process"
+
+# The context keys handed to a handler run by another process
+_PROCESS_KEYS = ("user", "message", "init_message")
+_STORAGE_KEY = '_<[storage]>_'
+
+# The prefix of the pool processes' names, by which a process recognizes running handlers for another one
+PROCESS_PREFIX = "samt-handler-"
+
+
+class _HandlerProcess(SpawnProcess):
+    """
+    A freshly started pool process, which is named to be recognized when the main module is imported again
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = f"{PROCESS_PREFIX}{self.name}"
+
+
+class _HandlerContext(SpawnContext):
+    Process = _HandlerProcess
+
+
+def is_handler_process() -> bool:
+    """
+    Tests, if the current process runs handlers for a HandlerPool
+    :return: If the process is a pool process
+    """
+
+    return multiprocessing.current_process().name.startswith(PROCESS_PREFIX)
+
+
+def _call_in_process(context: dict, func: Callable, args: tuple, kwargs: dict) -> Tuple[Any, dict, tuple, dict]:
+    """
+    Calls a handler in a pool process
+    :return: The handler's result, the storage and the arguments as changed by the handler
+    """
+
+    result = call_with_context(context, func, *args, **kwargs)
+    return result, context[_STORAGE_KEY], args, kwargs
+
+
+def _importable(func: Callable) -> bool:
+    """
+    Tests, if a function can be found by its name, which is how it is sent to another process
+    """
+
+    module = sys.modules.get(getattr(func, '__module__', None))
+    target = module
+    for name in getattr(func, '__qualname__', "<locals>").split("."):
+        target = getattr(target, name, None)
+    return module is not None and target is func
+
+
+def _send(gen: Generator, value: Any) -> Tuple[bool, Any]:
+    """
+    Resumes a generator in a pool thread
+    :return: If the generator is exhausted and its next answer
+    """
+
+    try:
+        return False, gen.send(value)
+    except StopIteration:
+        return True, None
+
+
+def _apply_changes(storage: dict, changed: dict) -> None:
+    """
+    Applies the changes a handler made to a copy of a storage to the storage itself, so only changed keys are marked
+    """
+
+    for key in [key for key in storage if key not in changed]:
+        del storage[key]
+
+    for key, value in changed.items():
+        if key not in storage or dict.__getitem__(storage, key) != value:
+            storage[key] = value
+
+
+class HandlerPool(object):
+    """
+    Runs synchronous handlers outside of the event loop, so blocking handlers do not delay the other chats.
+    The handlers see the context of their message. Threads share it, while processes receive a copy of the user,
+    the message and the storage and send the changed storage and dictionary arguments back. The processes import the
+    main module again, where the bot recognizes them by `is_handler_process` and only registers the routes
+    """
+
+    def __init__(self, threads: Optional[int] = None, processes: Optional[int] = None):
+        """
+        The pools are created when they are first used
+        :param threads: The maximal number of threads or None for python's default
+        :param processes: The maximal number of processes or None for the number of processors
+        """
+
+        self.threads = threads
+        self.processes = processes
+
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="samt-handler")
+        return self._thread_pool
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+
+        # The processes are started freshly, as forking a running event loop is not safe
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=_HandlerContext())
+        return self._process_pool
+
+    async def call(self, executor: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Calls a synchronous handler
+        :param executor: Either "thread" or "process"
+        :param func: The handler, which has to be importable by its name to be run by a process, otherwise it is run by
+            a thread
+        :param args: The positional arguments to pass
+        :param kwargs: The keyword arguments to pass
+        :return: The handler's result
+        """
+
+        loop = asyncio.get_event_loop()
+        context = current_context()
+
+        # Functions which cannot be found by their names, e.g. the ones wrapped by a decorator, are run by a thread
+        if executor == PROCESS and not _importable(func):
+            executor = THREAD
+
+        if executor == PROCESS:
+            storage = context.get(_STORAGE_KEY)
+            copy = {key: context.get(key) for key in _PROCESS_KEYS}
+            copy[_STORAGE_KEY] = dict(storage) if storage is not None else dict()
+
+            result, changed, changed_args, changed_kwargs = await loop.run_in_executor(
+                self._get_process_pool(), _call_in_process, copy, func, args, kwargs)
+
+            # Dictionaries passed in, like the data of a conversation, may be changed by the handler as well
+            for original, value in zip((*args, *kwargs.values()), (*changed_args, *changed_kwargs.values())):
+                if isinstance(original, dict) and isinstance(value, dict):
+                    _apply_changes(original, value)
+            if storage is not None:
+                _apply_changes(storage, changed)
+            return result
+
+        return await loop.run_in_executor(self._get_thread_pool(),
+                                          partial(call_with_context, context, func, *args, **kwargs))
+
+    async def send(self, gen: Generator, value: Any) -> Any:
+        """
+        Resumes a synchronous generator in a thread, as generators cannot be moved to other processes
+        :param gen: The generator
+        :param value: The value to send into it
+        :return: The generator's next answer
+        :raises StopAsyncIteration: If the generator is exhausted, as a StopIteration cannot leave a coroutine
+        """
+
+        done, answer = await asyncio.get_event_loop().run_in_executor(self._get_thread_pool(), call_with_context,
+                                                                      current_context(), _send, gen, value)
+        if done:
+            raise StopAsyncIteration
+        return answer
+
+    def shutdown(self) -> None:
+        """
+        Waits for the running handlers and stops the pools
+        """
+
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
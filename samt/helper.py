@@ -1,7 +1,11 @@
 import re
+import sys
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
 from enum import Enum
-from typing import Hashable, Any
+from string import Formatter
+from typing import Hashable, Any, Optional, Tuple, Match, Pattern, Dict, List, Set, Sequence, Callable, Iterator
 
 from tinydb import TinyDB, Query
 import aiotask_context
@@ -10,17 +14,38 @@ import parse
 
 class User:
     """
-    A wrapper around the user information which are by default contained in a dictionary
+    A wrapper around the user information which are by default contained in a dictionary.
+    The fields are read from the dictionary on access
     """
 
+    __slots__ = ('_data',)
+
     def __init__(self, user: dict):
-        # Safe all useful information as attributes
-        self.id = user.get("id")
-        self.is_bot = user.get('is_bot')
-        self.first_name = user.get('first_name')
-        self.last_name = user.get('last_name', "")
-        self.username = user.get('username', "")
-        self.language_code = user.get('language_code', "")
+        self._data = user
+
+    @property
+    def id(self) -> int:
+        return self._data.get('id')
+
+    @property
+    def is_bot(self) -> bool:
+        return self._data.get('is_bot')
+
+    @property
+    def first_name(self) -> str:
+        return self._data.get('first_name')
+
+    @property
+    def last_name(self) -> str:
+        return self._data.get('last_name', "")
+
+    @property
+    def username(self) -> str:
+        return self._data.get('username', "")
+
+    @property
+    def language_code(self) -> str:
+        return self._data.get('language_code', "")
 
     def __str__(self):
         return "{} {}".format(self.first_name, self.last_name)
@@ -31,14 +56,29 @@ class User:
 
 class Message:
     """
-    A wrapper around the message information which are by default contained in a dictionary
+    A wrapper around the message information which are by default contained in a dictionary.
+    The fields are read from the dictionary on access, the date is converted once when it is first used
     """
 
+    __slots__ = ('_data', '_date')
+
     def __init__(self, msg: dict):
-        # Safe all useful information as attributes
-        self.date = datetime.fromtimestamp(msg['date'])
-        self.text = msg.get('text', None)
-        self.id = msg['message_id']
+        self._data = msg
+        self._date = None
+
+    @property
+    def date(self) -> datetime:
+        if self._date is None:
+            self._date = datetime.fromtimestamp(self._data['date'])
+        return self._date
+
+    @property
+    def text(self) -> Optional[str]:
+        return self._data.get('text', None)
+
+    @property
+    def id(self) -> int:
+        return self._data['message_id']
 
     def __str__(self):
         return self.text
@@ -49,16 +89,181 @@ class Message:
 
 class Sticker:
     """
-    A wrapper around the sticker information which are by default contained in a dictionary
+    A wrapper around the sticker information which are by default contained in a dictionary.
+    The fields are read from the dictionary on access
     """
 
+    __slots__ = ('_data',)
+
     def __init__(self, sticker: dict):
-        # Safe all useful information as attributes
-        self.emoji = sticker['emoji']
-        self.file_id = sticker['file_id']
-        self.file_size = sticker['file_size']
-        self.height = sticker['height']
-        self.set_name = sticker['set_name']
+        self._data = sticker
+
+    @property
+    def emoji(self) -> str:
+        return self._data['emoji']
+
+    @property
+    def file_id(self) -> str:
+        return self._data['file_id']
+
+    @property
+    def file_size(self) -> int:
+        return self._data['file_size']
+
+    @property
+    def height(self) -> int:
+        return self._data['height']
+
+    @property
+    def set_name(self) -> str:
+        return self._data['set_name']
+
+
+def split_message(text: str, limit: int = 4096) -> Iterator[str]:
+    """
+    Splits a text into parts of at most the given length. The parts end at paragraphs, lines or words, if one of them
+    ends in the second half of the part, otherwise the text is cut. Formatting tags spanning a cut are not repaired
+    :param text: The text to split
+    :param limit: The maximal length of a part
+    :return: The parts in their order, without the separators they were split at
+    """
+
+    while len(text) > limit:
+
+        # Prefer the largest unit, as long as the part does not become too short
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, limit // 2, limit + len(separator))
+            if cut != -1:
+                break
+        else:
+            cut, separator = limit, ""
+
+        part, text = text[:cut], text[cut + len(separator):]
+        if part.strip():
+            yield part
+
+    if text.strip():
+        yield text
+
+
+def deep_sizeof(obj: Any) -> int:
+    """
+    Estimates the memory used by an object and everything it contains, counting shared objects only once
+    :param obj: The object to measure
+    :return: The size in bytes
+    """
+
+    seen = set()
+    size = 0
+    stack = [obj]
+
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+        elif hasattr(current, '__dict__') and not isinstance(current, type):
+            stack.append(current.__dict__)
+        elif hasattr(type(current), '__slots__'):
+            stack.extend(getattr(current, name) for name in type(current).__slots__ if hasattr(current, name))
+
+    return size
+
+
+class BroadcastReport:
+    """
+    The progress of a broadcast, counting the sent messages and the failures by their reason
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.failures: Dict[str, int] = dict()
+
+    @staticmethod
+    def reason(error: Exception) -> str:
+        """
+        Summarizes why a message could not be delivered
+        :param error: The raised error
+        :return: A short description, the same for all users failing for the same reason
+        """
+
+        description = str(getattr(error, 'description', '')).lower()
+
+        if "blocked" in description:
+            return "blocked"
+        if "chat not found" in description:
+            return "chat not found"
+        if "deactivated" in description:
+            return "deactivated"
+        return description or type(error).__name__
+
+    def add_failure(self, error: Exception) -> None:
+        """
+        Counts a failed message
+        :param error: The raised error
+        """
+
+        reason = self.reason(error)
+        self.failed += 1
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    @property
+    def total(self) -> int:
+        """
+        :return: The number of processed receivers
+        """
+
+        return self.sent + self.failed
+
+    def __str__(self):
+        failures = ", ".join(f"{count} {reason}" for reason, count in self.failures.items())
+        return f"{self.sent} sent, {self.failed} failed" + (f" ({failures})" if failures else "")
+
+
+# The context of a handler running outside of the event loop, set per thread
+_local = threading.local()
+
+
+def current_context() -> dict:
+    """
+    Finds the context of the message being processed, either the one of the current task or the one handed to the
+    current thread or process
+    :return: The context's dictionary
+    """
+
+    task = aiotask_context.asyncio_current_task()
+    if task is not None:
+        return task.context
+
+    context = getattr(_local, 'context', None)
+    if context is None:
+        raise ValueError("No context found, the code is not run while processing a message")
+    return context
+
+
+def call_with_context(context: dict, func: Callable, *args, **kwargs) -> Any:
+    """
+    Calls a function outside of the event loop with the context of the message being processed
+    :param context: The context's dictionary
+    :param func: The function to call
+    :param args: The positional arguments to pass
+    :param kwargs: The keyword arguments to pass
+    :return: The function's result
+    """
+
+    _local.context = context
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.context = None
 
 
 class Context:
@@ -86,11 +291,12 @@ class Context:
         """
 
         # First try to find the value in the context
-        value = aiotask_context.get(key)
+        context = current_context()
+        value = context.get(key)
 
         # If not found, try to find it in the session storage
         if value is None:
-            value = aiotask_context.get('_<[storage]>_').get(key, default)
+            value = context.get('_<[storage]>_').get(key, default)
 
         return value
 
@@ -103,10 +309,64 @@ class Context:
         """
 
         # Check for a conflict
-        if aiotask_context.get(key) is not None:
+        context = current_context()
+        if context.get(key) is not None:
             raise KeyError("This key is occupied by the framework")
         else:
-            aiotask_context.get('_<[storage]>_')[key] = value
+            context.get('_<[storage]>_')[key] = value
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which discards the least recently used entries first and counts its hits and misses
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+        # Counters to judge the cache's efficiency
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieves a cached value and marks it as recently used
+        :param key: The key to look up
+        :param default: The value to return, if the key is not cached
+        :return: The cached or the default value
+        """
+
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        # Drop the oldest entries if the cache grew too large
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self) -> None:
+        """
+        Removes all entries, but keeps the counters
+        """
+
+        self._entries.clear()
+
+
+_MISSING = object()
 
 
 # Source: https://djangosnippets.org/snippets/309/
@@ -116,89 +376,435 @@ class RegExDict(object):
     Setting a key will map all strings matching a certain regex to the
     set value.
 
-    One caveat: the order of the iteration over items is unspecified,
-    thus if a lookup matches multiple keys, it is unspecified which
-    value will be returned - still, one such value will be returned.
+    The regexes are sorted into a trie by the literal text every match starts with, so a message is only matched
+    against the regexes which could match it at all. Those are merged into as few alternations as possible, which are
+    compiled once per set of candidates. If a lookup matches multiple keys, the one registered first is returned.
+    The results of the recent lookups are cached by the looked up string.
     """
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024):
         self._regexes = {}
 
-        # The last tested item and result
-        self.last_request = None
-        self.last_result = None
+        # The prefix trie and the branches of the mergeable regexes, built lazily by compile
+        self._trie = None
+        self._routes: List[Tuple[Pattern, Any]] = []
+        self._branches: List[Optional[str]] = []
 
-    def __getitem__(self, name):
+        # The combined matchers by the candidates they test
+        self._merged: Dict[Tuple[int, ...], List[Pattern]] = dict()
 
-        # Check for a possible speedup
-        if self.last_request == name:
-            return self.last_result
+        # The results of the recent lookups, including failed ones
+        self.cache = LRUCache(cache_size)
+
+    @staticmethod
+    def _literal_prefix(regex: Pattern) -> str:
+        """
+        Extracts the text every match of a regex starts with
+        :param regex: The compiled regex
+        :return: The literal prefix, which is empty if it cannot be told safely, e.g. for case insensitive regexes
+        """
+
+        pattern = regex.pattern
+        if not isinstance(pattern, str) or regex.flags & (re.IGNORECASE | re.VERBOSE):
+            return ""
+
+        # An alternation on the top level may start with any of its branches
+        depth, escaped, in_class = 0, False, False
+        for char in pattern:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif in_class:
+                in_class = char != "]"
+            elif char == "[":
+                in_class = True
+            elif char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and depth == 0:
+                return ""
+
+        # The regexes are matched at the start anyway
+        prefix = []
+        i = 1 if pattern.startswith("^") else 0
+        while i < len(pattern):
+            char = pattern[i]
+            if char == "\\":
+
+                # Escaped punctuation is literal, while escapes like \d are classes
+                following = pattern[i + 1:i + 2]
+                if not following or following.isalnum() or not following.isascii():
+                    break
+                literal, i = following, i + 2
+            elif char in ".^$*+?{}[]|()":
+                break
+            else:
+                literal, i = char, i + 1
+
+            # A character which may be left out or repeated ends the prefix
+            quantifier = pattern[i:i + 1]
+            if quantifier and quantifier in "*?{+":
+                if quantifier == "+":
+                    prefix.append(literal)
+                break
+            prefix.append(literal)
+
+        return "".join(prefix)
+
+    def compile(self) -> None:
+        """
+        Builds the prefix trie of the registered regexes and prepares their branches to be merged. Each branch is
+        followed by an empty named dispatch group. As the dispatch group is only reached by a matching branch, failing
+        branches set no groups, which the regex engine would save and restore for every branch
+        """
 
-        # Search through all inputs for a matching regex
-        for regex, value in self._regexes.items():
-            m = regex.match(name)
+        self._trie = ({}, [])
+        self._routes = list(self._regexes.items())
+        self._branches = []
+        self._merged = dict()
+
+        for index, (regex, value) in enumerate(self._routes):
+            node = self._trie
+            for char in self._literal_prefix(regex):
+                node = node[0].setdefault(char, ({}, []))
+            node[1].append(index)
+
+            # Numbered back references would point to the wrong group after merging and flags would be lost, so
+            # those regexes are matched on their own
+            branch = f"(?:{regex.pattern})(?P<_r{index}>)"
+            backref = re.search(r"\\[1-9]|\(\?\([1-9]", regex.pattern) is not None
+            try:
+                mergeable = not backref and (regex.flags & ~re.UNICODE) == 0 and re.compile(branch) is not None
+            except re.error:
+                mergeable = False
+            self._branches.append(branch if mergeable else None)
+
+    def _merge(self, candidates: Tuple[int, ...]) -> List[Pattern]:
+        """
+        Merges the given regexes into alternations. A regex which cannot be merged (e.g. because of clashing group
+        names or back references) opens a new alternation, so the priority by registration order is kept
+        :param candidates: The indexes of the regexes in registration order
+        :return: The alternations and the regexes matched on their own
+        """
+
+        compiled = []
+        branches, names = [], set()
+
+        def close():
+            if len(branches) == 0:
+                return
+
+            # The branches compile on their own, so their alternation does as well, but never lose a route
+            try:
+                compiled.append(re.compile("|".join(branches)))
+            except re.error:
+                compiled.extend(re.compile(branch) for branch in branches)
+
+        for index in candidates:
+            regex, branch = self._routes[index][0], self._branches[index]
+            groups = set(regex.groupindex)
+
+            # Clashing group names start a new alternation, a regex which cannot be merged at all is matched as it is
+            if branch is None or groups & names:
+                close()
+                branches, names = [], set()
+            if branch is not None:
+                branches.append(branch)
+                names |= groups
+            else:
+                compiled.append(regex)
+
+        close()
+        return compiled
+
+    def lookup(self, name: str) -> Optional[Tuple[Any, Match]]:
+        """
+        Finds the value of the first regex matching the given string
+        :param name: The string to match
+        :return: A tuple of the value and the match object or None, if no regex matches
+        """
+
+        # Check for a possible speedup
+        result = self.cache.get(name, _MISSING)
+        if result is not _MISSING:
+            return result
+
+        if self._trie is None:
+            self.compile()
+
+        # Collect all regexes whose prefix matches the start of the name
+        node = self._trie
+        candidates = list(node[1])
+        for char in name:
+            node = node[0].get(char)
+            if node is None:
+                break
+            candidates.extend(node[1])
+        candidates = tuple(sorted(candidates))
+
+        matchers = self._merged.get(candidates)
+        if matchers is None:
+            matchers = self._merged[candidates] = self._merge(candidates)
+
+        result = None
+
+        # Search through the alternations for a matching regex
+        for combined in matchers:
+            m = combined.match(name)
             if m is not None:
-                return value, m
 
-        raise KeyError('Key does not match any regex')
+                # Regexes which could not be merged are their own route
+                if combined in self._regexes:
+                    result = self._regexes[combined], m
 
-    def __contains__(self, item):
+                # The dispatch group ends the matching branch and is thus closed last
+                else:
+                    regex, value = self._routes[int(m.lastgroup[2:])]
+                    result = value, regex.match(name)
+                break
 
-        # Check existence by accessing the item in question
-        try:
+        self.cache[name] = result
+        return result
 
-            # Remember the last questioned item to speed up access
-            self.last_result = self[item]
-            self.last_request = item
-        except KeyError:
-            return False
-        else:
-            return True
+    def __getitem__(self, name):
+        result = self.lookup(name)
+        if result is None:
+            raise KeyError('Key does not match any regex')
+        return result
+
+    def __contains__(self, item):
+        return self.lookup(item) is not None
 
     def __setitem__(self, regex, value):
         self._regexes[re.compile(regex)] = value
+        self._trie = None
+        self.cache.clear()
 
 
 class ParsingDict(object):
     """
     A dictionary-like to handle parsing strings, inspired by the RegExDict
+
+    The formats are sorted into a trie by their literal prefix, so a message is only parsed by the formats which
+    could match it at all. If a lookup matches multiple keys, the one registered first is returned.
+    The results of the recent lookups are cached by the looked up string.
     """
 
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024):
         self._entries = dict()
+        self._prefixes = dict()
 
-        # The last tested item and result
-        self.last_request = None
-        self.last_result = None
+        # The prefix trie, built lazily by compile
+        self._trie = None
 
-    def __getitem__(self, name):
+        # The results of the recent lookups, including failed ones
+        self.cache = LRUCache(cache_size)
 
-        # Check for a possible speedup
-        if self.last_request == name:
-            return self.last_result
+    @staticmethod
+    def _literal_prefix(pattern: str) -> str:
+        """
+        Extracts the text in front of the first field of a format string
+        :param pattern: The format string
+        :return: The literal prefix, unescaped and in lower case as formats are parsed case insensitive
+        """
+
+        prefix = []
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if char in "{}":
+
+                # Doubled braces are escaped ones, anything else starts a field
+                if pattern[i + 1:i + 2] != char:
+                    break
+                i += 1
+            prefix.append(char)
+            i += 1
+
+        prefix = "".join(prefix)
+
+        # Case folding of non-ASCII characters may differ from the regex engine, so do not rely on them
+        if not prefix.isascii():
+            prefix = prefix[:next(i for i, c in enumerate(prefix) if not c.isascii())]
+
+        return prefix.lower()
+
+    def compile(self) -> None:
+        """
+        Builds the prefix trie of the registered formats. Every node holds the formats whose prefix ends there
+        together with their registration order
+        """
+
+        self._trie = ({}, [])
+
+        for index, (pattern, value) in enumerate(self._entries.items()):
+            node = self._trie
+            for char in self._prefixes[pattern]:
+                node = node[0].setdefault(char, ({}, []))
+            node[1].append((index, pattern, value))
+
+    def lookup(self, name: str) -> Optional[Tuple[Any, parse.Result]]:
+        """
+        Finds the value of the first format matching the given string
+        :param name: The string to parse
+        :return: A tuple of the value and the parsing result or None, if no format matches
+        """
 
-        # Search through all inputs for a matching regex
-        for pattern, value in self._entries.items():
+        # Check for a possible speedup
+        result = self.cache.get(name, _MISSING)
+        if result is not _MISSING:
+            return result
+
+        if self._trie is None:
+            self.compile()
+
+        # Collect all formats whose prefix matches the start of the name
+        node = self._trie
+        candidates = list(node[1])
+        for char in name.lower():
+            node = node[0].get(char)
+            if node is None:
+                break
+            candidates.extend(node[1])
+
+        result = None
+
+        # Parse the candidates by their registration order
+        for _, pattern, value in sorted(candidates, key=lambda entry: entry[0]):
             m = pattern.parse(name)
             if m is not None:
-                return value, m
-        raise KeyError('Key does not match any format')
+                result = value, m
+                break
+
+        self.cache[name] = result
+        return result
+
+    def __getitem__(self, name):
+        result = self.lookup(name)
+        if result is None:
+            raise KeyError('Key does not match any format')
+        return result
 
     def __contains__(self, item):
+        return self.lookup(item) is not None
+
+    def __setitem__(self, pattern, value):
+        compiled = parse.compile(pattern)
+        self._entries[compiled] = value
+        self._prefixes[compiled] = self._literal_prefix(pattern)
+        self._trie = None
+        self.cache.clear()
+
+
+class LanguageCatalog(object):
+    """
+    The language file compiled into one flat table per section. The fallbacks of a section, e.g. de_at to de to
+    default, are resolved beforehand, so a lookup is a single dictionary access
+    """
+
+    def __init__(self, sections: Dict[str, Dict[str, str]]):
+        """
+        Compiles the language file
+        :param sections: The language file's sections keyed by the language code, containing the formatting templates
+        """
+
+        sections = {self.normalize(code): entries for code, entries in sections.items() if isinstance(entries, dict)}
+
+        # Pre-parse the templates into the raw text and, if it has no fields, its formatted version
+        templates = {code: {key: self._parse(text) for key, text in entries.items()}
+                     for code, entries in sections.items()}
+
+        # Merge the fallbacks into each section, the most specific one being applied last
+        self._tables: Dict[str, Dict[str, Tuple[str, Optional[str]]]] = dict()
+        for code in templates:
+            table = dict()
+            for fallback in reversed(self._fallbacks(code)):
+                table.update(templates.get(fallback, {}))
+            self._tables[code] = table
+
+        # The tables resolved for the language codes seen so far
+        self._resolved: Dict[str, Dict[str, Tuple[str, Optional[str]]]] = dict()
+
+        # Find the keys which are not available in every section
+        keys = set().union(*(table.keys() for table in self._tables.values()))
+        self.missing: Dict[str, Set[str]] = {code: keys - table.keys() for code, table in self._tables.items()
+                                             if len(keys - table.keys()) > 0}
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        """
+        Brings a language code into the form used by the catalog, e.g. de-AT becomes de_at
+        :param code: The language code
+        :return: The normalized code
+        """
+
+        return code.replace("-", "_").lower()
+
+    @staticmethod
+    def _fallbacks(code: str) -> List[str]:
+        """
+        Lists the sections to consider for a normalized language code, in the order of their priority
+        :param code: The normalized language code
+        :return: The code itself, its more general versions and default
+        """
+
+        parts = code.split("_")
+        return ["_".join(parts[:i]) for i in range(len(parts), 0, -1)] + ["default"]
+
+    @staticmethod
+    def _parse(text: str) -> Tuple[str, Optional[str]]:
+        """
+        Checks a template for replacement fields
+        :param text: The template
+        :return: The template and, if it has no fields, its formatted version
+        """
 
-        # Check existence by accessing the item in question
         try:
+            if all(field is None for _, field, _, _ in Formatter().parse(text)):
+                return text, text.format()
+        except ValueError:
+            pass
 
-            # Remember the last questioned item to speed up access
-            self.last_result = self[item]
-            self.last_request = item
-        except KeyError:
-            return False
-        else:
-            return True
+        return text, None
 
-    def __setitem__(self, pattern, value):
-        self._entries[parse.compile(pattern)] = value
+    def _table(self, code: str) -> Dict[str, Tuple[str, Optional[str]]]:
+        """
+        Retrieves the table for a language code, resolving it only on the first request
+        :param code: The language code as given by telegram
+        :return: The most specific table available
+        """
+
+        table = self._resolved.get(code)
+        if table is None:
+            normalized = self.normalize(code)
+            table = next((self._tables[fallback] for fallback in self._fallbacks(normalized)
+                          if fallback in self._tables), {})
+            self._resolved[code] = table
+
+        return table
+
+    def render(self, code: str, key: str, format_content: Sequence = ()) -> Optional[str]:
+        """
+        Looks up a template and applies the formatting
+        :param code: The language code of the user
+        :param key: The key of the template
+        :param format_content: The formatting arguments
+        :return: The formatted text or None, if the key is unknown
+        """
+
+        entry = self._table(code).get(key)
+        if entry is None:
+            return None
+
+        text, formatted = entry
+
+        if format_content is None or len(format_content) == 0:
+            return text
+        if formatted is not None:
+            return formatted
+        return text.format(*format_content)
 
 
 class Mode(Enum):
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque, OrderedDict
+from functools import partial
+from typing import Callable, Optional, Union
+
+from samt.metrics import Metrics, DisabledMetrics
+
+logger = logging.getLogger(__name__)
+
+# What happens to an update arriving while the queue is full
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+
+class Ingest(object):
+    """
+    Buffers the received updates in a bounded queue and hands them on in their order. Only a limited number of
+    updates is handed on without being processed yet, so a backlog stays in the queue, where it can be measured and
+    bounded. When the queue is full, the policy either lets the receiver wait, which stops polling, or sheds the
+    newest or the oldest updates.
+
+    Updates delivered twice are dropped by their IDs, of which the most recent ones are remembered. The IDs are not
+    compared by their order, as webhooks may deliver updates out of order and telegram starts over with a random ID
+    after a week without updates. The ID up to which all received updates are processed is tracked, so it can be
+    checkpointed
+    """
+
+    def __init__(self, dispatch: Callable[[dict, Callable[[], None]], None], maxsize: int = 1000,
+                 policy: str = BLOCK, pending: int = 1000, metrics: Union[Metrics, DisabledMetrics] = None,
+                 window: int = 10000, processed: int = None):
+        """
+        :param dispatch: The function handing an update on. It receives the update and a function to call once the
+            update is processed or discarded and must not raise
+        :param maxsize: The maximal number of queued updates
+        :param policy: One of "block", "drop_newest" and "drop_oldest"
+        :param pending: The maximal number of updates handed on, but not processed yet
+        :param metrics: The metrics to count the dropped updates in
+        :param window: The number of recent update IDs remembered to detect duplicates, 0 disables the detection
+        :param processed: The ID of the last update processed before, e.g. by a previous run. It and the window of
+            IDs before it are dropped as duplicates
+        """
+
+        if policy not in POLICIES:
+            raise ValueError(f"The ingest policy has to be one of {', '.join(POLICIES)}, not {policy}")
+
+        self.dispatch = dispatch
+        self.policy = policy
+        self.metrics = metrics if metrics is not None else DisabledMetrics()
+        self.dropped = 0
+
+        self._queue = asyncio.Queue(maxsize)
+        self._slots = asyncio.Semaphore(pending)
+        self._pending = 0
+        self._task: Optional[asyncio.Task] = None
+
+        # The recently received IDs as set for the lookup and in their order to forget the oldest
+        self.window = window
+        self._seen = set()
+        self._recent = deque()
+
+        # The checkpoint of the previous run, below which the updates delivered again after a restart are found
+        self.floor = processed
+
+        # The received updates not processed yet by their IDs in their order, marked once processed
+        self.processed = processed
+        self._unfinished: "OrderedDict[int, bool]" = OrderedDict()
+
+    @property
+    def depth(self) -> int:
+        """
+        :return: The number of queued updates
+        """
+
+        return self._queue.qsize()
+
+    @property
+    def pending(self) -> int:
+        """
+        :return: The number of updates handed on, but not processed yet
+        """
+
+        return self._pending
+
+    def _drop(self, update: dict) -> None:
+        self.dropped += 1
+        self.metrics.count("updates_dropped_total", policy=self.policy)
+        self._finish(update.get('update_id'))
+
+    def _is_duplicate(self, update_id: Optional[int]) -> bool:
+        """
+        Tests, if an update was received before, and remembers its ID otherwise
+        :param update_id: The update's ID
+        :return: If it is a duplicate
+        """
+
+        if update_id is None:
+            return False
+        if update_id in self._seen:
+            return True
+
+        # The previous run remembered no IDs, only its checkpoint, so the ones shortly before it count as duplicates
+        if self.floor is not None and self.floor - self.window < update_id <= self.floor:
+            return True
+
+        if self.window > 0:
+            self._seen.add(update_id)
+            self._recent.append(update_id)
+            if len(self._recent) > self.window:
+                self._seen.discard(self._recent.popleft())
+
+        # The updates before the first one received count as processed, which is only confirmed, but not used to
+        # detect duplicates
+        if self.processed is None:
+            self.processed = update_id - 1
+
+        self._unfinished[update_id] = False
+        return False
+
+    def _finish(self, update_id: Optional[int]) -> None:
+        """
+        Marks an update as processed and advances the ID up to which all are processed
+        :param update_id: The update's ID
+        """
+
+        if update_id not in self._unfinished:
+            return
+
+        self._unfinished[update_id] = True
+        while self._unfinished:
+            first, finished = next(iter(self._unfinished.items()))
+            if not finished:
+                break
+            del self._unfinished[first]
+            self.processed = first if self.processed is None else max(self.processed, first)
+
+    async def put(self, update: dict) -> None:
+        """
+        Queues an update, unless it is a duplicate. With the blocking policy, this waits until there is space
+        :param update: The update as received from telegram
+        """
+
+        if self._is_duplicate(update.get('update_id')):
+            self.metrics.count("updates_duplicate_total")
+            return
+
+        if self.policy == BLOCK:
+            await self._queue.put(update)
+            return
+
+        if self._queue.full():
+            if self.policy == DROP_NEWEST:
+                self._drop(update)
+                return
+            self._drop(self._queue.get_nowait())
+
+        self._queue.put_nowait(update)
+
+    def _done(self, update_id: Optional[int]) -> None:
+        self._pending -= 1
+        self._slots.release()
+        self._finish(update_id)
+
+    async def _run(self) -> None:
+        while True:
+            update = await self._queue.get()
+            await self._slots.acquire()
+            self._pending += 1
+            self.dispatch(update, partial(self._done, update.get('update_id')))
+
+    def start(self) -> None:
+        """
+        Starts handing on the queued updates
+        """
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Stops handing on the queued updates and waits for the ones handed on to be processed
+        :param timeout: The maximal seconds to wait
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        deadline = time.monotonic() + timeout
+        while self._pending > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+class Checkpoint(object):
+    """
+    Keeps the ID of the last processed update in a file, so a restarted bot neither processes updates twice nor
+    skips them. The file is replaced atomically and only written when asked to, so it can be written in batches
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: The name of the file
+        """
+
+        self.filename = filename
+        self.written: Optional[int] = None
+
+    def load(self) -> Optional[int]:
+        """
+        Reads the checkpoint
+        :return: The ID of the last processed update or None, if there is no checkpoint yet or it is not readable
+        """
+
+        try:
+            with open(self.filename) as file:
+                update_id = json.load(file)["update_id"]
+            if not isinstance(update_id, int):
+                raise ValueError(f"The update ID {update_id!r} is not an integer")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"The checkpoint {self.filename} is not readable and is ignored:\n\t{e!r}")
+            return None
+
+        self.written = update_id
+        return self.written
+
+    def write(self, update_id: Optional[int]) -> bool:
+        """
+        Writes the checkpoint, if it changed
+        :param update_id: The ID of the last processed update
+        :return: If it was written
+        """
+
+        if update_id is None or update_id == self.written:
+            return False
+
+        temporary = f"{self.filename}.tmp"
+        with open(temporary, "w") as file:
+            json.dump({"update_id": update_id}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.filename)
+
+        self.written = update_id
+        return True
@@ -0,0 +1,80 @@
+import json
+import logging
+import queue
+from datetime import datetime
+from logging.handlers import QueueHandler
+from typing import Callable, Any
+
+
+class Lazy(object):
+    """
+    A log message part, which is only computed when the record is written. Pass it as argument of a %s placeholder
+    """
+
+    __slots__ = ('_func', '_args')
+
+    def __init__(self, func: Callable[..., Any], *args):
+        """
+        :param func: The function computing the text, e.g. the format method of a string
+        :param args: The arguments to pass
+        """
+
+        self._func = func
+        self._args = args
+
+    def __str__(self):
+        return str(self._func(*self._args))
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands the records to a background thread by a bounded queue. The records are formatted by the thread, so logging
+    neither blocks on I/O nor on formatting. If the queue is full, records are dropped instead of waiting and the
+    number of dropped records is logged as soon as there is space again
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        """
+        :param maxsize: The maximal number of records waiting to be written
+        """
+
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+
+        # The record is used by the same process, so formatting is left to the background thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self._unreported > 0:
+                self.queue.put_nowait(logging.LogRecord(
+                    record.name, logging.WARNING, __file__, 0,
+                    "%d log records were dropped, as they could not be written fast enough", (self._unreported,),
+                    None))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the records as JSON objects, one per line
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import threading
+from os import path, stat, replace, getpid, SEEK_END
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Optional, List, BinaryIO, AsyncIterator, Any
+
+from samt.helper import Media
+
+# The keys of the sent message containing the uploaded file, by media type
+_RESULT_KEYS = {
+    Media.VOICE: ("voice", "audio", "document"),
+    Media.AUDIO: ("audio", "voice", "document"),
+    Media.PHOTO: ("photo", "document"),
+    Media.VIDEO: ("video", "animation", "document"),
+    Media.DOCUMENT: ("document", "animation", "video", "audio"),
+}
+
+
+def file_id_of(media_type: Media, sent: dict) -> Optional[str]:
+    """
+    Finds the ID telegram assigned to an uploaded file
+    :param media_type: The media type the file was sent as
+    :param sent: The sent message as returned by telegram
+    :return: The file ID or None, if the message contains no file
+    """
+
+    # Photos are returned in several sizes with the largest one being the last
+    for key in _RESULT_KEYS.get(media_type, ()):
+        if key in sent:
+            uploaded = sent[key][-1] if isinstance(sent[key], list) else sent[key]
+            return uploaded['file_id']
+
+    return None
+
+
+async def read_chunks(fileobj: BinaryIO, size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """
+    Reads a file-like object in chunks by a thread, so the event loop is not blocked
+    :param fileobj: The object to read, it is not closed
+    :param size: The size of the chunks
+    :return: The chunks
+    """
+
+    loop = asyncio.get_event_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, fileobj.read, size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class MediaCache(object):
+    """
+    Remembers the file IDs telegram assigned to uploaded local files, so every file is uploaded only once.
+    A file is identified by its path, modification time and size, so changed files are uploaded again.
+    Looking up and remembering a file access the disk, so they are meant to be called by a thread. Several processes
+    may share the file, as the entries remembered by the others are kept when it is written
+    """
+
+    def __init__(self, filename: Optional[str] = None):
+        """
+        Loads the cache from disk, if it was persisted before
+        :param filename: The file to persist the cache in or None to only keep it in memory
+        """
+
+        self.filename = filename
+        self._entries: Dict[str, List] = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List]:
+        if self.filename is None or not path.isfile(self.filename):
+            return dict()
+
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return entries if isinstance(entries, dict) else dict()
+
+    @staticmethod
+    def _key(media_type: Media, filename: str) -> str:
+        return f"{media_type.name}:{path.realpath(filename)}"
+
+    def get(self, media_type: Media, filename: str) -> Optional[str]:
+        """
+        Looks up the file ID of a previously uploaded file
+        :param media_type: The media type the file is sent as
+        :param filename: The path to the file
+        :return: The file ID or None, if the file was not uploaded yet or has changed since
+        """
+
+        entry = self._entries.get(self._key(media_type, filename))
+        if entry is None:
+            return None
+
+        try:
+            info = stat(filename)
+        except OSError:
+            return None
+
+        mtime, size, file_id = entry
+        return file_id if (mtime, size) == (info.st_mtime, info.st_size) else None
+
+    def put(self, media_type: Media, filename: str, sent: dict) -> None:
+        """
+        Remembers the file ID of an uploaded file and persists the cache
+        :param media_type: The media type the file was sent as
+        :param filename: The path to the file
+        :param sent: The sent message as returned by telegram
+        """
+
+        file_id = file_id_of(media_type, sent)
+        if file_id is None:
+            return
+
+        info = stat(filename)
+
+        # The cache is written in the order of the changes, even if several threads remember files at once. The files
+        # other processes remembered since are adopted, so they are not lost by replacing the file
+        with self._lock:
+            self._entries[self._key(media_type, filename)] = [info.st_mtime, info.st_size, file_id]
+            if self.filename is not None:
+                self._entries = {**self._load(), **self._entries}
+                self._save(json.dumps(self._entries))
+
+    def discard(self, media_type: Media, filename: str) -> None:
+        """
+        Forgets the file ID of a file and persists the cache, so it is not adopted from the file again
+        :param media_type: The media type the file was sent as
+        :param filename: The path to the file
+        """
+
+        key = self._key(media_type, filename)
+        with self._lock:
+            self._entries.pop(key, None)
+            if self.filename is not None:
+                self._entries = {**self._load(), **self._entries}
+                self._entries.pop(key, None)
+                self._save(json.dumps(self._entries))
+
+    def _save(self, content: str) -> None:
+
+        # Replace the file at once, so it is never left half written, even if several processes write it
+        temporary = f"{self.filename}.{getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(content)
+        replace(temporary, self.filename)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Upload(object):
+    """
+    The upload of media given as content instead of a path. It is shared by the copies of an answer, e.g. the ones
+    rendered per language by a broadcast, so the media is uploaded once and sent by its file ID afterwards.
+    Streams can only be read once, so until an upload succeeded, the chunks read from them are spooled to a temporary
+    file, which keeps only its first bytes in memory, to be sent again. Files which can be rewound are read from their
+    start again instead
+    """
+
+    def __init__(self, spool_size: int = 1024 * 1024):
+        """
+        :param spool_size: The bytes of a stream kept in memory, the rest is spooled to disk
+        """
+
+        self.file_id: Optional[str] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.spool_size = spool_size
+
+        # The position to rewind a file to or the spooled chunks of a stream and the ones left to read
+        self._prepared = False
+        self._start: Optional[int] = None
+        self._spool: Optional[SpooledTemporaryFile] = None
+        self._spooled = 0
+        self._source: Optional[AsyncIterator[bytes]] = None
+        self._broken = False
+
+    async def content(self, content: Any) -> Any:
+        """
+        Prepares the content for an attempt to upload it
+        :param content: The content as given to the answer
+        :return: The content to pass to the request
+        :raises ValueError: If a stream was interrupted while being read, so its chunks are lost
+        """
+
+        if not hasattr(content, 'read') and not hasattr(content, '__aiter__'):
+            return content
+
+        loop = asyncio.get_event_loop()
+        if not self._prepared:
+            self._prepared = True
+            if hasattr(content, 'read'):
+                self._start = await loop.run_in_executor(None, _position, content)
+
+            # Streams which cannot be rewound are spooled while being sent
+            if self._start is None:
+                self._source = read_chunks(content) if hasattr(content, 'read') else content.__aiter__()
+                self._spool = SpooledTemporaryFile(self.spool_size)
+
+        if self._start is not None:
+            await loop.run_in_executor(None, content.seek, self._start)
+            return read_chunks(content)
+
+        if self._broken:
+            raise ValueError("The media stream was interrupted while being uploaded and cannot be sent again, pass the "
+                             "media as bytes or as a file which can be rewound instead")
+        return self._replay()
+
+    async def _replay(self) -> AsyncIterator[bytes]:
+        loop = asyncio.get_event_loop()
+
+        # The chunks spooled by the earlier attempts are read back first
+        position = 0
+        while position < self._spooled:
+            chunk = await loop.run_in_executor(None, _read_at, self._spool, position, 64 * 1024)
+            position += len(chunk)
+            yield chunk
+
+        while True:
+            try:
+                chunk = await self._source.__anext__()
+            except StopAsyncIteration:
+                return
+            except BaseException:
+                self._broken = True
+                raise
+
+            await loop.run_in_executor(None, _append, self._spool, chunk)
+            self._spooled += len(chunk)
+            yield chunk
+
+    def done(self, file_id: Optional[str]) -> None:
+        """
+        Remembers the file ID of the successful upload and releases the spooled chunks
+        :param file_id: The ID telegram assigned to the file or None, if it is not known, so the chunks are kept
+        """
+
+        self.file_id = file_id
+        if file_id is not None and self._spool is not None:
+            self._spool.close()
+            self._spool = self._source = None
+
+
+def _position(fileobj: BinaryIO) -> Optional[int]:
+    """
+    :return: The position to rewind a file to or None, if it cannot be rewound
+    """
+
+    try:
+        return fileobj.tell() if fileobj.seekable() else None
+    except (AttributeError, OSError):
+        return None
+
+
+def _read_at(fileobj: BinaryIO, position: int, size: int) -> bytes:
+    fileobj.seek(position)
+    return fileobj.read(size)
+
+
+def _append(fileobj: BinaryIO, chunk: bytes) -> None:
+    fileobj.seek(0, SEEK_END)
+    fileobj.write(chunk)
@@ -0,0 +1,223 @@
+import time
+from bisect import bisect_left
+from typing import Dict, Tuple, Callable, List, Sequence
+
+# The upper bounds of the histogram buckets in seconds, from a millisecond to half a minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class Histogram(object):
+    """
+    Counts observed durations by buckets, like a prometheus histogram
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        """
+        :return: The number of observations up to each bound, as prometheus expects the buckets
+        """
+
+        total, result = 0, []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class _Timer(object):
+    """
+    Measures the duration of a with block and records it when the block is left
+    """
+
+    __slots__ = ('_metrics', '_key', '_started')
+
+    def __init__(self, metrics: "Metrics", key: _Key):
+        self._metrics = metrics
+        self._key = key
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics._observe(self._key, time.perf_counter() - self._started)
+        return False
+
+
+class _NullTimer(object):
+    """
+    A timer measuring nothing, used when the metrics are disabled
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    """
+    Records the durations of the processing stages and counts events. The values are kept in memory and rendered in
+    prometheus' text format on request
+    """
+
+    enabled = True
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS, prefix: str = "samt"):
+        """
+        :param buckets: The upper bounds of the histogram buckets in seconds
+        :param prefix: The prefix of all metric names
+        """
+
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self._histograms: Dict[_Key, Histogram] = dict()
+        self._counters: Dict[_Key, int] = dict()
+        self._gauges: Dict[str, Tuple[Callable[[], float], str]] = dict()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> _Key:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def _observe(self, key: _Key, seconds: float) -> None:
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def time(self, stage: str, **labels) -> _Timer:
+        """
+        Measures the duration of a with block
+        :param stage: The processing stage, which is added as label
+        :param labels: Further labels distinguishing the measurements
+        :return: The timer to use as context manager
+        """
+
+        labels['stage'] = stage
+        return _Timer(self, self._key("stage_seconds", labels))
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        """
+        Records a duration measured by the caller
+        :param stage: The processing stage, which is added as label
+        :param seconds: The duration
+        :param labels: Further labels distinguishing the measurements
+        """
+
+        labels['stage'] = stage
+        self._observe(self._key("stage_seconds", labels), seconds)
+
+    def count(self, name: str, amount: int = 1, **labels) -> None:
+        """
+        Increases a counter
+        :param name: The counter's name without the prefix
+        :param amount: The value to add
+        :param labels: The labels distinguishing the counters of the same name
+        """
+
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name: str, func: Callable[[], float], description: str = "") -> None:
+        """
+        Registers a value, which is read whenever the metrics are rendered
+        :param name: The gauge's name without the prefix
+        :param func: The function returning the current value
+        :param description: The help text
+        """
+
+        self._gauges[name] = func, description
+
+    def render(self) -> str:
+        """
+        Renders all metrics in prometheus' text exposition format
+        :return: The text to serve
+        """
+
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str, description: str = "") -> None:
+            if name not in typed:
+                typed.add(name)
+                if description:
+                    lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            name = f"{self.prefix}_{name}"
+            declare(name, "histogram", "The duration of the processing stages")
+            for bound, count in zip(self.buckets, histogram.cumulative()):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(float(bound))),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            name = f"{self.prefix}_{name}"
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, (func, description) in sorted(self._gauges.items()):
+            name = f"{self.prefix}_{name}"
+            declare(name, "gauge", description)
+            lines.append(f"{name} {func()}")
+
+        return "\n".join(lines) + "\n"
+
+
+class DisabledMetrics(object):
+    """
+    The metrics used when instrumentation is turned off. All methods do nothing, so the instrumented code only pays
+    for a method call
+    """
+
+    enabled = False
+
+    def time(self, stage: str, **labels) -> _NullTimer:
+        return _NULL_TIMER
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        pass
+
+    def count(self, name: str, amount: int = 1, **labels) -> None:
+        pass
+
+    def gauge(self, name: str, func: Callable[[], float], description: str = "") -> None:
+        pass
+
+    def render(self) -> str:
+        return ""
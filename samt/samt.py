@@ -1,30 +1,57 @@
 import asyncio
+import atexit
+import copy
+import hmac
+import itertools
+import json
 import logging
 import math
-import platform
+import multiprocessing
+import queue
 import signal
 import sys
+import threading
+import time
 import traceback
 import types
-from collections import deque
-from inspect import iscoroutinefunction, isgenerator, isasyncgen
-from os import path, system
-from typing import Dict, Callable, Tuple, Iterable, Union, Collection
+from collections import deque, OrderedDict
+from functools import partial
+from inspect import iscoroutinefunction, isgenerator, isasyncgen, isawaitable
+from logging.handlers import QueueListener, QueueHandler, RotatingFileHandler, TimedRotatingFileHandler
+from os import path
+from typing import Dict, Callable, Tuple, Iterable, Union, Collection, AsyncIterable, Awaitable, NamedTuple, FrozenSet, \
+    BinaryIO
 
 import aiotask_context as _context
-import collections
-import telepot
-import telepot.aio.delegate
+import collections.abc
 import toml
-from telepot.aio.loop import MessageLoop
-from telepot.exception import TelegramError
-from telepot.namedtuple import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, \
-    ReplyKeyboardRemove
 
+from samt.bot import LowerBot, TelegramError, BadRequest, Unauthorized, NotFound
+from samt.conversation import Conversation, Transition, STATE_KEY
+from samt.executor import HandlerPool, LOOP, THREAD, PROCESS, is_handler_process
 from samt.helper import *
+from samt.ingest import Ingest, Checkpoint, BLOCK
+from samt.log import Lazy, DroppingQueueHandler, JsonFormatter
+from samt.media import MediaCache, Upload, file_id_of
+from samt.metrics import Metrics, DisabledMetrics, DEFAULT_BUCKETS
+from samt.scheduler import SendScheduler
+from samt.sharding import ShardPool, is_worker
+from samt.storage import Storage, SQLiteStorage, TinyDBStorage, TrackedDict, WriteBehind
 
 logger = logging.getLogger(__name__)
 
+# The event loop, set when the bot starts listening
+loop = None
+
+# The maximal length of a text message accepted by telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# The bot created by the main module, run by the worker processes
+_instance = None
+
+# The instrumentation of the processing stages, replaced when metrics are enabled
+_metrics = DisabledMetrics()
+
 
 def _load_configuration(filename: str) -> dict:
     """
@@ -37,16 +64,17 @@ def _load_configuration(filename: str) -> dict:
     return toml.load(f"{script_path}/config/{filename}.toml")
 
 
-def _config_value(*keys, default: Any = None) -> Any:
+def _config_value(*keys, default: Any = None, config: dict = None) -> Any:
     """
     Safely accesses any key in the configuration and returns a default value if it is not found
     :param keys: The keys to the config dictionary
     :param default: The value to return if nothing is found
+    :param config: The configuration to look into, by default the current one
     :return: Either the desired or the default value
     """
 
     # Traverse through the dictionaries
-    step = _config
+    step = _config if config is None else config
     for key in keys:
         try:
 
@@ -60,6 +88,58 @@ def _config_value(*keys, default: Any = None) -> Any:
     return step
 
 
+class Settings(NamedTuple):
+    """
+    An immutable snapshot of the configuration values used while processing messages, so they do not have to be
+    looked up in the configuration on every message. It is replaced as a whole when the configuration is reloaded
+    """
+
+    allowed_ids: Optional[FrozenSet]
+    cancel_command: str
+    replace_query: bool
+    error_reply: Optional[str]
+    extract_emojis: bool
+    max_history_entries: int
+    mark_as_answer: bool
+    markup: Optional[str]
+    language_feature: bool
+    strict_mode: bool
+    disable_web_preview: bool
+    disable_notification: bool
+    executor: str
+    overflow_mode: str
+    handler_timeout: Optional[float]
+
+    @classmethod
+    def from_config(cls, config: dict = None) -> "Settings":
+        """
+        Reads the configuration
+        :param config: The configuration to read, by default the current one
+        :return: The new snapshot
+        """
+
+        value = partial(_config_value, config=config)
+        ids = value('general', 'allowed_ids')
+
+        return cls(
+            allowed_ids=frozenset(ids) if ids is not None else None,
+            cancel_command=value('bot', 'cancel_command', default="/cancel"),
+            replace_query=value('query', 'replace_query', default=True),
+            error_reply=value('bot', 'error_reply', default=None),
+            extract_emojis=value('bot', 'extract_emojis', default=False),
+            max_history_entries=value('bot', 'max_history_entries', default=10),
+            mark_as_answer=value('bot', 'mark_as_answer', default=False),
+            markup=value('bot', 'markup', default=None),
+            language_feature=value('bot', 'language_feature', default=False),
+            strict_mode=value('bot', 'strict_mode', default=False),
+            disable_web_preview=value('bot', 'disable_web_preview', default=False),
+            disable_notification=value('bot', 'disable_notification', default=False),
+            executor=value('bot', 'executor', default=LOOP),
+            overflow_mode=value('bot', 'overflow_mode', default="document"),
+            handler_timeout=value('bot', 'handler_timeout', default=None),
+        )
+
+
 class Bot:
     """
     The main class of this framework
@@ -67,6 +147,9 @@ class Bot:
 
     _on_termination = lambda: None
 
+    # The handler writing the log records by a background thread, which the workers' records are handed to as well
+    _log_handler: Optional[logging.Handler] = None
+
     def __init__(self):
         """
         Initialize the framework using the configuration file(s)
@@ -84,31 +167,82 @@ class Bot:
         # Initialize logger
         self._configure_logger()
 
+        # Take the snapshot of the values used while processing messages
+        global _settings
+        _settings = Settings.from_config()
+
         # Read language files
-        if _config_value('bot', 'language_feature', default=False):
+        if _settings.language_feature:
             try:
-                _Session.language = _load_configuration("lang")
+                _Session.language = self._load_language()
             except FileNotFoundError:
                 logger.critical("The language file could not be found. Please make sure there is a file called " +
                                 "lang.toml in the directory config or disable this feature.")
                 quit(-1)
 
-        signal.signal(signal.SIGINT, Bot.signal_handler)
-
         # Prepare empty stubs
         self._on_startup = None
+        self._ingest = None
+        self._checkpoint = None
+        self._exit_code = 0
 
         # Create access level dictionary
         self.access_checker = dict()
 
+        global _instance
+
+        # Pool processes import the main module again to find the handlers. They only need the routes and the
+        # settings, but neither the storage, the log files, the media cache nor a connection to telegram
+        if is_handler_process():
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            Answer._apply_settings()
+            _instance = self
+            return
+
+        signal.signal(signal.SIGINT, Bot.signal_handler)
+
         # Config Answer class
         Answer._load_defaults()
 
+        # Limit the number of cached route lookups
+        _Session.parse_routes.cache.maxsize = _config_value('bot', 'route_cache_size', default=1024)
+        _Session.regex_routes.cache.maxsize = _config_value('bot', 'route_cache_size', default=1024)
+
+        # Limit the number of cached keyboards
+        Keyboard.cache.maxsize = _config_value('bot', 'keyboard_cache_size', default=256)
+
+        # Record the durations of the processing stages, if enabled
+        global _metrics
+        if _config_value('metrics', 'enabled', default=False):
+            _metrics = Metrics(_config_value('metrics', 'buckets', default=DEFAULT_BUCKETS))
+            _metrics.gauge("live_sessions", lambda: len(_Session.sessions), "The number of open sessions")
+            _metrics.gauge("bytes_per_session", lambda: Bot.session_stats()["bytes_per_session"],
+                           "The average size of the open sessions in bytes, measured when scraped")
+            _metrics.gauge("pending_storage_writes", lambda: len(_Session.write_behind or ()),
+                           "The number of changed storages waiting to be written")
+            _metrics.gauge("ingest_queue_depth", lambda: self._ingest.depth if self._ingest is not None else 0,
+                           "The number of received updates waiting to be handed to the sessions")
+            _metrics.gauge("pending_updates", lambda: self._ingest.pending if self._ingest is not None else 0,
+                           "The number of updates handed to the sessions, but not processed yet")
+            _metrics.gauge("active_chats", lambda: _Session.active,
+                           "The number of chats, whose updates are being processed")
+
+        # The pools running synchronous handlers outside of the event loop, if configured
+        _Session.handler_pool = HandlerPool(_config_value('bot', 'handler_threads'),
+                                            _config_value('bot', 'handler_processes'))
+
         # Load database
         if _config_value('general', 'persistent_storage', default=False):
-            name = _config_value('general', 'storage_file', default="db.json")
+            default_name = "db.sqlite" if _config_value('general', 'storage_backend') == "sqlite" else "db.json"
+            name = _config_value('general', 'storage_file', default=default_name)
             args = _config_value('general', 'storage_args', default=" ").split(" ")
-            _Session.database = self._initialize_persistent_storage(name, *args)
+            database = self._initialize_persistent_storage(name, *args)
+
+            # Custom storages may return an open TinyDB database, as the default storage did before
+            if not isinstance(database, Storage) and TinyDBStorage.wraps(database):
+                database = TinyDBStorage(database)
+            _Session.database = database
+            _Session.write_behind = WriteBehind(_Session.store_user_data, _metrics)
         else:
             _Session.database = None
 
@@ -116,11 +250,76 @@ class Bot:
         self._create_bot()
         logger.info("Bot started")
 
-    def listen(self) -> None:
+        _instance = self
+
+    @staticmethod
+    def _load_language() -> LanguageCatalog:
+        """
+        Reads and compiles the language file
+        :return: The compiled catalog, which renders the answers of every language
+        """
+
+        language = LanguageCatalog(_load_configuration("lang"))
+
+        # Report incomplete sections once instead of on every message
+        for code, keys in language.missing.items():
+            logger.warning('The language section "{}" and its fallbacks miss the keys: {}'
+                           .format(code, ", ".join(sorted(keys))))
+
+        return language
+
+    def reload_configuration(self) -> None:
         """
-        Activates the bot by running it in a never ending asynchronous loop
+        Reads the configuration and language files again and replaces the settings used while processing messages.
+        Settings which are only used on startup, like the token or the storage, take effect after a restart
         """
 
+        global _config, _settings
+
+        # Everything is read before anything is replaced, so a failing step keeps the previous configuration
+        try:
+            config = _load_configuration("config")
+            settings = Settings.from_config(config)
+            language = self._load_language() if settings.language_feature else _Session.language
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"The configuration could not be reloaded, the previous one is kept:\n\t{e!r}")
+            return
+
+        # Swap the configuration, the snapshot and the language at once
+        _config, _settings, _Session.language = config, settings, language
+        Answer._apply_settings()
+        logger.info("Configuration reloaded")
+
+    async def watch_configuration(self, interval: float) -> None:
+        """
+        Reloads the configuration whenever the configuration or language file has been changed
+        :param interval: The seconds between two checks
+        """
+
+        script_path = path.dirname(path.realpath(sys.argv[0]))
+        files = [f"{script_path}/config/config.toml", f"{script_path}/config/lang.toml"]
+
+        def modification_times():
+            return [path.getmtime(file) if path.exists(file) else None for file in files]
+
+        last = modification_times()
+        while True:
+            await asyncio.sleep(interval)
+            current = modification_times()
+            if current != last:
+                last = current
+                self.reload_configuration()
+
+    def _prepare_loop(self, worker: int = None) -> None:
+        """
+        Creates the event loop and the tasks every process processing messages needs
+        :param worker: The index of the worker process or None for the main process
+        """
+
+        # Compile the routes once, so the first messages do not pay for it
+        _Session.regex_routes.compile()
+        _Session.parse_routes.compile()
+
         # Creates an event loop
         global loop
         loop = asyncio.get_event_loop()
@@ -128,8 +327,111 @@ class Bot:
         # Changes its task factory to use the async context provided by aiotask_context
         loop.set_task_factory(_context.copying_task_factory)
 
+        # Reload the configuration on SIGHUP or, if enabled, on changes of the files
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, self.reload_configuration)
+        if _config_value('general', 'config_watch_interval', default=0) > 0:
+            loop.create_task(self.watch_configuration(_config_value('general', 'config_watch_interval')))
+
+        # Write changed storages periodically
+        if _Session.database is not None:
+            loop.create_task(self.schedule_storage_flush())
+
+        # Close the sessions which were idle for too long
+        loop.create_task(_Session.expire(_Session.timeout))
+
+        # Serve the metrics, each worker on the port following the ones of the main process and the previous workers
+        if _metrics.enabled:
+            port = _config_value('metrics', 'port', default=9090) + (worker + 1 if worker is not None else 0)
+            loop.run_until_complete(self._start_metrics(port))
+
+    @property
+    def metrics(self) -> Union[Metrics, DisabledMetrics]:
+        """
+        The instrumentation of the processing stages, which can be used to record own measurements as well
+        """
+
+        return _metrics
+
+    @staticmethod
+    async def _start_metrics(port: int) -> None:
+        """
+        Starts a HTTP server serving the metrics in prometheus' text format
+        :param port: The port to listen on
+        """
+
+        from aiohttp import web
+
+        async def serve(request: web.Request) -> web.Response:
+            return web.Response(text=_metrics.render(), content_type="text/plain", charset="utf-8",
+                                headers={"X-Content-Type-Options": "nosniff"})
+
+        app = web.Application()
+        app.router.add_get(_config_value('metrics', 'path', default="/metrics"), serve)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        host = _config_value('metrics', 'host', default="127.0.0.1")
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Serving metrics on {host}:{port}")
+
+    def listen(self, mode: str = None, workers: int = None) -> None:
+        """
+        Activates the bot by running it in a never ending asynchronous loop
+        :param mode: Either "polling" to fetch the updates from telegram or "webhook" to receive them by a local HTTP
+            server. Defaults to the configured mode or polling
+        :param workers: The number of processes handling the messages. With more than one, this process only receives
+            the updates and hands each to the worker responsible for its chat. Defaults to the configured number or one
+        """
+
+        # The workers import the main module again, but run the bot by themselves
+        if is_worker():
+            return
+
+        mode = mode or _config_value('bot', 'mode', default="polling")
+        workers = workers or _config_value('bot', 'workers', default=1)
+
+        pool = None
+        if workers > 1:
+            if _Session.database is not None and not isinstance(_Session.database, SQLiteStorage):
+                logger.warning("The persistent storage is shared by several workers, use the sqlite backend")
+
+            # The workers hand their log records to this process, which writes them
+            logs = multiprocessing.get_context("spawn").Queue()
+            if Bot._log_handler is not None:
+                listener = QueueListener(logs, Bot._log_handler)
+                listener.start()
+                atexit.register(listener.stop)
+
+            pool = ShardPool(workers, Bot._run_worker, (logs,))
+            pool.start()
+            logger.info(f"Started {workers} workers")
+
+            # The workers process the updates, so this process does not know which are processed
+            if _config_value('bot', 'checkpoint_file') is not None:
+                logger.warning("The update checkpoint is not supported with several workers and is not written")
+
+        self._prepare_loop()
+        if pool is None:
+            self._start_ingest(checkpoint=True)
+
         # Creates the forever running bot listening function as task
-        loop.create_task(MessageLoop(self._bot).run_forever(timeout=None))
+        poller = None
+        if pool is not None:
+
+            # The workers process the messages, so they reload the configuration instead
+            if hasattr(signal, "SIGHUP"):
+                loop.add_signal_handler(signal.SIGHUP, pool.signal, signal.SIGHUP)
+            loop.create_task(self._supervise_workers(pool))
+
+            if mode == "webhook":
+                loop.run_until_complete(self._start_webhook(pool.dispatch))
+            else:
+                poller = loop.create_task(self._poll(pool.dispatch))
+        elif mode == "webhook":
+            loop.run_until_complete(self._start_webhook(self._ingest.put))
+        else:
+            poller = loop.create_task(self._poll(self._ingest.put))
 
         # Create the startup as a separated task
         loop.create_task(self.schedule_startup())
@@ -137,23 +439,277 @@ class Bot:
         # Start the event loop to never end (of itself)
         loop.run_forever()
 
+        # The loop was stopped by the signal handler, so stop polling, let the workers and the running handlers finish
+        # and write all pending storages
+        if poller is not None:
+            poller.cancel()
+        if self._ingest is not None:
+            loop.run_until_complete(self._ingest.drain(_config_value('bot', 'shutdown_timeout', default=5)))
+        if pool is not None:
+            pool.stop()
+        _Session.handler_pool.shutdown()
+        if _Session.database is not None:
+            loop.run_until_complete(self._close_storage())
+        if self._checkpoint is not None and (_Session.database is None or len(_Session.write_behind) == 0):
+            self._write_checkpoint(self._ingest.processed)
+        loop.run_until_complete(self._bot.close())
+
+        Bot._on_termination()
+        logger.info("Bot shuts down")
+        quit(self._exit_code)
+
+    @staticmethod
+    async def _supervise_workers(pool: ShardPool) -> None:
+        """
+        Restarts the workers which exited unexpectedly
+        :param pool: The running workers
+        """
+
+        while True:
+            await asyncio.sleep(1)
+            for index, exitcode in pool.check():
+                logger.error(f"Worker {index} exited with code {exitcode} and was restarted")
+
+    @staticmethod
+    def _run_worker(index: int, count: int, updates: multiprocessing.Queue, logs: multiprocessing.Queue) -> None:
+        """
+        Runs a worker process, which handles the updates of its share of the chats
+        :param index: The worker's index
+        :param count: The number of workers
+        :param updates: The queue the updates are received by, ending with None
+        :param logs: The queue the log records are handed to the main process by
+        """
+
+        # The log records are written by the main process
+        handler = QueueHandler(logs)
+        for framework_logger in Bot._loggers():
+            framework_logger.addHandler(handler)
+
+        # The main module was imported again and has created the bot
+        bot = _instance
+        if bot is None:
+            raise RuntimeError("The main module has to create the bot when imported to run it in workers")
+
+        # The main process decides when to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # The workers share telegram's global rate limit
+        if Answer.scheduler is not None:
+            Answer.scheduler.set_global_rate(Answer.scheduler.global_rate / count)
+
+        bot._prepare_loop(index)
+        ingest = bot._start_ingest()
+
+        # Blocking reads are done by a thread, which hands the updates to the loop in their order and waits, if the
+        # ingest queue is full
+        def receive() -> None:
+            parent = multiprocessing.parent_process()
+            while True:
+                try:
+                    update = updates.get(timeout=1)
+                except queue.Empty:
+                    if parent is not None and not parent.is_alive():
+                        break
+                    continue
+
+                if update is None:
+                    break
+                asyncio.run_coroutine_threadsafe(ingest.put(update), loop).result()
+
+            loop.call_soon_threadsafe(loop.stop)
+
+        threading.Thread(target=receive, daemon=True).start()
+        logger.info(f"Worker {index} started")
+
+        loop.run_forever()
+
+        loop.run_until_complete(ingest.drain(_config_value('bot', 'shutdown_timeout', default=5)))
+        _Session.handler_pool.shutdown()
+        if _Session.database is not None:
+            loop.run_until_complete(bot._close_storage())
+        loop.run_until_complete(bot._bot.close())
+        logger.info(f"Worker {index} shuts down")
+
+    async def _start_webhook(self, feed: Callable[[dict], Any]) -> None:
+        """
+        Starts a HTTP server receiving the updates posted by telegram and hands them on.
+        If a public URL is configured, the webhook is registered at telegram
+        :param feed: The function or coroutine function the updates are handed to
+        """
+
+        from aiohttp import web
+
+        secret = _config_value('webhook', 'secret_token')
+
+        async def receive(request: web.Request) -> web.Response:
+
+            # Only accept updates from telegram, which sends the secret token along
+            if secret is not None and not hmac.compare_digest(
+                    request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+                return web.Response(status=403)
+
+            try:
+                update = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+
+            # Errors are only logged, as telegram would otherwise deliver the same update again
+            try:
+                result = feed(update)
+                if isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.warning(f"An update could not be dispatched:\n\t{e!r}")
+
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(_config_value('webhook', 'path', default="/webhook"), receive)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        host = _config_value('webhook', 'host', default="127.0.0.1")
+        port = _config_value('webhook', 'port', default=8080)
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Listening for updates on {host}:{port}")
+
+        url = _config_value('webhook', 'url')
+        if url is not None:
+            await self._bot.set_webhook(url, secret)
+
     def _create_bot(self) -> None:
         """
-        Creates the bot using the telepot API
+        Creates the client of the Bot API
+        """
+
+        # Idle sessions are closed, which only loses data, if their storage is not persisted
+        _Session.timeout = _config_value('bot', 'timeout', default=3600 if _Session.database is not None else 31536000)
+        _Session.max_sessions = _config_value('bot', 'max_sessions')
+        if _Session.max_sessions is not None and _Session.database is None:
+            logger.warning("The number of sessions is limited without a persistent storage, so evicted sessions lose "
+                           "their storage and conversations")
+
+        # The chats are processed concurrently, but only up to the given number at once
+        concurrency = _config_value('bot', 'max_concurrent_chats')
+        _Session.concurrency = asyncio.Semaphore(concurrency) if concurrency is not None else None
+
+        # The requests may be sent to another server than telegram, like a local Bot API server or the simulator
+        self._bot = LowerBot(_config_value('bot', 'token'), _config_value('bot', 'api_url'),
+                             connections=_config_value('bot', 'connections', default=100))
+        _Session.bot = self._bot
+
+    async def _poll(self, feed: Callable[[dict], Any]) -> None:
+        """
+        Receives the updates by long polling. The next updates are requested while the previous ones are handed on.
+        If telegram rejects the token, the bot shuts down, as it would otherwise keep running without receiving anything
+        :param feed: The function or coroutine function the updates are handed to
+        """
+
+        # With a checkpoint, polling continues after the last processed update and only confirms processed ones
+        offset, confirmed = None, None
+        if self._checkpoint is not None:
+            offset = self._ingest.processed + 1 if self._ingest.processed is not None else None
+            confirmed = lambda: self._ingest.processed
+
+        try:
+            async for update in self._bot.updates(offset, timeout=_config_value('bot', 'poll_timeout', default=20),
+                                                  confirmed=confirmed):
+                try:
+                    result = feed(update)
+                    if isawaitable(result):
+                        await result
+                except Exception as e:
+                    logger.warning(f"An update could not be dispatched:\n\t{e!r}")
+        except (Unauthorized, NotFound) as e:
+            logger.error(f"The updates could not be received, please check the token. The bot shuts down:\n\t{e!r}")
+            self._exit_code = 1
+            loop.stop()
+
+    def _start_ingest(self, checkpoint: bool = False) -> Ingest:
+        """
+        Creates and starts the bounded queue the received updates wait in until they are handed to the sessions
+        :param checkpoint: If the ID of the last processed update is written to the configured file, if any, and
+            read from it to skip the updates processed before
+        :return: The queue
+        """
+
+        def dispatch(update: dict, done: Callable[[], None]) -> None:
+            try:
+                _Session.dispatch(update, done)
+            except Exception as e:
+                done()
+                logger.warning(f"An update could not be dispatched:\n\t{e!r}")
+
+        self._ingest = Ingest(dispatch,
+                              maxsize=_config_value('bot', 'ingest_queue_size', default=1000),
+                              policy=_config_value('bot', 'ingest_policy', default=BLOCK),
+                              pending=_config_value('bot', 'max_pending_updates', default=1000),
+                              metrics=_metrics,
+                              window=_config_value('bot', 'dedup_window', default=10000))
+
+        # Continue after the last processed update, which is written in batches
+        filename = _config_value('bot', 'checkpoint_file')
+        if checkpoint and filename is not None:
+            self._checkpoint = Checkpoint(f"{path.dirname(path.realpath(sys.argv[0]))}/{filename}")
+            self._ingest.processed = self._ingest.floor = self._checkpoint.load()
+            if self._ingest.processed is not None:
+                logger.info(f"Continuing after update {self._ingest.processed}")
+            loop.create_task(self.schedule_checkpoint())
+
+        self._ingest.start()
+        return self._ingest
+
+    async def schedule_checkpoint(self) -> None:
+        """
+        Writes the ID of the last processed update in a fixed interval, if it changed. With a persistent storage, the
+        storages are written first, so the checkpoint never claims changes which are not stored yet
+        """
+
+        interval = _config_value('bot', 'checkpoint_interval', default=1)
+
+        while True:
+            await asyncio.sleep(interval)
+            processed = self._ingest.processed
+            try:
+                if _Session.database is not None:
+                    await _Session.write_behind.flush()
+                await loop.run_in_executor(None, self._write_checkpoint, processed)
+            except Exception as e:
+                logger.warning(f"The update checkpoint could not be written and will be retried:\n\t{e!r}")
+
+    def _write_checkpoint(self, processed: Optional[int]) -> None:
+        """
+        Writes the ID of the last processed update
+        :param processed: The ID
+        """
+
+        if self._checkpoint.write(processed):
+            logger.debug(f"Checkpointed update {processed}")
+
+    @staticmethod
+    def session_stats() -> Dict[str, float]:
+        """
+        Measures the live sessions. As the size of every session is computed, this should not be called too often
+        :return: The number of live sessions and their average size in bytes
+        """
+
+        sizes = [session.memory_usage() for session in list(_Session.sessions.values())]
+        return {"live_sessions": len(sizes), "bytes_per_session": sum(sizes) / len(sizes) if sizes else 0}
+
+    @staticmethod
+    def _loggers() -> List[logging.Logger]:
+        """
+        :return: The logger of the framework and the ones of the API client, the storage backends and the ingest
         """
 
-        self._bot = telepot.aio.DelegatorBot(_config_value('bot', 'token'), [
-            telepot.aio.delegate.pave_event_space()(
-                telepot.aio.delegate.per_chat_id(types=["private"]),
-                telepot.aio.delegate.create_open,
-                _Session,
-                timeout=_config_value('bot', 'timeout', default=31536000)),
-        ])
+        return [logger] + [logging.getLogger(module) for module in (LowerBot.__module__, Storage.__module__,
+                                                                    Checkpoint.__module__)]
 
     @staticmethod
     def _configure_logger() -> None:
         """
-        Configures the default python logging module
+        Configures the default python logging module. Only the main process writes the log, so the log files are
+        rotated once
         """
 
         # Deactivate loggers of imported modules
@@ -168,30 +724,96 @@ class Bot:
                  "critical": logging.CRITICAL
                  }.get(_config_value('general', 'logging', default="error").lower(), logging.WARNING)
 
-        # Configure the logger
-        logger.setLevel(level)
+        # Configure the logger and the ones of the API client, the storage backends and the ingest
+        for framework_logger in Bot._loggers():
+            framework_logger.setLevel(level)
+
+        # Pool processes leave the records to python's default, workers hand them to the main process when started
+        if is_handler_process() or is_worker():
+            return
+
         shandler = logging.StreamHandler()
-        fhandler = logging.FileHandler(
-            f"{path.dirname(path.realpath(sys.argv[0]))}/{_config_value('general', 'logfile', default='Bot.log')}")
-        formatter = logging.Formatter("[%(asctime)s] %(message)s", "%x %X")
+        filename = f"{path.dirname(path.realpath(sys.argv[0]))}/{_config_value('general', 'logfile', default='Bot.log')}"
+
+        # Rotate the log file by its size or by time, if configured
+        rotation = _config_value('general', 'log_rotation')
+        backups = _config_value('general', 'log_backups', default=5)
+        if rotation == "size":
+            fhandler = RotatingFileHandler(filename, maxBytes=_config_value('general', 'log_max_bytes',
+                                                                            default=10 * 1024 * 1024),
+                                           backupCount=backups, encoding="utf-8")
+        elif rotation == "time":
+            fhandler = TimedRotatingFileHandler(filename, when=_config_value('general', 'log_rotation_when',
+                                                                             default="midnight"),
+                                                backupCount=backups, encoding="utf-8")
+        else:
+            fhandler = logging.FileHandler(filename, encoding="utf-8")
+
+        if _config_value('general', 'log_format', default="text") == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter("[%(asctime)s] %(message)s", "%x %X")
         shandler.setFormatter(formatter)
         fhandler.setFormatter(formatter)
-        logger.addHandler(shandler)
-        logger.addHandler(fhandler)
+
+        # The records are formatted and written by a background thread, so a slow disk does not delay the messages
+        qhandler = DroppingQueueHandler(_config_value('general', 'log_queue_size', default=10000))
+        listener = QueueListener(qhandler.queue, shandler, fhandler)
+        listener.start()
+        atexit.register(listener.stop)
+        for framework_logger in Bot._loggers():
+            framework_logger.addHandler(qhandler)
+        Bot._log_handler = qhandler
 
     @staticmethod
-    def _initialize_persistent_storage(*args):
+    def _initialize_persistent_storage(*args) -> Storage:
         """
-        Creates the default database
+        Creates the default database, which is either a TinyDB or SQLite database depending on the configuration
         :param args: The file name to be used
         :return: The database connection
         """
-        return TinyDB(args[0])
+
+        if _config_value('general', 'storage_backend', default="tinydb") == "sqlite":
+            return SQLiteStorage(args[0])
+        return TinyDBStorage(args[0])
+
+    async def schedule_storage_flush(self) -> None:
+        """
+        Writes the storages of all changed sessions in a fixed interval
+        """
+
+        interval = _config_value('general', 'storage_flush_interval', default=5)
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                with _metrics.time("storage_write"):
+                    await _Session.write_behind.flush()
+            except Exception as e:
+                logger.warning(f"The persistent storage could not be written and will be retried:\n\t{e!r}")
+            else:
+                logger.debug(f"Storage writes: {_Session.write_behind.performed} performed, "
+                             f"{_Session.write_behind.skipped} skipped as unchanged")
+
+    @staticmethod
+    async def _close_storage() -> None:
+        """
+        Writes all pending storages and closes the database
+        """
+
+        try:
+            await _Session.write_behind.flush()
+        except Exception as e:
+            logger.error(f"The persistent storage could not be written on shutdown:\n\t{e!r}")
+
+        if isinstance(_Session.database, Storage):
+            await _Session.database.close()
 
     @staticmethod
     def init_storage(func: Callable):
         """
-        Decorator to replace the default persistent storage
+        Decorator to replace the default persistent storage. The function may return a Storage or an open TinyDB
+        database, any other object needs the functions given by load_storage and update_storage to be used
         :param func: The function which initializes the storage
         :return: The unchanged function
         """
@@ -215,16 +837,28 @@ class Bot:
         :return: The unchanged function
         """
         _Session.update_user_data = func
+        _Session.batch_updates = False
 
     @staticmethod
-    def answer(message: str, mode: Mode = Mode.DEFAULT) -> Callable:
+    def answer(message: str, mode: Mode = Mode.DEFAULT, executor: str = None, timeout: float = None) -> Callable:
         """
         The wrapper for the inner decorator
         :param message: The message to react upon
         :param mode: The mode by which to interpret the given string
+        :param executor: How a synchronous handler is run, either "loop" to call it on the event loop, "thread" or
+            "process" to run it by a pool, so it does not block the other chats. Defaults to the configured executor.
+            Handlers run by processes have to be importable by their names and receive a copy of the storage,
+            generators and handlers wrapped by another decorator, like access_level, are run by threads instead.
+            Choosing "process" for a wrapped handler raises a ValueError
+        :param timeout: The seconds the handler, or each step of a generator, may take, before it is cancelled and the
+            error reply is sent. Defaults to the configured handler timeout. Synchronous handlers run on the event loop
+            cannot be interrupted and the ones run by a pool are only abandoned
         :return: The decorator itself
         """
 
+        if executor not in (None, LOOP, THREAD, PROCESS):
+            raise ValueError(f"Unknown executor {executor!r}, use one of {LOOP}, {THREAD} or {PROCESS}")
+
         def decorator(func: Callable) -> Callable:
             """
             Adds the given method to the known routes
@@ -232,6 +866,31 @@ class Bot:
             :return: The function unchanged
             """
 
+            # Label the function's measurements by its patterns
+            label = _Session.route_labels.get(func)
+            _Session.route_labels[func] = message if label is None else f"{label} | {message}"
+
+            # The wrappers of e.g. access_level are not importable by their names, so neither is the wrapped function
+            if executor == PROCESS and getattr(func, '__wrapped__', None) is not None:
+                raise ValueError(f"The handler of {message!r} is wrapped by another decorator and cannot be run by a "
+                                 f"process, use the executor {THREAD!r} instead")
+
+            # Remember the executor and the timeout by the function and the functions it wraps. Wrappers like the ones
+            # of access_level share their code, so only the innermost function's code is used, by which its
+            # generators are found
+            wrapped = func
+            while wrapped is not None:
+                innermost = getattr(wrapped, '__wrapped__', None) is None
+                if executor is not None:
+                    _Session.executors[wrapped] = executor
+                    if innermost:
+                        _Session.executors[wrapped.__code__] = executor
+                if timeout is not None:
+                    _Session.timeouts[wrapped] = timeout
+                    if innermost:
+                        _Session.timeouts[wrapped.__code__] = timeout
+                wrapped = getattr(wrapped, '__wrapped__', None)
+
             # Add the function keyed by the given message
             if mode == Mode.REGEX:
                 _Session.regex_routes[message] = func
@@ -291,6 +950,81 @@ class Bot:
                 # answer.language_feature = False
                 await answer._send(dummy)
 
+    async def broadcast(self, answer: "Answer", receivers: Union[Iterable, AsyncIterable],
+                        concurrency: int = None, progress: Callable = None,
+                        progress_interval: int = 100) -> BroadcastReport:
+        """
+        Sends the same answer to many users. The answer's message is rendered once per language and the receivers are
+        consumed lazily, so the memory used does not depend on their number
+        :param answer: The answer to be sent
+        :param receivers: The users to send the answer to, either as iterable or async iterable of user IDs or user
+            objects. The language of the user objects is respected, IDs receive the default language
+        :param concurrency: The maximal number of messages being sent at the same time
+        :param progress: A function to be called with the report every progress_interval receivers and at the end
+        :param progress_interval: The number of receivers between two calls of progress
+        :return: The report counting the sent messages and the failures by their reason
+        """
+
+        concurrency = concurrency or _config_value('bot', 'broadcast_concurrency', default=30)
+        report = BroadcastReport()
+        localized: Dict[str, Answer] = dict()
+
+        # The receivers are handed to the senders by a bounded queue, ending with a stop mark for each sender
+        queue = asyncio.Queue(maxsize=concurrency)
+        stop = object()
+
+        async def report_progress():
+            if progress is None:
+                return
+            if iscoroutinefunction(progress):
+                await progress(report)
+            else:
+                progress(report)
+
+        async def produce():
+            try:
+                if hasattr(receivers, '__aiter__'):
+                    async for receiver in receivers:
+                        await queue.put(receiver)
+                else:
+                    for receiver in receivers:
+                        await queue.put(receiver)
+            finally:
+                for _ in range(concurrency):
+                    await queue.put(stop)
+
+        async def send():
+            while True:
+                receiver = await queue.get()
+                if receiver is stop:
+                    return
+
+                # Render the message once per language
+                lang_code = receiver.language_code if isinstance(receiver, User) else "default"
+                if lang_code not in localized:
+                    localized[lang_code] = answer._localized(lang_code)
+
+                try:
+                    await localized[lang_code]._send_to(receiver.id if isinstance(receiver, User) else receiver,
+                                                        self._bot)
+                except TelegramError as e:
+                    report.add_failure(e)
+                    logger.debug("Broadcast to %s failed: %s", receiver, e.description)
+                except Exception as e:
+                    report.add_failure(e)
+                    logger.debug("Broadcast to %s failed: %r", receiver, e)
+                else:
+                    report.sent += 1
+
+                if report.total % progress_interval == 0:
+                    await report_progress()
+
+        await asyncio.gather(produce(), *(send() for _ in range(concurrency)))
+        await report_progress()
+
+        logger.info(f"Broadcast finished: {report}")
+        return report
+
     def on_startup(self, func: types.CoroutineType):
         """
         A decorator for a function to be awaited on the program's startup
@@ -321,21 +1055,13 @@ class Bot:
     @staticmethod
     def _on_message_overflow(answer):
         """
-
+        Converts a too long message into a text document, which is uploaded from memory
         :param answer: The answer which exceeded the maximal length
-        :return: A tuple with a new message, media type, and media
+        :return: A tuple with a new message, media type, and media, which is either a path or a tuple of a file name
+            and the file's content
         """
 
-        with open("Temp" + str(hash(answer)) + ".txt", "w") as f:
-            f.write(answer.msg + "\n")
-
-        # Schedule removal of the temp file after 5 seconds
-        if platform.system() == "Windows":
-            system('start /B cmd /C "sleep 5 && del Temp' + str(hash(answer)) + '.txt"')
-        else:
-            system('bash -c "sleep 5; rm Temp' + str(hash(answer)) + '.txt" &')
-
-        return "", Media.DOCUMENT, "Temp" + str(hash(answer)) + ".txt"
+        return "", Media.DOCUMENT, ("message.txt", (answer.msg + "\n").encode("utf-8"))
 
     @staticmethod
     def signal_handler(sig, frame):
@@ -343,6 +1069,11 @@ class Bot:
         A signal handler to catch a termination via CTR-C
         """
 
+        # A running loop is stopped, listen will then shut down the bot
+        if loop is not None and loop.is_running():
+            loop.call_soon_threadsafe(loop.stop)
+            return
+
         Bot._on_termination()
         logger.info("Bot shuts down")
         quit(0)
@@ -401,21 +1132,19 @@ class Bot:
                     if self.access_checker.get(level, lambda: False)():
 
                         # If one level evaluated to True, call the function as usual
-                        if iscoroutinefunction(func):
-                            return await func(**kwargs)
-                        else:
-                            return func(**kwargs)
+                        return await _Session.call_handler(func, **kwargs)
 
                 # If no level evaluated to True, return nothing
                 return None
 
+            inner.__wrapped__ = func
             return inner
 
         return decorator
 
     def ensure_parameter(self, name: str, phrase: str, choices: Collection[str] = None):
         """
-        The wrapper for the inner decorator
+        The wrapper for the inner decorator. The question is a conversation, so it is stored with the user's storage
         :param name: The name of the parameter to provide
         :param phrase: The phrase to use when asking the user for the parameter
         :param choices: The choices to show the user as callback
@@ -429,24 +1158,37 @@ class Bot:
             :return: The decorated function
             """
 
+            # The conversation is named by the innermost function, which stays the same across restarts
+            wrapped = func
+            while getattr(wrapped, '__wrapped__', None) is not None:
+                wrapped = wrapped.__wrapped__
+            key = f"ensure_parameter:{wrapped.__module__}.{wrapped.__qualname__}:{name}"
+            conversation = Conversation.registry.get(key) or Conversation(key)
+
+            @conversation.step("value")
+            async def receive(text: str, data: Dict) -> Transition:
+                """
+                Calls the function with the provided parameter
+                :return: The end of the conversation with the message handler's usual output
+                """
+
+                data[name] = text
+                return conversation.end(await _Session.call_handler(func, **data))
+
             async def inner(**kwargs):
                 """
                 Checks if the requested parameter exists and aks the user to provide it, if it misses
                 :return: The message handler's usual output
                 """
 
-                # Check if the parameter exists
+                # Check if the parameter exists and ask the user for it, if not
                 if name not in kwargs:
-                    # If not, ask the user for it
-                    temp = (yield Answer(phrase, choices=choices))
-                    kwargs[name] = temp
+                    return conversation.start("value", Answer(phrase, choices=choices), **kwargs)
 
-                # If one level evaluated to True, call the function as usual
-                if iscoroutinefunction(func):
-                    yield await func(**kwargs)
-                else:
-                    yield func(**kwargs)
+                # If the parameter exists, call the function as usual
+                return await _Session.call_handler(func, **kwargs)
 
+            inner.__wrapped__ = func
             return inner
 
         return decorator
@@ -470,13 +1212,31 @@ class Answer(object):
         'document': Media.DOCUMENT,
     }
 
+    # The methods to send media files and their relevant kwargs
+    media_methods = {
+        Media.VOICE: ("send_voice", ("caption", "parse_mode", "duration", "disable_notification",
+                                     "reply_to_message_id", "reply_markup")),
+        Media.AUDIO: ("send_audio", ("caption", "parse_mode", "duration", "performer", "title",
+                                     "disable_notification", "reply_to_message_id", "reply_markup")),
+        Media.PHOTO: ("send_photo", ("caption", "parse_mode", "disable_notification", "reply_to_message_id",
+                                     "reply_markup")),
+        Media.VIDEO: ("send_video", ("duration", "width", "height", "caption", "parse_mode", "supports_streaming",
+                                     "disable_notification", "reply_to_message_id", "reply_markup")),
+        Media.DOCUMENT: ("send_document", ("caption", "parse_mode", "disable_notification", "reply_to_message_id",
+                                           "reply_markup")),
+    }
+
+    # The scheduler pacing the sent messages and the file IDs of uploaded files, set up by the bot if enabled
+    scheduler: Optional[SendScheduler] = None
+    media_cache: Optional[MediaCache] = None
+
     def __init__(self, msg: str = None,
                  *format_content: Any,
-                 choices: Collection = None,
+                 choices: Union[Collection, "Keyboard"] = None,
                  callback: Callable = None,
-                 keyboard: Collection = None,
+                 keyboard: Union[Collection, "Keyboard"] = None,
                  media_type: Media = None,
-                 media: str = None,
+                 media: Union[str, bytes, memoryview, BinaryIO, AsyncIterable[bytes], Tuple[str, Any]] = None,
                  caption: str = None,
                  receiver: Union[str, int, User] = None,
                  edit_id: int = None):
@@ -485,14 +1245,18 @@ class Answer(object):
         :param msg: The message to be sent, this can be a language key or a command for a media type
         :param format_content: If the message is a language key, the format arguments might be supplied here
         :param choices: The choices to be presented the user as a query, either as Collection of strings, which will
-            automatically be aligned or as a Collection of Collection of strings to control the alignment. This argument
-            being not None is the indicator of being a query
+            automatically be aligned or as a Collection of Collection of strings to control the alignment or as an
+            inline Keyboard. This argument being not None is the indicator of being a query
         :param callback: The function to be called with the next incoming message by this user. The message will be
             propagated as parameter.
         :param keyboard: A keyboard to be sent, either as Collection of strings, which will
-            automatically be aligned or as a Collection of Collection of strings to control the alignment.
+            automatically be aligned or as a Collection of Collection of strings to control the alignment or as a
+            Keyboard.
         :param media_type: The media type of this answer. Can be used instead of the media commands.
-        :param media: The path to the media to be sent. Can be used instead of the media commands.
+        :param media: The media to be sent, either as path, as bytes or memoryview, as file-like object, as async
+            iterator of bytes or as tuple of a file name and one of these contents. Can be used instead of the media
+            commands. Streams are read in chunks without blocking, but only once, so the answer reuses the uploaded
+            file when sent again.
         :param caption: The caption to be sent. Can be used instead of the media commands.
         :param receiver: The user ID or a user object of the user who should receiver this answer. Will default to the
             user who sent the triggering message.
@@ -510,6 +1274,9 @@ class Answer(object):
         self.caption = caption
         self.edit_id = edit_id
 
+        # The upload of the media, if they are not given as path, shared by the copies of this answer
+        self._upload_state = Upload()
+
     async def _send(self, session) -> Dict:
         """
         Sends this instance of answer to the user
@@ -527,123 +1294,213 @@ class Answer(object):
             if isinstance(ID, User):
                 ID = ID.id
 
-        sender = session.bot
+        return await self._send_to(ID, session.bot)
+
+    async def _send_to(self, ID: Union[str, int], sender: LowerBot) -> Dict:
+        """
+        Sends this instance of answer to the given recipient
+        :param ID: The recipient's id
+        :param sender: The bot to send with
+        :return : The send message as dictionary
+        """
+
         msg = self.msg
-        kwargs = self._get_config()
 
-        # Catch a to long message text
-        if self.media_type == Media.TEXT and len(msg) > 4096:
+        # Catch a to long message text before it is scheduled, so the parts of a split message keep their order
+        if self.media_type == Media.TEXT and self.edit_id is None and len(msg) > MAX_MESSAGE_LENGTH:
+            if self.overflow_mode == "split":
+                return await self._send_parts(ID, sender, msg)
             msg, self.media_type, self.media = Bot._on_message_overflow(self)
 
+        # Pace the request to stay within the rate limits
+        if self.scheduler is not None:
+            return await self.scheduler.send(ID, self._request, ID, sender, msg)
+        return await self._request(ID, sender, msg)
+
+    async def _send_parts(self, ID: Union[str, int], sender: LowerBot, msg: str) -> Dict:
+        """
+        Sends a too long text as several messages in their order. Only the first one replies to the user's message
+        and only the last one carries the keyboard
+        :param ID: The recipient's id
+        :param sender: The bot to send with
+        :param msg: The text to send
+        :return : The last sent message as dictionary
+        """
+
+        parts = list(split_message(msg, MAX_MESSAGE_LENGTH))
+        sent = None
+
+        for index, text in enumerate(parts):
+            part = copy.copy(self)
+            part._msg = text
+            part.format_content = ()
+            part.language_feature = False
+            part.media_type = Media.TEXT
+            part.mark_as_answer = self.mark_as_answer and index == 0
+            if index < len(parts) - 1:
+                part.choices = None
+                part.keyboard = None
+
+            sent = await part._send_to(ID, sender)
+
+        # The prepared keyboards are needed to process the user's choice
+        self.choices = part.choices
+        self.keyboard = part.keyboard
+        return sent
+
+    async def _request(self, ID: Union[str, int], sender: LowerBot, msg: str) -> Dict:
+        """
+        Performs the request to send this answer and measures its duration
+        :param ID: The recipient's id
+        :param sender: The bot to send with
+        :param msg: The rendered message
+        :return : The send message as dictionary
+        """
+
+        with _metrics.time("telegram", media=self.media_type.name.lower() if self.edit_id is None else "edit"):
+            return await self._deliver(ID, sender, msg)
+
+    async def _deliver(self, ID: Union[str, int], sender: LowerBot, msg: str) -> Dict:
+        """
+        Performs the request to send this answer
+        :param ID: The recipient's id
+        :param sender: The bot to send with
+        :param msg: The rendered message
+        :return : The send message as dictionary
+        """
+
+        kwargs = self._get_config()
+
         # Check for a request for editing
         if self.edit_id is not None:
-            return await sender.editMessageText((ID, self.edit_id), msg,
-                                                **{key: kwargs[key] for key in kwargs if key in ("parse_mode",
-                                                                                                 "disable_web_page_preview",
-                                                                                                 "reply_markup")}
-                                                )
+            return await sender.edit_message_text(ID, self.edit_id, msg,
+                                                  **{key: kwargs[key] for key in kwargs if key in ("parse_mode",
+                                                                                                   "disable_web_page_preview",
+                                                                                                   "reply_markup")}
+                                                  )
 
         # Call the correct method for sending the desired media type and filter the relevant kwargs
         if self.media_type == Media.TEXT:
-            return await sender.sendMessage(ID, msg,
-                                            **{key: kwargs[key] for key in kwargs if key in ("parse_mode",
-                                                                                             "disable_web_page_preview",
-                                                                                             "disable_notification",
-                                                                                             "reply_to_message_id",
-                                                                                             "reply_markup")})
-
-        elif self.media_type == Media.STICKER:
-            return await sender.sendSticker(ID, self.media,
-                                            **{key: kwargs[key] for key in kwargs if key in ('disable_notification',
-                                                                                             'reply_to_message_id',
-                                                                                             'reply_markup')})
-
-        elif self.media_type == Media.VOICE:
-            return await sender.sendVoice(ID, open(self.media, "rb"),
-                                          **{key: kwargs[key] for key in kwargs if key in ("caption",
-                                                                                           "parse_mode",
-                                                                                           "duration",
-                                                                                           "disable_notification",
-                                                                                           "reply_to_message_id",
-                                                                                           "reply_markup")})
-
-        elif self.media_type == Media.AUDIO:
-            return await sender.sendAudio(ID, open(self.media, "rb"),
-                                          **{key: kwargs[key] for key in kwargs if key in ("caption",
-                                                                                           "parse_mode",
-                                                                                           "duration",
-                                                                                           "performer",
-                                                                                           "title",
-                                                                                           "disable_notification",
-                                                                                           "reply_to_message_id",
-                                                                                           "reply_markup")})
-
-        elif self.media_type == Media.PHOTO:
-            return await sender.sendPhoto(ID, open(self.media, "rb"),
-                                          **{key: kwargs[key] for key in kwargs if key in ("caption",
-                                                                                           "parse_mode",
-                                                                                           "disable_notification",
-                                                                                           "reply_to_message_id",
-                                                                                           "reply_markup")})
-
-        elif self.media_type == Media.VIDEO:
-            return await sender.sendVideo(ID, open(self.media, "rb"),
-                                          **{key: kwargs[key] for key in kwargs if key in ("duration",
-                                                                                           "width",
-                                                                                           "height",
-                                                                                           "caption",
-                                                                                           "parse_mode",
-                                                                                           "supports_streaming",
-                                                                                           "disable_notification",
-                                                                                           "reply_to_message_id",
-                                                                                           "reply_markup")})
-
-        elif self.media_type == Media.DOCUMENT:
-            return await sender.sendDocument(ID, open(self.media, "rb"),
-                                             **{key: kwargs[key] for key in kwargs if key in ("caption",
-                                                                                              "parse_mode",
+            return await sender.send_message(ID, msg,
+                                             **{key: kwargs[key] for key in kwargs if key in ("parse_mode",
+                                                                                              "disable_web_page_preview",
                                                                                               "disable_notification",
                                                                                               "reply_to_message_id",
                                                                                               "reply_markup")})
 
-    def _apply_language(self) -> str:
+        elif self.media_type == Media.STICKER:
+            return await sender.send_sticker(ID, self.media,
+                                             **{key: kwargs[key] for key in kwargs if key in ('disable_notification',
+                                                                                              'reply_to_message_id',
+                                                                                              'reply_markup')})
+
+        # Media files are sent by the file ID of a previous upload, if possible
+        method, keys = self.media_methods[self.media_type]
+        method = getattr(sender, method)
+        kwargs = {key: kwargs[key] for key in kwargs if key in keys}
+
+        # Media which are not files are uploaded once per answer
+        if not isinstance(self.media, str):
+            return await self._upload(ID, method, kwargs)
+
+        # The cache looks at the file on disk, so it is asked by a thread like the file is read
+        loop = asyncio.get_event_loop()
+        file_id = await loop.run_in_executor(None, self.media_cache.get, self.media_type, self.media) \
+            if self.media_cache is not None else None
+        if file_id is not None:
+            try:
+                return await method(ID, file_id, **kwargs)
+            except BadRequest:
+                # The file ID may have become invalid, so upload the file again. Other errors, like the flood control,
+                # are left to the scheduler, which sends the file ID again
+                await loop.run_in_executor(None, self.media_cache.discard, self.media_type, self.media)
+
+        # The file is opened and read by threads, the upload streams it in chunks
+        f = await loop.run_in_executor(None, open, self.media, "rb")
+        try:
+            sent = await method(ID, f, **kwargs)
+        finally:
+            f.close()
+
+        if self.media_cache is not None:
+            await loop.run_in_executor(None, self.media_cache.put, self.media_type, self.media, sent)
+
+        return sent
+
+    async def _upload(self, ID: Union[str, int], method: Callable, kwargs: Dict) -> Dict:
+        """
+        Uploads media given as content instead of a path. Streams and iterators can only be read once, so further
+        recipients of this answer and its copies, e.g. of a broadcast, receive the file by the ID telegram assigned to
+        the upload. An upload which failed, e.g. by the flood control, sends the chunks spooled so far again
+        :param ID: The recipient's id
+        :param method: The bot's method sending the media type
+        :param kwargs: The arguments to pass
+        :return : The send message as dictionary
+        """
+
+        upload = self._upload_state
+        if upload.file_id is None:
+            if upload.lock is None:
+                upload.lock = asyncio.Lock()
+
+            # Concurrent sends wait for the first upload
+            async with upload.lock:
+                if upload.file_id is None:
+                    filename, content = self.media if isinstance(self.media, tuple) else \
+                        (self.media_type.name.lower(), self.media)
+
+                    # File-like objects are read by a thread, so the event loop is not blocked
+                    sent = await method(ID, (filename, await upload.content(content)), **kwargs)
+                    upload.done(file_id_of(self.media_type, sent))
+                    return sent
+
+        return await method(ID, upload.file_id, **kwargs)
+
+    def _apply_language(self, lang_code: str = None) -> str:
         """
         Uses the given key and formatting addition to answer the user the appropriate language
+        :param lang_code: The language to use, defaults to the one of the current user
         :return The formatted text
         """
 
         # The language code should be something like de, but could be also like de_DE or non-existent
-        usr = _context.get('user')
-        lang_code = usr.language_code.split('_')[0].lower() if usr is not None else "en"
+        # The catalog falls back to the more general sections and finally to default
+        if lang_code is None:
+            usr = _context.get('user')
+            lang_code = usr.language_code if usr is not None else "en"
 
-        try:
-            # Try to load the string with the given language code
-            answer: str = _Session.language[lang_code][self._msg]
+        # Load and format the string with the given language code
+        with _metrics.time("language"):
+            answer = _Session.language.render(lang_code, self._msg, self.format_content)
 
-        except KeyError:
+        if answer is None:
 
-            # Try to load the answer string in the default segment
-            try:
-                answer: str = _Session.language['default'][self._msg]
+            # In strict mode, raise an error, which will terminate the application
+            if self.strict_mode:
+                logger.critical('Language key "{}" not found!'.format(self._msg))
+                raise KeyError(self._msg)
 
-            # Catch the key error which might be thrown
-            except KeyError as e:
+            # In non-strict mode just send the user the key as answer
+            else:
+                return self._msg
 
-                # In strict mode, raise the error again, which will terminate the application
-                if self.strict_mode:
-                    logger.critical('Language key "{}" not found!'.format(self._msg))
-                    raise e
+        return answer
 
-                # In non-strict mode just send the user the key as answer
-                else:
-                    return self._msg
+    def _localized(self, lang_code: str = None) -> "Answer":
+        """
+        Creates a copy of this answer whose message is already rendered, so it can be sent to many users
+        :param lang_code: The language to render the message in
+        :return: The rendered copy
+        """
 
-        # Apply formatting
-        if self.format_content is not None and len(self.format_content) > 0:
-            answer = answer.format(*self.format_content)
+        localized = copy.copy(self)
+        if self.language_feature and self._msg is not None:
+            localized._msg = self._apply_language(lang_code)
+        localized.format_content = ()
+        localized.language_feature = False
+        localized.mark_as_answer = False
 
-        # Write back
-        return answer
+        return localized
 
     def is_query(self) -> bool:
         """
@@ -694,64 +1551,20 @@ class Answer(object):
 
         if self.choices is not None:
 
-            # In the case of 1-dimensional array
-            # align the options in pairs of 2
-            if isinstance(self.choices[0], (str, tuple)):
-                self.choices = [[y for y in self.choices[x * 2:(x + 1) * 2]] for x in
-                                range(int(math.ceil(len(self.choices) / 2)))]
-
-            # Prepare button array
-            buttons = []
-
-            # Loop over all rows
-            for row in self.choices:
-                r = []
-                # Loop over each entry
-                for text in row:
-                    # Append the text as a new button
-                    if isinstance(text, str):
-                        r.append(InlineKeyboardButton(
-                            text=text, callback_data=text))
-                    else:
-                        r.append(InlineKeyboardButton(
-                            text=text[0], callback_data=text[1]))
-
-                # Append the button row to the list
-                buttons.append(r)
-
-            # Assemble keyboard
-            keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+            # Use the prebuilt keyboard for this layout
+            # The aligned layout is kept, as it is needed to process the user's choice
+            self.choices = Keyboard.of(self.choices, inline=True)
+            keyboard = self.choices.markup
 
         elif self.keyboard is not None:
 
             # For anything except a collection, any previous sent keyboard is deleted
-            if not isinstance(self.keyboard, collections.Iterable):
-                keyboard = ReplyKeyboardRemove()
+            if not isinstance(self.keyboard, collections.abc.Iterable):
+                keyboard = Keyboard.REMOVE
 
             else:
-
-                # In the case of 1-dimensional array
-                # align the options in pairs of 2
-                if isinstance(self.keyboard[0], str):
-                    self.keyboard = [[y for y in self.keyboard[x * 2:(x + 1) * 2]] for x in
-                                     range(int(math.ceil(len(self.keyboard) / 2)))]
-
-                # Prepare button array
-                buttons = []
-
-                # Loop over all rows
-                for row in self.keyboard:
-                    r = []
-                    # Loop over each entry
-                    for text in row:
-                        # Append the text as a new button
-                        r.append(KeyboardButton(
-                            text=text))
-                    # Append the button row to the list
-                    buttons.append(r)
-
-                # Assemble keyboard
-                keyboard = ReplyKeyboardMarkup(keyboard=buttons, one_time_keyboard=True)
+                self.keyboard = Keyboard.of(self.keyboard)
+                keyboard = self.keyboard.markup
         else:
             keyboard = None
 
@@ -765,55 +1578,190 @@ class Answer(object):
             'caption': self.caption
         }
 
+    @classmethod
+    def _apply_settings(cls) -> None:
+        """
+        Load the default values which may change with a reload of the configuration
+        """
+
+        cls.mark_as_answer = _settings.mark_as_answer
+        cls.markup = _settings.markup
+        cls.language_feature = _settings.language_feature
+        cls.strict_mode = _settings.strict_mode
+        cls.disable_web_preview = _settings.disable_web_preview
+        cls.disable_notification = _settings.disable_notification
+        cls.overflow_mode = _settings.overflow_mode
+
     @classmethod
     def _load_defaults(cls) -> None:
         """
         Load default values from config
         """
 
-        cls.mark_as_answer = _config_value('bot', 'mark_as_answer', default=False)
-        cls.markup = _config_value('bot', 'markup', default=None)
-        cls.language_feature = _config_value('bot', 'language_feature', default=False)
-        cls.strict_mode = _config_value('bot', 'strict_mode', default=False)
-        cls.disable_web_preview = _config_value('bot', 'disable_web_preview', default=False)
-        cls.disable_notification = _config_value('bot', 'disable_notification', default=False)
+        cls._apply_settings()
+
+        # Limit the rate of sent messages as demanded by telegram
+        if _config_value('bot', 'rate_limit', default=True):
+            cls.scheduler = SendScheduler(global_rate=_config_value('bot', 'global_rate', default=30),
+                                          chat_rate=_config_value('bot', 'chat_rate', default=1),
+                                          chat_burst=_config_value('bot', 'chat_burst', default=3),
+                                          max_retries=_config_value('bot', 'send_retries', default=3))
+        else:
+            cls.scheduler = None
+
+        # Remember the file IDs of uploaded files across restarts
+        if _config_value('bot', 'media_cache', default=True):
+            cls.media_cache = MediaCache(f"{path.dirname(path.realpath(sys.argv[0]))}/"
+                                         f"{_config_value('bot', 'media_cache_file', default='media_cache.json')}")
+        else:
+            cls.media_cache = None
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    Converts nested lists and tuples into nested tuples to be used as dictionary key. Their type is kept, as a tuple
+    of an inline keyboard may be a single button with its callback data, while a list is a row of buttons
+    :param value: The value to convert
+    :return: The hashable version of the value
+    """
 
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_freeze(entry) for entry in value)
+    return value
 
-class _Session(telepot.aio.helper.UserHandler):
+
+class Keyboard(object):
+    """
+    A keyboard, either inline below the message or as custom keyboard, whose markup is built and serialized only once.
+    It may be created once and reused by any number of answers
     """
-    The underlying framework telepot spawns an instance of this class for every conversation its encounters.
+
+    # The serialized markup to remove a custom keyboard
+    REMOVE = json.dumps({'remove_keyboard': True}, separators=(',', ':'))
+
+    # The keyboards built from plain layouts, keyed by their layout
+    cache = LRUCache(256)
+
+    def __init__(self, buttons: Collection, inline: bool = False):
+        """
+        Builds and serializes the keyboard
+        :param buttons: The buttons, either as Collection of strings, which will automatically be aligned in pairs of
+            2 or as a Collection of Collection of strings to control the alignment. The buttons of inline keyboards may
+            also be tuples of the text and the callback data
+        :param inline: If the keyboard is shown below the message as query
+        """
+
+        self.inline = inline
+
+        # In the case of 1-dimensional array
+        # align the options in pairs of 2
+        if isinstance(buttons[0], (str, tuple) if inline else str):
+            buttons = [[y for y in buttons[x * 2:(x + 1) * 2]] for x in range(int(math.ceil(len(buttons) / 2)))]
+
+        self.layout = buttons
+
+        # Assemble the keyboard
+        if inline:
+            markup = {'inline_keyboard': [[{'text': text, 'callback_data': text} if isinstance(text, str) else
+                                           {'text': text[0], 'callback_data': text[1]} for text in row]
+                                          for row in buttons]}
+        else:
+            markup = {'keyboard': [[{'text': text} for text in row] for row in buttons], 'one_time_keyboard': True}
+
+        self.markup = json.dumps(markup, separators=(',', ':'))
+
+    @classmethod
+    def of(cls, buttons: Union["Keyboard", Collection], inline: bool = False) -> "Keyboard":
+        """
+        Gets the keyboard for the given layout, building it only if it is not cached yet
+        :param buttons: Either a keyboard, which is returned unchanged, or the buttons as given to the constructor
+        :param inline: If the keyboard is shown below the message as query
+        :return: The keyboard
+        """
+
+        if isinstance(buttons, Keyboard):
+            return buttons
+
+        try:
+            key = (inline, _freeze(buttons))
+            keyboard = cls.cache.get(key)
+        except TypeError:
+            return cls(buttons, inline)
+
+        if keyboard is None:
+            keyboard = cls(buttons, inline)
+            cls.cache[key] = keyboard
+
+        return keyboard
+
+    def __getitem__(self, item):
+        return self.layout[item]
+
+    def __iter__(self):
+        return iter(self.layout)
+
+    def __len__(self):
+        return len(self.layout)
+
+
+class _Session(object):
+    """
+    A session is created for every private chat the bot encounters.
     It will be responsible for directing the bot's reactions
     """
 
+    # The client used to answer
+    bot: LowerBot = None
+
     # The routing dictionaries
     simple_routes: Dict[str, Callable] = dict()
     parse_routes: ParsingDict = ParsingDict()
     regex_routes: RegExDict = RegExDict()
 
     # Language files
-    language = None
+    language: LanguageCatalog = None
 
-    def __init__(self, *args, **kwargs):
-        """
-        Initialize the session, called by the underlying framework telepot
-        :param args: Used by telepot
-        :param kwargs: Used by telepot
-        """
+    # The persistent storage and the queue of changed sessions to be written
+    database = None
+    write_behind: WriteBehind = None
 
-        # Call superclasses superclass, allowing callback queries to be processed
-        super(_Session, self).__init__(include_callback_query=True, *args, **kwargs)
+    # If the storages are written in batches by the storage backend
+    batch_updates = True
 
-        # Extract the user of the default arguments
-        self.user = User(args[0][1]['from'])
+    # The live sessions by their user, the least recently used first
+    sessions: "OrderedDict[int, _Session]" = OrderedDict()
+    max_sessions: Optional[int] = None
 
-        # Create dictionary to use as persistent storage
-        # Load data from persistent storage
-        if _Session.database is not None:
+    # The seconds after which an idle session is closed
+    timeout: float = 31536000
 
-            self.storage = _Session.load_user_data(self.user_id)
+    # The limit of chats processed at once and the number of chats being processed
+    concurrency: Optional[asyncio.Semaphore] = None
+    active: int = 0
 
-        else:
-            self.storage = dict()
+    # The executors chosen for handlers, keyed by the handler and by the code of its generators, and the pools
+    # running them
+    executors: Dict[Union[Callable, types.CodeType], str] = dict()
+
+    # The seconds a handler may take, keyed by the handler and by the code of its generators
+    timeouts: Dict[Union[Callable, types.CodeType], float] = dict()
+
+    # The patterns of the handlers to label their measurements by, keyed by the handlers, as wrappers share their code
+    route_labels: Dict[Callable, str] = dict()
+    handler_pool: HandlerPool = None
+
+    def __init__(self, user: dict):
+        """
+        Initialize the session
+        :param user: The user as received with their first message
+        """
+
+        self.user_id = user['id']
+        self.user = User(user)
+
+        # Create dictionary to use as persistent storage
+        # With a persistent storage, it is loaded asynchronously on the first message
+        self.storage = None if _Session.database is not None else dict()
 
         self.callback = None
         self.query_callback = {}
@@ -822,38 +1770,288 @@ class _Session(telepot.aio.helper.UserHandler):
         self.gen = None
         self.gen_is_async = None
 
+        # The updates waiting to be processed in their order and the time of the last one
+        self.mailbox = deque()
+        self.processing = False
+        self.closed = False
+        self.last_active = time.monotonic()
+
         # Prepare dequeue to store sent messages' IDs
-        _context.set("history", deque(maxlen=_config_value("bot", "max_history_entries", default=10)))
+        self.history = deque(maxlen=_settings.max_history_entries)
+
+        # The context is kept between the messages, e.g. the initial message of a generator
+        self.context = {"history": self.history}
+
+        # Evict the least recently used idle sessions, if there are too many, and register the session
+        if _Session.max_sessions is not None and len(_Session.sessions) >= _Session.max_sessions:
+            _Session.evict_idle(len(_Session.sessions) - _Session.max_sessions + 1)
+        _Session.sessions[self.user_id] = self
+
+        logger.info("User %s connected", self.user)
+
+    @staticmethod
+    def dispatch(update: dict, done: Callable[[], None] = None) -> None:
+        """
+        Hands an update to the session of its chat, which is created for the first message of a private chat.
+        Callback queries are only processed by a live session, as they refer to its sent messages, unless the
+        storage is persistent and may hold the conversation they belong to
+        :param update: The update as received from telegram
+        :param done: Called once the update is processed or discarded
+        """
+
+        if 'callback_query' in update:
+            query = update['callback_query']
+            chat_id = query['message']['chat']['id'] if 'message' in query else query['from']['id']
+            session = _Session.sessions.get(chat_id)
+            if (session is None or session.closed) and _Session.database is not None and chat_id == query['from']['id']:
+                session = _Session.replace(session, query['from'])
+            if session is not None and not session.closed:
+                session.post(session.on_callback_query, query, done)
+            elif done is not None:
+                done()
+            return
 
-        logger.info(
-            "User {} connected".format(self.user))
+        msg = update.get('message') or update.get('edited_message')
+        if msg is None or msg['chat']['type'] != "private" or 'from' not in msg:
+            if done is not None:
+                done()
+            return
+
+        session = _Session.sessions.get(msg['chat']['id'])
+        if session is None or session.closed:
+            session = _Session.replace(session, msg['from'])
+
+        session.post(session.on_chat_message, msg, done)
 
     @staticmethod
-    def load_user_data(user):
+    def replace(previous: Optional["_Session"], user: dict) -> "_Session":
+        """
+        Creates the session of a user, who has no live session
+        :param previous: The closing session of the user, if any
+        :param user: The user as received with the update
+        :return: The new session
+        """
+
+        session = _Session(user)
+
+        # A closing session hands its storage over, so no change is lost before it is written
+        if previous is not None and _Session.database is not None:
+            session.storage = previous.storage
+
+        return session
+
+    def post(self, handler: Callable, payload: Any, done: Callable[[], None] = None) -> None:
+        """
+        Adds an update to the mailbox. The updates of a session are processed one after another, the sessions
+        concurrently
+        :param handler: The coroutine function processing the update
+        :param payload: The value to pass to it
+        :param done: Called once the update is processed
         """
 
-        :param user:
-        :return:
+        self.mailbox.append((handler, payload, done))
+        if not self.processing:
+            self.processing = True
+            asyncio.ensure_future(self._process())
+
+    async def _process(self) -> None:
+        """
+        Processes the updates in the mailbox until it is empty. Each update waits for a free slot of the global
+        concurrency limit, so a chat holds none while it is idle
         """
 
-        storage = _Session.database.search(Query().user == user)
+        # The task uses the session's context instead of a copy, so it lasts from one task to the next
+        asyncio.current_task().context = self.context
 
-        if len(storage) == 0:
-            _Session.database.insert({"user": user, "storage": {}})
-            return dict()
-        else:
-            return storage[0]["storage"]
+        try:
+            while self.mailbox:
+                handler, payload, done = self.mailbox.popleft()
+                try:
+                    if _Session.concurrency is None:
+                        await self._run(handler, payload)
+                    else:
+                        async with _Session.concurrency:
+                            await self._run(handler, payload)
+                except Exception as e:
+                    logger.error("An update by %s could not be processed%s", self.user,
+                                 Lazy(self._describe_error, e, "\n\tError message: {}\n\tFile: {}\n\tFunc: {}"
+                                                               "\n\tLiNo: {}\n\tLine: {}"))
+                finally:
+
+                    # Count the update as skipped write, if it left the storage unchanged. Only updates come with a
+                    # function to call once they are processed
+                    if done is not None:
+                        if _Session.write_behind is not None:
+                            _Session.write_behind.count_update(self.user_id)
+                        done()
+        finally:
+            self.processing = False
 
     @staticmethod
-    def update_user_data(user, storage):
+    async def _run(handler: Callable, payload: Any) -> None:
+        """
+        Processes a single update and counts it as active meanwhile
+        :param handler: The coroutine function processing the update
+        :param payload: The value to pass to it
         """
 
-        :param user:
-        :param storage:
-        :return:
+        _Session.active += 1
+        try:
+            await handler(payload)
+        finally:
+            _Session.active -= 1
+
+    def close(self, timeout: float) -> None:
+        """
+        Closes the session after the updates already received are processed
+        :param timeout: The exceeded timeout
+        """
+
+        if not self.closed:
+            self.closed = True
+            self.post(self.on_close, timeout)
+
+    @staticmethod
+    async def expire(timeout: float) -> None:
+        """
+        Closes the sessions which were idle for the given time, forever
+        :param timeout: The seconds of inactivity after which a session is closed
         """
 
-        _Session.database.update({"storage": storage}, Query().user == user)
+        while True:
+            await asyncio.sleep(max(1.0, min(timeout / 10, 60.0)))
+
+            # The sessions are ordered by their last use, so only the oldest have to be looked at. Sessions still
+            # processing an update are closed once they are idle
+            deadline = time.monotonic() - timeout
+            for session in list(itertools.takewhile(lambda session: session.last_active < deadline,
+                                                    _Session.sessions.values())):
+                if session.is_idle():
+                    session.close(timeout)
+
+    def is_idle(self) -> bool:
+        """
+        Tests, if the session neither processes an update nor has any waiting, so it can be closed at once
+        :return: If the session is idle
+        """
+
+        return not self.processing and not self.mailbox and not self.closed
+
+    @staticmethod
+    def evict_idle(count: int) -> None:
+        """
+        Evicts the least recently used idle sessions. Sessions processing updates are kept, so a new session of their
+        user never starts while they are still busy. The limit may be exceeded meanwhile
+        :param count: The number of sessions to evict
+        """
+
+        for session in list(itertools.islice((session for session in _Session.sessions.values()
+                                              if session.is_idle()), count)):
+            session.evict()
+
+    def evict(self) -> None:
+        """
+        Closes the session as if it had timed out. Its storage is written and loaded again by the next session of
+        this user
+        """
+
+        if _Session.sessions.get(self.user_id) is self:
+            del _Session.sessions[self.user_id]
+        self.close(0)
+
+    def touch(self) -> None:
+        """
+        Marks the session as recently used
+        """
+
+        self.last_active = time.monotonic()
+        if _Session.sessions.get(self.user_id) is self:
+            _Session.sessions.move_to_end(self.user_id)
+
+    def memory_usage(self) -> int:
+        """
+        Estimates the memory used by this session's data
+        :return: The size in bytes
+        """
+
+        return deep_sizeof((self.__dict__, self.storage, self.history, self.query_callback))
+
+    @staticmethod
+    def _backend() -> Storage:
+        """
+        :return: The persistent storage, if it is a backend the default load and update functions can use
+        :raises TypeError: If a custom storage is used without custom load and update functions
+        """
+
+        if not isinstance(_Session.database, Storage):
+            raise TypeError(f"The persistent storage {type(_Session.database).__name__} is neither a Storage nor a "
+                            f"TinyDB database, give the functions to use it by load_storage and update_storage")
+        return _Session.database
+
+    @staticmethod
+    async def load_user_data(user):
+        """
+        Loads the user's storage from the storage backend
+        :param user: The user's ID
+        :return: The user's storage
+        """
+
+        return await _Session._backend().load(user)
+
+    @staticmethod
+    async def update_user_data(user, storage):
+        """
+        Writes the user's storage with the storage backend
+        :param user: The user's ID
+        :param storage: The user's storage
+        """
+
+        await _Session._backend().update_many({user: storage})
+
+    @staticmethod
+    async def store_user_data(batch: Dict, changed: Dict = None) -> None:
+        """
+        Writes a batch of storages, either at once by the storage backend or one by one by a custom update function
+        :param batch: The storages keyed by the users' IDs
+        :param changed: The keys changed since the last write keyed by the users' IDs, only used by the backend
+        """
+
+        if _Session.batch_updates:
+            await _Session._backend().update_many(batch, changed)
+            return
+
+        # A storage the custom function cannot serialize is left out, so it does not keep the others from being written
+        for user, storage in batch.items():
+            try:
+                if iscoroutinefunction(_Session.update_user_data):
+                    await _Session.update_user_data(user, storage)
+                else:
+                    _Session.update_user_data(user, storage)
+            except (TypeError, ValueError) as e:
+                logger.error(f"The storage of {user} could not be serialized and was not written:\n\t{e!r}")
+
+    async def load_storage(self) -> None:
+        """
+        Loads the session's storage from the persistent storage, if not done yet
+        """
+
+        if self.storage is not None:
+            return
+
+        # The storage of an evicted session may not be written yet
+        pending = _Session.write_behind.pending(self.user_id)
+        if pending is not None:
+            self.storage = pending
+            return
+
+        with _metrics.time("storage_read"):
+            if iscoroutinefunction(_Session.load_user_data):
+                storage = await _Session.load_user_data(self.user_id)
+            else:
+                storage = _Session.load_user_data(self.user_id)
+
+        # Track the changes to only write the storage if needed
+        self.storage = TrackedDict(storage)
 
     def is_allowed(self):
         """
@@ -861,7 +2059,7 @@ class _Session(telepot.aio.helper.UserHandler):
         :return: If the user is allowed
         """
 
-        ids = _config_value("general", "allowed_ids")
+        ids = _settings.allowed_ids
 
         # If no IDs are defined, the user is allowed
         if ids is None:
@@ -871,24 +2069,33 @@ class _Session(telepot.aio.helper.UserHandler):
 
     async def on_close(self, timeout: int) -> None:
         """
-        The function which will be called by telepot when the connection times out. Unused.
+        The function which will be called when the session times out or is evicted
         :param timeout: The length of the exceeded timeout
         """
-        logger.info("User {} timed out".format(self.user))
 
-        pass
+        if _Session.sessions.get(self.user_id) is self:
+            del _Session.sessions[self.user_id]
+
+        # Make sure the storage is written, the next session will find it in the write-behind queue until then
+        if _Session.database is not None and self.storage is not None:
+            _Session.write_behind.mark_dirty(self.user_id, self.storage)
+
+        logger.info("User %s timed out", self.user)
 
     async def on_callback_query(self, query: Dict) -> None:
         """
-        The function which will be called by telepot if the incoming message is a callback query
+        The function which will be called if the incoming message is a callback query
         """
 
         # Acknowledge the received query
         # (The waiting circle in the user's application will disappear)
-        await self.bot.answerCallbackQuery(query['id'])
+        await self.bot.answer_callback_query(query['id'])
+
+        self.touch()
+        await self.load_storage()
 
-        # Replace the query to prevent multiple activations
-        if _config_value('query', 'replace_query', default=True):
+        # Replace the query to prevent multiple activations, unless the session started after the query was sent
+        if _settings.replace_query and self.last_sent is not None:
             lastMessage: Answer = self.last_sent[0]
             choices = lastMessage.choices
 
@@ -898,23 +2105,28 @@ class _Session(telepot.aio.helper.UserHandler):
                 ([x[0] for x in row if x[1] == query['data']] for row in choices), None)[0]
 
             # Edit the message
-            await self.bot.editMessageText((self.user.id, query['message']['message_id']),
-                                           # The message and chat ids are inquired in this way to prevent an error when
-                                           # the user clicks on old queries
-                                           text=("{}\n<b>{}</b>" if lastMessage.markup == "HTML" else "{}\n**{}**")
-                                           .format(lastMessage.msg, replacement),
-                                           parse_mode=lastMessage.markup)
+            await self.bot.edit_message_text(self.user.id, query['message']['message_id'],
+                                             # The message and chat ids are inquired in this way to prevent an error
+                                             # when the user clicks on old queries
+                                             text=("{}\n<b>{}</b>" if lastMessage.markup == "HTML" else "{}\n**{}**")
+                                             .format(lastMessage.msg, replacement),
+                                             parse_mode=lastMessage.markup)
 
         # Look for a matching callback and execute it
         answer = None
         func = self.query_callback.pop(query['message']['message_id'], None)
         if func is not None:
-            if iscoroutinefunction(func):
-                answer = await func(query['data'])
-            else:
-                answer = func(query['data'])
+            try:
+                with _metrics.time("handler", route="callback query"):
+                    answer = await _Session.call_handler(func, query['data'])
+            except asyncio.TimeoutError:
+                await self.handle_timeout('Callback query by {}: "{}"'.format(self.user, query['data']))
+                return
         elif self.gen is not None:
             await self.handle_generator(msg=query['data'])
+        else:
+            await self.handle_conversation(query['data'], Lazy('Callback query by {}: "{}"'.format, self.user,
+                                                               query['data']))
 
         # Process answer
         if answer is not None:
@@ -922,13 +2134,16 @@ class _Session(telepot.aio.helper.UserHandler):
 
     async def on_chat_message(self, msg: dict) -> None:
         """
-        The function which will be called by telepot
+        The function which will be called for every message of the chat
         :param msg: The received message as dictionary
         """
 
         if not self.is_allowed():
             return
 
+        self.touch()
+        await self.load_storage()
+
         # Tests, if it is normal message or something special
         if 'text' in msg:
             await self.handle_text_message(msg)
@@ -942,28 +2157,32 @@ class _Session(telepot.aio.helper.UserHandler):
         """
 
         text = msg['text']
-        log = f'Message by {self.user}: "{text}"'
+        log = Lazy('Message by {}: "{}"'.format, self.user, text)
 
         # Prepare the context
+        message = Message(msg)
         _context.set('user', self.user)
-        _context.set('message', Message(msg))
+        _context.set('message', message)
         _context.set('_<[storage]>_', self.storage)
 
         # If there is currently no generator ongoing, save this message additionally as init
         # This may be of use when inside a generator the starting message is needed
         if self.gen is None:
-            _context.set("init_message", Message(msg))
+            _context.set("init_message", message)
 
         # Calls the preprocessing function
-        if not Bot._before_function():
+        with _metrics.time("before"):
+            proceed = Bot._before_function()
+        if not proceed:
             return
 
         args: Tuple = ()
         kwargs: Dict = {}
 
-        if text == _config_value('bot', 'cancel_command', default="/cancel"):
+        if text == _settings.cancel_command:
             self.gen = None
             self.callback = None
+            self.leave_conversation()
 
         # If a generator is defined, handle it the message and return if it did not stop
         if self.gen is not None:
@@ -971,53 +2190,61 @@ class _Session(telepot.aio.helper.UserHandler):
             if await self.handle_generator(msg=text):
                 return
 
-        # If a callback is defined and the text does not match the defined cancel command,
-        # the callback function is called
-        if self.callback is not None:
-            func = self.callback
-            self.callback = None
-            args = tuple(text)
+        # If a conversation is ongoing, its current step processes the message
+        if await self.handle_conversation(text, log):
+            return
+
+        with _metrics.time("routing"):
+            # If a callback is defined and the text does not match the defined cancel command,
+            # the callback function is called
+            if self.callback is not None:
+                func = self.callback
+                self.callback = None
+                args = tuple(text)
 
-        # Check, if the message is covered by one of the known simple routes
-        elif text in _Session.simple_routes:
-            func = _Session.simple_routes[text]
+            # Check, if the message is covered by one of the known simple routes
+            elif text in _Session.simple_routes:
+                func = _Session.simple_routes[text]
 
-        # Check, if the message is covered by one of the known parse routes
-        elif text in _Session.parse_routes:
-            func, matching = _Session.parse_routes[text]
-            kwargs = matching.named
+            else:
 
-        # Check, if the message is covered by one of the known regex routes
-        elif text in _Session.regex_routes:
-            func, matching = _Session.regex_routes[text]
-            kwargs = matching.groupdict()
+                # Look the message up once per routing dictionary, the results are cached by text
+                parsed = _Session.parse_routes.lookup(text)
+                matched = _Session.regex_routes.lookup(text) if parsed is None else None
 
-        # After everything else has not matched, call the default handler
-        else:
-            func = _Session.default_answer
+                # Check, if the message is covered by one of the known parse routes
+                if parsed is not None:
+                    func, matching = parsed
+                    kwargs = matching.named
+
+                # Check, if the message is covered by one of the known regex routes
+                elif matched is not None:
+                    func, matching = matched
+                    kwargs = matching.groupdict()
+
+                # After everything else has not matched, call the default handler
+                else:
+                    func = _Session.default_answer
 
         # Call the matching function to process the message and catch any exceptions
         try:
 
             # The user of the framework can choose freely between synchronous and asynchronous programming
             # So the program decides upon the signature how to call the function
-            if iscoroutinefunction(func):
-                answer = await func(*args, **kwargs)
-            else:
-                answer = func(*args, **kwargs)
+            with _metrics.time("handler", route=self.route_label(func) if _metrics.enabled else None):
+                answer = await _Session.call_handler(func, *args, **kwargs)
+
+        except asyncio.TimeoutError:
+            await self.handle_timeout(log)
 
         except Exception as e:
+            _metrics.count("errors_total", exception=type(e).__name__, stage="handler")
 
-            # Depending of the exceptions type, the specific message is on a different index
-            if isinstance(e, OSError):
-                msg = e.args[1]
-            else:
-                msg = e.args[0]
-            err = traceback.extract_tb(sys.exc_info()[2])[-1]
-            err = "\n\tDuring the processing occured an error\n\t\tError message: {}\n\t\tFile: {}\n\t\tFunc: {}" \
-                  "\n\t\tLiNo: {}\n\t\tLine: {}\n\tNothing was returned to the user" \
-                .format(msg, err.filename.split("/")[-1], err.name, err.lineno, err.line)
-            logger.warning(log + err)
+            # The report is only put together when it is written
+            logger.warning("%s%s", log, Lazy(self._describe_error, e,
+                                             "\n\tDuring the processing occured an error\n\t\tError message: {}"
+                                             "\n\t\tFile: {}\n\t\tFunc: {}\n\t\tLiNo: {}\n\t\tLine: {}"
+                                             "\n\tNothing was returned to the user"))
 
             # Send error message, if configured
             await self.handle_error()
@@ -1025,22 +2252,27 @@ class _Session(telepot.aio.helper.UserHandler):
         else:
             await self.prepare_answer(answer, log)
 
-    async def prepare_answer(self, answer: Union[Answer, Iterable], log: str = "") -> None:
+    async def prepare_answer(self, answer: Union[Answer, Iterable], log: Union[str, Lazy] = "") -> None:
         """
         Prepares the returned object to be processed later on
         :param answer: The answer to be given
-        :param log: A logging string
+        :param log: A logging string, which may be formatted lazily
         """
 
-        # Syncs persistent storage
+        # Schedules the persistent storage to be synced, if it was changed
         if _Session.database is not None:
-            _Session.update_user_data(self.user_id, self.storage)
+            _Session.write_behind.mark_dirty(self.user_id, self.storage)
 
         try:
 
+            # A transition changes the conversation and its answer is sent
+            if isinstance(answer, Transition):
+                self.enter(answer)
+                answer = answer.answer
+
             # None as return will result in no answer being sent
             if answer is None:
-                logger.info(log + "\n\tNo answer was given")
+                logger.info("%s\n\tNo answer was given", log)
                 return
 
             # Handle multiple strings or answers as return
@@ -1050,8 +2282,9 @@ class _Session(telepot.aio.helper.UserHandler):
                 elif isinstance(answer[0], Answer):
                     await self.handle_answer(answer)
 
-            # Handle a generator
+            # Handle a generator, which replaces an ongoing conversation
             elif isgenerator(answer) or isasyncgen(answer):
+                self.leave_conversation()
                 self.gen = answer
                 self.gen_is_async = isasyncgen(answer)
                 await self.handle_generator(first_call=True)
@@ -1061,60 +2294,137 @@ class _Session(telepot.aio.helper.UserHandler):
                 await self.handle_answer([answer])
 
         except IndexError:
-            err = '\n\tAn index error occured while preparing the answer.' \
-                  '\n\tLikely the answer is ill-formatted:\n\t\t{}'.format(str(answer))
-            logger.warning(log + err)
+            _metrics.count("errors_total", exception="IndexError", stage="answer")
+            logger.warning("%s\n\tAn index error occured while preparing the answer."
+                           "\n\tLikely the answer is ill-formatted:\n\t\t%s", log, answer)
 
             # Send error message, if configured
             await self.handle_error()
             return
 
         except FileNotFoundError as e:
-            err = '\n\tThe request could not be fulfilled as the file "{}" could not be found'.format(e.filename)
-            logger.warning(log + err)
+            _metrics.count("errors_total", exception="FileNotFoundError", stage="answer")
+            logger.warning('%s\n\tThe request could not be fulfilled as the file "%s" could not be found',
+                           log, e.filename)
 
             # Send error message, if configured
             await self.handle_error()
             return
 
         except TelegramError as e:
+            _metrics.count("errors_total", exception="TelegramError", stage="answer")
             reason = e.args[0]
 
             # Try to give a clearer error description
             if reason == "Bad Request: chat not found":
                 reason = "The recipient has either not yet started communication with this bot or blocked it"
 
-            err = '\n\tThe request could not be fulfilled as an API error occured:' \
-                  '\n\t\t{}' \
-                  '\n\tNothing was returned to the user'.format(reason)
-            logger.warning(log + err)
+            logger.warning("%s\n\tThe request could not be fulfilled as an API error occured:"
+                           "\n\t\t%s"
+                           "\n\tNothing was returned to the user", log, reason)
 
             # Send error message, if configured
             await self.handle_error()
             return
 
         except Exception as e:
+            _metrics.count("errors_total", exception=type(e).__name__, stage="answer")
 
-            # Depending of the exceptions type, the specific message is on a different index
-            if isinstance(e, OSError):
-                msg = e.args[1]
-            else:
-                msg = e.args[0]
-            err = traceback.extract_tb(sys.exc_info()[2])[-1]
-            err = "\n\tDuring the sending of the bot's answer occured an error\n\t\tError message: {}\n\t\tFile: {}" \
-                  "\n\t\tFunc: {}\n\t\tLiNo: {}\n\t\tLine: {}\n\tNothing was returned to the user" \
-                  "\n\tYou may report this bug as it either should not have occured " \
-                  "or should have been properly caught" \
-                .format(msg, err.filename.split("/")[-1], err.name, err.lineno, err.line)
-            logger.warning(log + err)
+            # The report is only put together when it is written
+            logger.warning("%s%s", log, Lazy(self._describe_error, e,
+                                             "\n\tDuring the sending of the bot's answer occured an error"
+                                             "\n\t\tError message: {}\n\t\tFile: {}\n\t\tFunc: {}\n\t\tLiNo: {}"
+                                             "\n\t\tLine: {}\n\tNothing was returned to the user"
+                                             "\n\tYou may report this bug as it either should not have occured "
+                                             "or should have been properly caught"))
 
             # Send error message, if configured
             await self.handle_error()
 
         else:
 
-            if log is not None and len(log) > 0:
-                logger.info(log)
+            if log:
+                logger.info("%s", log)
+
+    def enter(self, transition: Transition) -> None:
+        """
+        Stores the conversation state a transition leads to. Entering a conversation ends an ongoing generator
+        :param transition: The transition returned by a handler or a step
+        """
+
+        if transition.conversation is None:
+            self.leave_conversation()
+        else:
+
+            # The data is kept when moving to another step of the same conversation
+            data = transition.data
+            if data is None:
+                state = self.storage.get(STATE_KEY)
+                data = state['data'] if state is not None and state['conversation'] == transition.conversation else {}
+
+            self.gen = None
+            self.storage[STATE_KEY] = {"conversation": transition.conversation, "step": transition.step, "data": data}
+
+        # Make sure the changed state is written
+        if _Session.database is not None:
+            _Session.write_behind.mark_dirty(self.user_id, self.storage)
+
+    def leave_conversation(self) -> None:
+        """
+        Ends the ongoing conversation. The storage is only changed, if there is one, so it is not marked as changed
+        for every message
+        """
+
+        if STATE_KEY in self.storage:
+            del self.storage[STATE_KEY]
+
+    async def handle_conversation(self, text: str, log: Union[str, Lazy]) -> bool:
+        """
+        Processes a message by the current step of the ongoing conversation, if there is one
+        :param text: The message's text or the data of the pressed button
+        :param log: A logging string, which may be formatted lazily
+        :return: If there was a conversation to process the message
+        """
+
+        state = self.storage.get(STATE_KEY)
+        if state is None:
+            return False
+
+        # A conversation, which is not declared anymore, e.g. after an update of the bot, is dropped
+        step = Conversation.lookup(state)
+        if step is None:
+            logger.warning("The conversation %s of %s is at the unknown step %s and was ended",
+                           state.get('conversation'), self.user, state.get('step'))
+            self.leave_conversation()
+            return False
+
+        try:
+            with _metrics.time("handler", route=f"{state['conversation']}: {state['step']}"):
+                answer = await _Session.call_handler(step, text, state['data'])
+
+        # A failed step ends the conversation
+        except asyncio.TimeoutError:
+            self.leave_conversation()
+            await self.handle_timeout(log)
+
+        except Exception as e:
+            self.leave_conversation()
+            _metrics.count("errors_total", exception=type(e).__name__, stage="handler")
+            logger.warning("%s%s", log, Lazy(self._describe_error, e,
+                                             "\n\tDuring the processing occured an error\n\t\tError message: {}"
+                                             "\n\t\tFile: {}\n\t\tFunc: {}\n\t\tLiNo: {}\n\t\tLine: {}"
+                                             "\n\tNothing was returned to the user"))
+
+            # Send error message, if configured
+            await self.handle_error()
+
+        else:
+            await self.prepare_answer(answer, log)
+
+        # Make sure the changed state is written
+        if _Session.database is not None:
+            _Session.write_behind.mark_dirty(self.user_id, self.storage)
+        return True
 
     async def handle_sticker(self, msg: Dict) -> None:
         """
@@ -1126,8 +2436,8 @@ class _Session(telepot.aio.helper.UserHandler):
             return
 
         # Extract the emojis associated with the sticker
-        if _config_value('bot', 'extract_emojis', default=False):
-            logger.debug("Sticker by {}, will be dismantled".format(self.user))
+        if _settings.extract_emojis:
+            logger.debug("Sticker by %s, will be dismantled", self.user)
             msg['text'] = msg['sticker']['emoji']
             await self.handle_text_message(msg)
 
@@ -1140,8 +2450,21 @@ class _Session(telepot.aio.helper.UserHandler):
         Informs the connected user that an exception occured, if enabled
         """
 
-        if _config_value('bot', 'error_reply', default=None) is not None:
-            await self.prepare_answer(Answer(_config_value('bot', 'error_reply')))
+        if _settings.error_reply is not None:
+            await self.prepare_answer(Answer(_settings.error_reply))
+
+    async def handle_timeout(self, log: Union[str, Lazy]) -> None:
+        """
+        Reports a handler, which was cancelled as it exceeded its timeout, and informs the user, if enabled
+        :param log: A logging string describing the update, which may be formatted lazily
+        """
+
+        _metrics.count("errors_total", exception="TimeoutError", stage="handler")
+        logger.warning("%s\n\tThe handler exceeded its timeout and was cancelled\n\tNothing was returned to the user",
+                       log)
+
+        # Send error message, if configured
+        await self.handle_error()
 
     async def handle_answer(self, answers: Iterable[Answer]) -> None:
         """
@@ -1175,18 +2498,17 @@ class _Session(telepot.aio.helper.UserHandler):
         try:
 
             # On first call, None has to be inserted
-            if first_call:
-                if self.gen_is_async:
-                    answer = await self.gen.asend(None)
-                else:
-                    answer = self.gen.send(None)
+            value = None if first_call else msg
 
             # On the following calls, the message is inserted
-            else:
+            with _metrics.time("handler", route="generator"):
                 if self.gen_is_async:
-                    answer = await self.gen.asend(msg)
+                    answer = await _Session.within_timeout(self.gen.ag_code, self.gen.asend(value))
+                elif _Session.executors.get(self.gen.gi_code, _settings.executor) != LOOP:
+                    answer = await _Session.within_timeout(self.gen.gi_code,
+                                                           _Session.handler_pool.send(self.gen, value))
                 else:
-                    answer = self.gen.send(msg)
+                    answer = self.gen.send(value)
 
             await self.prepare_answer(answer)
 
@@ -1194,9 +2516,85 @@ class _Session(telepot.aio.helper.UserHandler):
         except (StopIteration, StopAsyncIteration):
             self.gen = None
             return False
+
+        # A step which took too long ends the conversation, the message counts as handled
+        except asyncio.TimeoutError:
+            self.gen = None
+            await self.handle_timeout("A step of a conversation with {}".format(self.user))
+            return True
         else:
             return True
 
+    @staticmethod
+    def _describe_error(error: Exception, template: str) -> str:
+        """
+        Describes an error raised while processing a message
+        :param error: The raised error
+        :param template: The description with placeholders for the error's message, file, function, line number and line
+        :return: The filled in description
+        """
+
+        # Depending of the exceptions type, the specific message is on a different index
+        if isinstance(error, OSError) and len(error.args) > 1:
+            msg = error.args[1]
+        else:
+            msg = error.args[0] if error.args else repr(error)
+
+        err = traceback.extract_tb(error.__traceback__)[-1]
+        return template.format(msg, err.filename.split("/")[-1], err.name, err.lineno, err.line)
+
+    @staticmethod
+    def route_label(func: Callable) -> str:
+        """
+        Names the route of a handler to label its measurements
+        :param func: The handler
+        :return: The handler's patterns or a description of its kind
+        """
+
+        if func is _Session.default_answer:
+            return "default"
+
+        return _Session.route_labels.get(func, "callback")
+
+    @staticmethod
+    async def call_handler(func: Callable, *args, **kwargs) -> Any:
+        """
+        Calls a handler, coroutine functions are awaited and synchronous ones are run by their executor
+        :param func: The handler
+        :param args: The positional arguments to pass
+        :param kwargs: The keyword arguments to pass
+        :return: The handler's result
+        :raises asyncio.TimeoutError: If the handler exceeded its timeout and was cancelled
+        """
+
+        if iscoroutinefunction(func):
+            return await _Session.within_timeout(func, func(*args, **kwargs))
+
+        executor = _Session.executors.get(func, _settings.executor)
+        if executor == LOOP:
+            return func(*args, **kwargs)
+        return await _Session.within_timeout(func, _Session.handler_pool.call(executor, func, *args, **kwargs))
+
+    @staticmethod
+    async def within_timeout(key: Union[Callable, types.CodeType, None], awaitable: Awaitable) -> Any:
+        """
+        Awaits a handler's result, but cancels it after the handler's timeout
+        :param key: The handler or the code of its generator, by which its timeout is looked up
+        :param awaitable: The handler's result to await
+        :return: The awaited result
+        :raises asyncio.TimeoutError: If the timeout was exceeded
+        """
+
+        timeout = _Session.timeouts.get(key, _settings.handler_timeout)
+        if timeout is None:
+            return await awaitable
+
+        # The handler runs as a task of its own to be cancelled, but shares the session's context, so its changes of the
+        # context last. The task is created without the loop's task factory, which would copy the whole context first
+        task = asyncio.Task(awaitable) if asyncio.iscoroutine(awaitable) else asyncio.ensure_future(awaitable)
+        task.context = asyncio.current_task().context
+        return await asyncio.wait_for(task, timeout)
+
     @staticmethod
     async def default_answer() -> Union[str, Answer, Iterable[str], None]:
         """
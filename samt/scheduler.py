@@ -0,0 +1,163 @@
+import asyncio
+import time
+from typing import Dict, Hashable, Callable, Awaitable, Any, Optional
+
+from samt.bot import TelegramError, RetryAfter
+
+
+class TokenBucket(object):
+    """
+    A token bucket handing out time slots at a fixed rate, allowing bursts up to its capacity.
+    Tokens are reserved in advance, so concurrent callers are spread over the following slots
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        :param rate: The number of tokens refilled per second
+        :param capacity: The maximal number of tokens available at once
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self) -> float:
+        """
+        Takes a token
+        :return: The seconds to wait until the token may be used
+        """
+
+        self._refill()
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Delays the next reservation by at least the given time
+        :param seconds: The time to wait
+        """
+
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        """
+        Tests, if the bucket has been refilled completely, so it is not distinguishable from a new one
+        :return: If the bucket is full
+        """
+
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class _Chat(object):
+    """
+    The rate limit and the queue of a single chat
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class SendScheduler(object):
+    """
+    Paces outgoing requests to stay within telegram's limits, globally and per chat. Requests to the same chat are
+    performed in the order of their submission, requests to different chats run concurrently
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 3):
+        """
+        :param global_rate: The maximal number of requests per second
+        :param chat_rate: The maximal number of requests per second and chat
+        :param chat_burst: The number of requests a chat may receive at once before being limited
+        :param max_retries: How often a request is repeated after telegram asked to retry later
+        """
+
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        # The global limit holds for any second, so it allows no burst on top of its rate
+        self._global = TokenBucket(global_rate)
+        self._chats: Dict[Hashable, _Chat] = dict()
+        self._sweep_at = 1024
+
+    def set_global_rate(self, rate: float) -> None:
+        """
+        Changes the global limit, e.g. to share it between several processes
+        :param rate: The maximal number of requests per second
+        """
+
+        self.global_rate = rate
+        self._global = TokenBucket(rate)
+
+    @staticmethod
+    def _retry_after(error: TelegramError) -> Optional[float]:
+        """
+        Extracts the time to wait from a flood control error
+        :param error: The error raised by the client
+        :return: The seconds to wait or None, if the error is of another kind
+        """
+
+        if not isinstance(error, RetryAfter):
+            return None
+        return error.retry_after
+
+    def _sweep(self) -> None:
+        """
+        Removes the chats which have no pending requests and whose rate limits have recovered
+        """
+
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if chat.pending == 0 and chat.bucket.is_full()]:
+            del self._chats[chat_id]
+
+        self._sweep_at = max(1024, 2 * len(self._chats))
+
+    async def send(self, chat_id: Hashable, func: Callable[..., Awaitable], *args: Any) -> Any:
+        """
+        Performs a request as soon as the rate limits allow it
+        :param chat_id: The chat the request is sent to
+        :param func: The coroutine function performing the request, called again for a retry
+        :param args: The arguments to pass
+        :return: The request's result
+        """
+
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self._sweep_at:
+                self._sweep()
+            chat = self._chats[chat_id] = _Chat(self.chat_rate, self.chat_burst)
+
+        chat.pending += 1
+        try:
+
+            # The lock keeps the order of requests to the same chat
+            async with chat.lock:
+                for attempt in range(self.max_retries + 1):
+                    for bucket in (chat.bucket, self._global):
+                        delay = bucket.reserve()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+
+                    try:
+                        return await func(*args)
+                    except TelegramError as e:
+                        retry_after = self._retry_after(e)
+                        if retry_after is None or attempt == self.max_retries:
+                            raise
+                        chat.bucket.pause(retry_after)
+        finally:
+            chat.pending -= 1
+
+    def __len__(self):
+        return len(self._chats)
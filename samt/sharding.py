@@ -0,0 +1,150 @@
+import multiprocessing
+import os
+import queue
+from typing import Callable, List, Optional, Tuple
+
+# The prefix of the worker processes' names, by which a process recognizes being a worker
+WORKER_PREFIX = "samt-worker-"
+
+
+def chat_id_of(update: dict) -> Optional[int]:
+    """
+    Finds the chat an update belongs to
+    :param update: The update as received from telegram
+    :return: The chat's ID or None, if the update does not belong to a chat
+    """
+
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+
+        # Callback queries carry the message they are attached to
+        message = value.get('message', value) if key == 'callback_query' else value
+        if isinstance(message.get('chat'), dict):
+            return message['chat']['id']
+        if isinstance(value.get('from'), dict):
+            return value['from']['id']
+
+    return None
+
+
+def is_worker() -> bool:
+    """
+    Tests, if the current process is a worker started by a ShardPool
+    :return: If the process is a worker
+    """
+
+    return multiprocessing.current_process().name.startswith(WORKER_PREFIX)
+
+
+class ShardPool(object):
+    """
+    Distributes updates to worker processes by their chat, so all updates of a chat are processed in order by the same
+    worker. Workers which exit unexpectedly are restarted.
+    The workers are started freshly instead of being forked, so the main module is imported again and has to guard
+    starting the bot by `if __name__ == "__main__"`
+    """
+
+    def __init__(self, count: int, target: Callable, args: tuple = ()):
+        """
+        :param count: The number of worker processes
+        :param target: The function run by each worker with its index, the number of workers, its update queue and the
+            further arguments. It has to be importable, as it is passed to the new processes by reference
+        :param args: The further arguments passed to the target, e.g. queues shared by all workers
+        """
+
+        self.count = count
+        self.target = target
+        self.args = args
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = [None] * count
+        self._processes: List[multiprocessing.Process] = [None] * count
+        self._stopping = False
+
+    def _start(self, index: int) -> None:
+        self._queues[index] = self._context.Queue()
+        self._processes[index] = self._context.Process(target=self.target,
+                                                       args=(index, self.count, self._queues[index], *self.args),
+                                                       name=f"{WORKER_PREFIX}{index}")
+        self._processes[index].start()
+
+    def start(self) -> None:
+        """
+        Starts all workers
+        """
+
+        for index in range(self.count):
+            self._start(index)
+
+    def dispatch(self, update: dict) -> None:
+        """
+        Hands an update to the worker responsible for its chat
+        :param update: The update as received from telegram
+        """
+
+        chat_id = chat_id_of(update)
+        self._queues[(chat_id or 0) % self.count].put(update)
+
+    def _restart(self, index: int) -> None:
+        """
+        Replaces a dead worker and hands it the updates its predecessor did not take yet
+        :param index: The worker's index
+        """
+
+        old = self._queues[index]
+        self._start(index)
+
+        # The queue is abandoned, as the dead worker may still hold its lock
+        try:
+            while True:
+                self._queues[index].put(old.get_nowait())
+        except (queue.Empty, OSError, EOFError):
+            pass
+        old.close()
+
+    def check(self) -> List[Tuple[int, int]]:
+        """
+        Restarts the workers which exited, unless the pool is being stopped
+        :return: The indexes and exit codes of the restarted workers
+        """
+
+        restarted = []
+
+        for index, process in enumerate(self._processes):
+            if self._stopping or process.exitcode is None:
+                continue
+
+            restarted.append((index, process.exitcode))
+            self.restarts += 1
+            self._restart(index)
+
+        return restarted
+
+    def signal(self, sig: int) -> None:
+        """
+        Forwards a signal to all workers
+        :param sig: The signal to send
+        """
+
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, sig)
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Asks all workers to finish and waits for them. Workers which do not finish in time are terminated
+        :param timeout: The seconds to wait for each worker
+        """
+
+        self._stopping = True
+
+        # None marks the end of the updates
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
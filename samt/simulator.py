@@ -0,0 +1,543 @@
+"""
+A local stand-in for telegram's Bot API and a benchmark driving synthetic chats through a bot script.
+Run `python -m samt.simulator path/to/Bot.py --chats 1000` to measure a bot without any network access
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque, defaultdict, Counter
+from typing import Dict, Deque, List, Optional, Callable, Iterable
+
+import toml
+from aiohttp import web
+
+# The keys of the sent media in the returned messages, by the methods sending them
+_MEDIA_METHODS = {
+    "sendPhoto": "photo",
+    "sendAudio": "audio",
+    "sendDocument": "document",
+    "sendSticker": "sticker",
+    "sendVideo": "video",
+    "sendVoice": "voice",
+}
+
+# The methods which are answered with a plain success
+_TRUE_METHODS = ("answerCallbackQuery", "setWebhook", "deleteWebhook", "sendChatAction")
+
+# The seconds over which the flood control averages the messages, so short bursts are tolerated like by telegram
+_FLOOD_WINDOW = 3
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _rss(pid: int) -> Optional[int]:
+    """
+    Reads the resident memory of a process, which is only possible on linux
+    :return: The size in bytes or None, if it cannot be read
+    """
+
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class FakeTelegram(object):
+    """
+    A HTTP server answering the Bot API methods a bot uses to receive and answer messages. Updates are queued by
+    the caller and handed out by getUpdates, sent messages are confirmed with made up IDs and reported to a callback
+    """
+
+    def __init__(self, token: str = "123456:simulated", global_rate: float = None, chat_rate: float = None):
+        """
+        :param token: The bot token the requests have to use
+        :param global_rate: The messages per second the bot may send in total, before the flood control answers with
+            429 like telegram, or None to accept any number. The rates are averaged over a few seconds
+        :param chat_rate: The messages per second the bot may send to a single chat or None to accept any number
+        """
+
+        self.token = token
+        self.me = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Simulated", "username": "sim_bot"}
+
+        # Called with the method, the parameters and the resulting message of every request sending to or editing in
+        # a chat
+        self.on_send: Optional[Callable[[str, dict, dict], None]] = None
+
+        self.requests: Counter = Counter()
+        self.delivered = 0
+        self.uploads = 0
+
+        # The flood control, which remembers the times of the recent messages
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.flood_errors = 0
+        self._sent: Deque[float] = deque()
+        self._sent_by_chat: Dict[str, Deque[float]] = defaultdict(deque)
+
+        self._updates: Deque[dict] = deque()
+        self._failures: Dict[str, Deque[dict]] = defaultdict(deque)
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._new_updates: Optional[asyncio.Event] = None
+        self._polled: Optional[asyncio.Event] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    def push(self, kind: str, payload: dict) -> dict:
+        """
+        Queues an update for the next getUpdates
+        :param kind: The update's type, e.g. "message"
+        :param payload: The update's content
+        :return: The update
+        """
+
+        update = {"update_id": self._next_update_id, kind: payload}
+        self._next_update_id += 1
+        self._updates.append(update)
+
+        if self._new_updates is not None:
+            self._new_updates.set()
+        return update
+
+    def fail(self, method: str, error_code: int, description: str = "", **parameters) -> None:
+        """
+        Lets the next call of a method fail, e.g. to trigger the flood control
+        :param method: The name of the method, e.g. "sendPhoto"
+        :param error_code: The error code to answer with, e.g. 429
+        :param description: The error's description
+        :param parameters: The response parameters, e.g. retry_after
+        """
+
+        self._failures[method].append({"ok": False, "error_code": error_code, "description": description,
+                                       "parameters": parameters})
+
+    def push_message(self, chat_id: int, text: str, first_name: str = None, language_code: str = "en") -> dict:
+        """
+        Queues a text message written by a user in their private chat
+        :param chat_id: The chat's ID, which is the user's ID as well
+        :param text: The message's text
+        :param first_name: The user's name, by default derived from the ID
+        :param language_code: The language of the user's client
+        :return: The update
+        """
+
+        user = {"id": chat_id, "is_bot": False, "first_name": first_name or f"User {chat_id}",
+                "language_code": language_code}
+        return self.push("message", {"message_id": self._message_id(), "from": user,
+                                     "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+                                     "date": int(time.time()), "text": text})
+
+    def push_callback_query(self, chat_id: int, message_id: int, data: str) -> dict:
+        """
+        Queues the press of an inline button
+        :param chat_id: The chat's ID, which is the user's ID as well
+        :param message_id: The ID of the message the button is attached to
+        :param data: The button's callback data
+        :return: The update
+        """
+
+        user = {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}", "language_code": "en"}
+        message = {"message_id": message_id, "from": self.me, "chat": {"id": chat_id, "type": "private"},
+                   "date": int(time.time())}
+        return self.push("callback_query", {"id": str(self._message_id()), "from": user, "message": message,
+                                            "chat_instance": str(chat_id), "data": data})
+
+    def _flooded(self, chat_id: str) -> bool:
+        """
+        Tests, if a message exceeds the rate limits, and remembers it otherwise
+        :param chat_id: The recipient
+        :return: If the message has to be rejected
+        """
+
+        now = time.monotonic()
+        sent, sent_to_chat = self._sent, self._sent_by_chat[chat_id]
+        while sent and sent[0] <= now - _FLOOD_WINDOW:
+            sent.popleft()
+        while sent_to_chat and sent_to_chat[0] <= now - _FLOOD_WINDOW:
+            sent_to_chat.popleft()
+
+        if (self.global_rate is not None and len(sent) > self.global_rate * _FLOOD_WINDOW) or \
+                (self.chat_rate is not None and len(sent_to_chat) > self.chat_rate * _FLOOD_WINDOW):
+            self.flood_errors += 1
+            return True
+
+        sent.append(now)
+        sent_to_chat.append(now)
+        return False
+
+    def _message_id(self) -> int:
+        self._next_message_id += 1
+        return self._next_message_id
+
+    async def wait_polled(self) -> None:
+        """
+        Waits for the first getUpdates or the registration of a webhook, after which the bot is ready
+        """
+
+        await self._polled.wait()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts the server
+        :param host: The address to listen on
+        :param port: The port to listen on, by default any free one
+        :return: The server's URL
+        """
+
+        self._new_updates = asyncio.Event()
+        self._polled = asyncio.Event()
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        """
+        Stops the server
+        """
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @staticmethod
+    async def _parameters(request: web.Request) -> dict:
+        """
+        Reads the parameters, which may be passed as query, form, multipart or JSON
+        """
+
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        elif request.body_exists:
+            params.update(await request.post())
+        return params
+
+    @staticmethod
+    def _reply(result=None, status: int = 200, description: str = None) -> web.Response:
+        if status != 200:
+            return web.json_response({"ok": False, "error_code": status, "description": description}, status=status)
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, params: dict, **content) -> dict:
+        chat_id = params.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        message_id = params.get("message_id")
+        return {"message_id": int(message_id) if message_id is not None else self._message_id(), "from": self.me,
+                "chat": {"id": chat_id, "type": "private"}, "date": int(time.time()), **content}
+
+    async def _get_updates(self, params: dict) -> list:
+
+        # An offset confirms all updates before it
+        offset = int(params.get("offset", 0))
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+            self.delivered += 1
+
+        if not self._updates and float(params.get("timeout", 0)) > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+
+        limit = min(int(params.get("limit", 100)), 100)
+        return [update for _, update in zip(range(limit), self._updates)]
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if request.match_info["token"] != self.token:
+            return self._reply(status=401, description="Unauthorized")
+
+        method = request.match_info["method"]
+        params = await self._parameters(request)
+        self.requests[method] += 1
+
+        if self._failures.get(method):
+            failure = self._failures[method].popleft()
+            return web.json_response(failure, status=failure["error_code"])
+
+        if method == "getUpdates":
+            self._polled.set()
+            return self._reply(await self._get_updates(params))
+        if method == "getMe":
+            return self._reply(self.me)
+        if method == "setWebhook":
+            self._polled.set()
+        if method in _TRUE_METHODS:
+            return self._reply(True)
+
+        if (self.global_rate is not None or self.chat_rate is not None) and \
+                (method in ("sendMessage", "editMessageText") or method in _MEDIA_METHODS) and \
+                self._flooded(str(params.get("chat_id"))):
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        if method == "sendMessage" or method == "editMessageText":
+            result = self._message(params, text=params.get("text", ""))
+        elif method in _MEDIA_METHODS:
+            key = _MEDIA_METHODS[method]
+            sent = params.get(key)
+
+            # Files sent by ID or URL keep it, uploads get a new one
+            if isinstance(sent, str):
+                file_id = sent
+            else:
+                self.uploads += 1
+                file_id = f"simulated-{self.uploads}"
+
+            media = {"file_id": file_id, "file_unique_id": file_id}
+            result = self._message(params, **{key: [media] if key == "photo" else media})
+        else:
+            return self._reply(status=404, description="Not Found: method not found")
+
+        if self.on_send is not None:
+            self.on_send(method, params, result)
+        return self._reply(result)
+
+
+class Benchmark(object):
+    """
+    Runs a bot script against a FakeTelegram and lets many synthetic users write to it. For every update, the time
+    until the bot sends or edits a message in its chat is measured. The script runs on a copy of its directory with a
+    configuration pointing it to the simulator. The rate limit is disabled, which would otherwise be measured, unless
+    the scheduler itself is measured against a simulator enforcing telegram's flood control
+    """
+
+    def __init__(self, script: str, chats: int = 1000, messages: int = 1, texts: Iterable[str] = ("/start",),
+                 rate: float = 0, settle: float = 5, startup: float = 30, rate_limit: bool = False, workers: int = 1,
+                 press: bool = False):
+        """
+        :param script: The path of the bot script, which has its configuration folder next to it
+        :param chats: The number of users writing to the bot
+        :param messages: The number of messages every user writes
+        :param texts: The texts the users write, used in turn
+        :param rate: The updates queued per second or 0 to queue all at once
+        :param settle: The seconds without any answer after which the benchmark ends, if not all updates are answered
+        :param startup: The seconds the bot may take to poll for the first time
+        :param rate_limit: If the bot paces its messages by its scheduler, while the simulator answers messages
+            exceeding about 30 per second in total or 1 per second and chat with 429
+        :param workers: The number of processes the bot handles the messages by
+        :param press: If the users press the first button of every inline keyboard they are sent, once per message
+            they write. The pressed buttons count as updates
+        """
+
+        self.script = os.path.realpath(script)
+        self.chats = chats
+        self.messages = messages
+        self.texts = list(texts)
+        self.rate = rate
+        self.settle = settle
+        self.startup = startup
+        self.rate_limit = rate_limit
+        self.workers = workers
+        self.press = press
+
+        self._pending: Dict[int, Deque[float]] = dict()
+        self._latencies: List[float] = []
+        self._last_answer = 0.0
+        self._queued = 0
+        self._presses: Counter = Counter()
+        self._server: Optional[FakeTelegram] = None
+
+    def _on_send(self, method: str, params: dict, sent: dict) -> None:
+        try:
+            chat_id = int(params.get("chat_id"))
+        except (TypeError, ValueError):
+            return
+        pending = self._pending.get(chat_id)
+
+        # Further messages answering the same update are not counted
+        if pending:
+            self._last_answer = time.perf_counter()
+            self._latencies.append(self._last_answer - pending.popleft())
+
+        # Press the first button of a new inline keyboard, unless the user pressed one for every message already
+        if self.press and method != "editMessageText" and self._presses[chat_id] < self.messages:
+            markup = params.get("reply_markup") or dict()
+            try:
+                keyboard = (json.loads(markup) if isinstance(markup, str) else markup).get("inline_keyboard")
+            except (ValueError, AttributeError):
+                keyboard = None
+            if keyboard:
+                self._presses[chat_id] += 1
+                self._server.push_callback_query(chat_id, sent["message_id"], keyboard[0][0]["callback_data"])
+                self._pending.setdefault(chat_id, deque()).append(time.perf_counter())
+                self._queued += 1
+
+    def _prepare(self, directory: str, server: FakeTelegram, url: str) -> str:
+        """
+        Copies the script's directory and points its configuration to the simulator
+        :return: The path of the copied script
+        """
+
+        source = os.path.dirname(self.script)
+        target = os.path.join(directory, "bot")
+        shutil.copytree(source, target)
+
+        filename = os.path.join(target, "config", "config.toml")
+        config = toml.load(filename) if os.path.exists(filename) else dict()
+        config.setdefault("general", dict())["logging"] = "error"
+        config["bot"] = {**config.get("bot", dict()), "token": server.token, "api_url": url, "mode": "polling",
+                         "workers": self.workers, "rate_limit": self.rate_limit}
+        config.pop("webhook", None)
+        config.pop("metrics", None)
+        with open(filename, "w") as file:
+            toml.dump(config, file)
+
+        return os.path.join(target, os.path.basename(self.script))
+
+    async def _feed(self, server: FakeTelegram) -> None:
+        """
+        Queues the messages of all users, round by round
+        """
+
+        started = time.perf_counter()
+        queued = 0
+
+        for round_index in range(self.messages):
+            for chat in range(self.chats):
+                chat_id = 1000000 + chat
+                server.push_message(chat_id, self.texts[(round_index + chat) % len(self.texts)])
+                self._pending.setdefault(chat_id, deque()).append(time.perf_counter())
+                queued += 1
+                self._queued += 1
+
+                # Wait until the next update is due
+                if self.rate > 0:
+                    delay = started + queued / self.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+    async def run(self) -> dict:
+        """
+        Runs the benchmark
+        :return: The measured values
+        """
+
+        server = FakeTelegram(global_rate=30, chat_rate=1) if self.rate_limit else FakeTelegram()
+        server.on_send = self._on_send
+        self._server = server
+        url = await server.start()
+
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+
+        with tempfile.TemporaryDirectory() as directory:
+            script = self._prepare(directory, server, url)
+            process = subprocess.Popen([sys.executable, script], cwd=os.path.dirname(script), env=env)
+
+            try:
+                await asyncio.wait_for(server.wait_polled(), self.startup)
+                memory_before = _rss(process.pid)
+
+                started = time.perf_counter()
+                await self._feed(server)
+
+                # Wait for the answers until all arrived or none arrived for a while, pressed buttons are queued as
+                # their messages arrive
+                while len(self._latencies) < self._queued and process.poll() is None:
+                    await asyncio.sleep(0.05)
+                    if time.perf_counter() - max(self._last_answer, started) > self.settle:
+                        break
+                memory_after = _rss(process.pid)
+            finally:
+                # Keep serving the bot while it shuts down, as it may still send or confirm the updates
+                if process.poll() is None:
+                    process.send_signal(signal.SIGINT)
+                    for _ in range(200):
+                        if process.poll() is not None:
+                            break
+                        await asyncio.sleep(0.05)
+                    else:
+                        process.kill()
+                        process.wait()
+                await server.stop()
+
+        latencies = sorted(self._latencies)
+        duration = (self._last_answer or time.perf_counter()) - started
+        return {
+            "updates": self._queued,
+            "answered": len(latencies),
+            "seconds": duration,
+            "updates_per_second": len(latencies) / duration if duration > 0 else 0,
+            "p50_latency": _percentile(latencies, 0.5),
+            "p99_latency": _percentile(latencies, 0.99),
+            "bytes_per_session": (memory_after - memory_before) / self.chats
+            if memory_before is not None and memory_after is not None else None,
+            "requests": dict(server.requests),
+            "uploads": server.uploads,
+            "flood_errors": server.flood_errors,
+        }
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m samt.simulator",
+                                     description="Measures a bot against a simulated Bot API with synthetic chats")
+    parser.add_argument("script", help="The bot script, with its config folder next to it")
+    parser.add_argument("--chats", type=int, default=1000, help="The number of users writing to the bot")
+    parser.add_argument("--messages", type=int, default=1, help="The number of messages every user writes")
+    parser.add_argument("--text", action="append", dest="texts",
+                        help="A text the users write, may be repeated. Defaults to /start")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="The updates queued per second, by default all are queued at once")
+    parser.add_argument("--settle", type=float, default=5,
+                        help="The seconds without an answer after which unanswered updates are given up")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Keep the bot's scheduler and let the simulator enforce telegram's flood control")
+    parser.add_argument("--workers", type=int, default=1, help="The number of processes handling the messages")
+    parser.add_argument("--press", action="store_true",
+                        help="Let the users press the first button of the inline keyboards they are sent")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.script, args.chats, args.messages, args.texts or ["/start"], args.rate, args.settle,
+                          rate_limit=args.rate_limit, workers=args.workers, press=args.press)
+    results = asyncio.run(benchmark.run())
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    def milliseconds(value: Optional[float]) -> str:
+        return f"{value * 1000:.1f} ms" if value is not None else "-"
+
+    print(f"Answered {results['answered']} of {results['updates']} updates in {results['seconds']:.2f} s")
+    print(f"Throughput:        {results['updates_per_second']:.1f} updates/s")
+    print(f"Latency p50 / p99: {milliseconds(results['p50_latency'])} / {milliseconds(results['p99_latency'])}")
+    if results["bytes_per_session"] is not None:
+        print(f"Memory:            {results['bytes_per_session'] / 1024:.1f} KiB per session")
+    print(f"Requests:          {', '.join(f'{name} {count}' for name, count in sorted(results['requests'].items()))}")
+    print(f"Uploads:           {results['uploads']}")
+    if args.rate_limit:
+        print(f"Flood errors:      {results['flood_errors']}")
+
+
+if __name__ == "__main__":
+    main()
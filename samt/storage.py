@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, Callable, Awaitable, Any, Set, Optional, Union
+
+from samt.metrics import Metrics, DisabledMetrics
+
+logger = logging.getLogger(__name__)
+
+# Values which cannot be changed without being set again
+_IMMUTABLE = (str, int, float, bool, bytes, tuple, frozenset, type(None))
+
+
+def _dumps(user: Hashable, value: Any, key: Hashable = None) -> Optional[str]:
+    """
+    Serializes a value to be written. A value which is not serializable, e.g. a datetime, is logged and left out, so it
+    does not keep the other users' storages from being written
+    :param user: The ID of the user the value belongs to
+    :param value: The value to serialize
+    :param key: The storage's key of the value or None for the whole storage
+    :return: The value as JSON or None, if it cannot be serialized
+    """
+
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError) as e:
+        logger.error(f"The storage of {user}{f' at {key!r}' if key is not None else ''} is not serializable as JSON "
+                     f"and was not written:\n\t{e!r}")
+        return None
+
+
+class TrackedDict(dict):
+    """
+    A dictionary which records the keys that were changed since the last write. As nested values like lists may be
+    changed in place, keys of mutable values count as changed as soon as they are read by key. Values reached by
+    iterating `values()` or `items()` are not tracked, so changing them in place has to be followed by setting the key
+    again
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty: Set[Hashable] = set()
+
+    def _read(self, key: Hashable, value: Any) -> Any:
+        if not isinstance(value, _IMMUTABLE):
+            self.dirty.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._read(key, super().__getitem__(key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.dirty.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.dirty.add(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.dirty.update(self.keys())
+        super().clear()
+
+    def pop_dirty(self) -> Set[Hashable]:
+        """
+        Returns the changed keys and resets them
+        :return: The keys changed since the last call, including removed ones
+        """
+
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+
+class Storage:
+    """
+    The interface of the persistent storage backends. All methods are coroutines, the backends shipped with this
+    framework perform their I/O on a separate thread to not block the event loop
+    """
+
+    def __init__(self):
+        # Database connections are usually bound to one thread, so all I/O is done by the same one
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, func: Callable, *args):
+        """
+        Executes the given function on the storage's thread
+        :param func: The function to execute
+        :param args: The arguments to pass
+        :return: The function's result
+        """
+
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def load(self, user: Hashable) -> dict:
+        """
+        Loads the storage of a single user
+        :param user: The user's ID
+        :return: The user's storage or an empty dictionary, if nothing is stored yet
+        """
+
+        raise NotImplementedError
+
+    async def update_many(self, batch: Dict[Hashable, dict], changed: Dict[Hashable, Set[Hashable]] = None) -> None:
+        """
+        Writes the storages of several users at once
+        :param batch: The storages keyed by the users' IDs
+        :param changed: The keys changed since the last write, keyed by the users' IDs. Backends may use them to only
+            write those fields, users without an entry are written completely
+        """
+
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """
+        Releases the underlying resources, after all pending I/O is done
+        """
+
+        self._executor.shutdown(wait=True)
+
+
+class SQLiteStorage(Storage):
+    """
+    A storage backend using a SQLite database with a table keyed by the user's ID and the storage's key, so single
+    fields can be written. The values are saved as JSON
+    """
+
+    def __init__(self, filename: str):
+        """
+        Opens or creates the database
+        :param filename: The name of the database file
+        """
+
+        super().__init__()
+
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS storage "
+                                 "(user INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                                 "PRIMARY KEY (user, key))")
+        self._connection.commit()
+
+    def _load(self, user: Hashable) -> dict:
+        rows = self._connection.execute("SELECT key, value FROM storage WHERE user = ?", (user,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def _update_many(self, cleared, deleted, rows) -> None:
+        with self._connection:
+            self._connection.executemany("DELETE FROM storage WHERE user = ?", cleared)
+            self._connection.executemany("DELETE FROM storage WHERE user = ? AND key = ?", deleted)
+            self._connection.executemany("INSERT OR REPLACE INTO storage (user, key, value) VALUES (?, ?, ?)", rows)
+
+    async def load(self, user: Hashable) -> dict:
+        return await self._run(self._load, user)
+
+    async def update_many(self, batch: Dict[Hashable, dict], changed: Dict[Hashable, Set[Hashable]] = None) -> None:
+        cleared, deleted, rows = [], [], []
+        changed = changed or dict()
+
+        # Serialize on the calling thread, as the storages may change while being written
+        for user, storage in batch.items():
+            keys = changed.get(user)
+
+            # Without knowing the changes, the whole storage is replaced
+            if keys is None:
+                cleared.append((user,))
+                keys = storage.keys()
+
+            # Each field is serialized on its own, so one which is not serializable only leaves out itself
+            for key in keys:
+                if key in storage:
+                    value = _dumps(user, dict.__getitem__(storage, key), key)
+                    if value is not None:
+                        rows.append((user, str(key), value))
+                else:
+                    deleted.append((user, str(key)))
+
+        await self._run(self._update_many, cleared, deleted, rows)
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        await super().close()
+
+
+class TinyDBStorage(Storage):
+    """
+    A storage backend using TinyDB, which keeps all users in one JSON document
+    """
+
+    def __init__(self, database: Union[str, Any]):
+        """
+        Opens or creates the database
+        :param database: The name of the database file or an open TinyDB database
+        """
+
+        super().__init__()
+
+        from tinydb import TinyDB, Query
+
+        self._database = database if isinstance(database, TinyDB) else TinyDB(database)
+        self._query = Query()
+
+    @staticmethod
+    def wraps(database: Any) -> bool:
+        """
+        Tests, if an object is an open TinyDB database, which this backend can use
+        :param database: The object to test
+        :return: If the object is a TinyDB database
+        """
+
+        try:
+            from tinydb import TinyDB
+        except ImportError:
+            return False
+        return isinstance(database, TinyDB)
+
+    def _load(self, user: Hashable) -> dict:
+        storage = self._database.search(self._query.user == user)
+
+        if len(storage) == 0:
+            self._database.insert({"user": user, "storage": {}})
+            return dict()
+        else:
+            return storage[0]["storage"]
+
+    def _update_many(self, batch: Dict[Hashable, dict]) -> None:
+        table = self._database.table(self._database.default_table_name)
+        found = set()
+
+        # TinyDB rewrites the whole file on every change, so all users are updated by a single write
+        def update(documents: Dict[int, dict]) -> None:
+            for doc_id, document in documents.items():
+                user = document.get("user")
+                if user in batch:
+                    documents[doc_id] = {"user": user, "storage": batch[user]}
+                    found.add(user)
+
+        table._update_table(update)
+
+        # Users are inserted when loaded, so missing ones are rare
+        missing = [{"user": user, "storage": storage} for user, storage in batch.items() if user not in found]
+        if len(missing) > 0:
+            table.insert_multiple(missing)
+
+    async def load(self, user: Hashable) -> dict:
+        return await self._run(self._load, user)
+
+    async def update_many(self, batch: Dict[Hashable, dict], changed: Dict[Hashable, Set[Hashable]] = None) -> None:
+
+        # TinyDB rewrites the whole file anyway, so the changed keys are of no use
+        # Copy on the calling thread, as the storages may change while being written. Users whose storage is not
+        # serializable are left out, so the others are written
+        serialized = {user: _dumps(user, dict(storage)) for user, storage in batch.items()}
+        batch = {user: json.loads(value) for user, value in serialized.items() if value is not None}
+        await self._run(self._update_many, batch)
+
+    async def close(self) -> None:
+        await self._run(self._database.close)
+        await super().close()
+
+
+class WriteBehind:
+    """
+    Collects the storages of changed sessions and writes them in batches. Multiple changes of the same session
+    between two flushes result in a single write, storages which did not change are not written at all
+    """
+
+    def __init__(self, write: Callable[[Dict[Hashable, dict], Dict[Hashable, Set[Hashable]]], Awaitable],
+                 metrics: Union[Metrics, DisabledMetrics] = None):
+        """
+        :param write: The coroutine function writing a batch of storages and their changed keys, both keyed by the
+            users' IDs
+        :param metrics: The metrics to count the performed and skipped writes in
+        """
+
+        self._write = write
+        self.metrics = metrics if metrics is not None else DisabledMetrics()
+        self._dirty: Dict[Hashable, dict] = dict()
+        self._writing: Dict[Hashable, dict] = dict()
+
+        # Flushes run one after another, so a flush returns only after all earlier changes are written
+        self._lock = asyncio.Lock()
+
+        # Counters to judge how many writes are saved
+        self.performed = 0
+        self.skipped = 0
+
+    def mark_dirty(self, user: Hashable, storage: dict) -> None:
+        """
+        Schedules the storage of a user to be written with the next flush, if it has changed
+        :param user: The user's ID
+        :param storage: The user's storage
+        """
+
+        if isinstance(storage, TrackedDict) and len(storage.dirty) == 0:
+            return
+
+        self._dirty[user] = storage
+
+    def count_update(self, user: Hashable) -> None:
+        """
+        Counts a processed update as skipped write, if it did not change the user's storage. It is called once per
+        update, while the storage may be marked several times
+        :param user: The user's ID
+        """
+
+        if user not in self._dirty:
+            self.skipped += 1
+            self.metrics.count("storage_writes_skipped_total")
+
+    def pending(self, user: Hashable) -> Optional[dict]:
+        """
+        Looks up a storage which has not been written completely yet
+        :param user: The user's ID
+        :return: The storage or None, if it is not pending
+        """
+
+        storage = self._dirty.get(user)
+        return storage if storage is not None else self._writing.get(user)
+
+    def __len__(self):
+        return len(self._dirty)
+
+    async def flush(self) -> None:
+        """
+        Writes all pending storages. If the writing fails, they are kept for the next flush
+        """
+
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if len(self._dirty) == 0:
+            return
+
+        batch, self._dirty = self._dirty, dict()
+        changed = {user: storage.pop_dirty() for user, storage in batch.items() if isinstance(storage, TrackedDict)}
+        self._writing = batch
+
+        try:
+            await self._write(batch, changed)
+        except Exception:
+
+            # Keep the failed storages and their changes for the next try
+            for user, storage in batch.items():
+                self._dirty.setdefault(user, storage)
+                if user in changed:
+                    storage.dirty |= changed[user]
+            raise
+        finally:
+            self._writing = dict()
+
+        self.performed += len(batch)
+        self.metrics.count("storage_writes_total", len(batch))
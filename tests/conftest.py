@@ -0,0 +1,139 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+from typing import Dict, Any, Optional, Tuple
+
+import pytest
+import toml
+
+from samt.simulator import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class BotProcess(object):
+    """
+    Runs a bot script in a process of its own against a FakeTelegram, which records everything the bot sends
+    """
+
+    def __init__(self, directory: str, source: str, config: Dict[str, Dict[str, Any]] = None):
+        """
+        :param directory: The directory to place the script and its configuration in
+        :param source: The source of the script, which creates the bot as `bot` and calls `bot.listen()`
+        :param config: The configuration sections, the token and the simulator's URL are added
+        """
+
+        self.directory = directory
+        self.source = textwrap.dedent(source)
+        self.config = config or dict()
+        self.server = FakeTelegram()
+        self.sent: Optional[asyncio.Queue] = None
+        self.process: Optional[subprocess.Popen] = None
+
+    def _on_send(self, method: str, params: dict, sent: dict) -> None:
+        self.sent.put_nowait((method, params))
+
+    async def start(self) -> "BotProcess":
+        """
+        Writes the script and its configuration, starts it and waits until it polls
+        """
+
+        url = await self.server.start("127.0.0.1")
+        self.sent = asyncio.Queue()
+        self.server.on_send = self._on_send
+
+        config = {section: dict(values) for section, values in self.config.items()}
+        config.setdefault("general", dict()).setdefault("logging", "error")
+        bot = config.setdefault("bot", dict())
+        bot.update(token=self.server.token, api_url=url)
+        bot.setdefault("rate_limit", False)
+
+        os.makedirs(os.path.join(self.directory, "config"), exist_ok=True)
+        with open(os.path.join(self.directory, "config", "config.toml"), "w") as file:
+            toml.dump(config, file)
+        with open(os.path.join(self.directory, "bot.py"), "w") as file:
+            file.write(self.source)
+
+        await self.restart()
+        return self
+
+    async def restart(self) -> None:
+        """
+        Starts the script again, after it was stopped
+        """
+
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+        self.process = subprocess.Popen([sys.executable, "bot.py"], cwd=self.directory, env=environment,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server._polled.clear()
+        await asyncio.wait_for(self.server.wait_polled(), 30)
+
+    async def stop(self, sig: int = signal.SIGINT) -> int:
+        """
+        Stops the script and waits for it to exit
+        :param sig: The signal to send
+        :return: The exit code
+        """
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(sig)
+            for _ in range(200):
+                if self.process.poll() is not None:
+                    break
+                await asyncio.sleep(0.05)
+            else:
+                self.process.kill()
+        return self.process.wait()
+
+    async def close(self) -> None:
+        await self.stop()
+        await self.server.stop()
+
+    async def receive(self, timeout: float = 10) -> Tuple[str, dict]:
+        """
+        Waits for the next request the bot sends
+        :return: The method and the parameters
+        """
+
+        return await asyncio.wait_for(self.sent.get(), timeout)
+
+    async def ask(self, text: str, chat_id: int = 1, timeout: float = 10) -> str:
+        """
+        Writes a message and waits for the answer's text
+        """
+
+        self.server.push_message(chat_id, text)
+        method, params = await self.receive(timeout)
+        return params.get("text")
+
+    async def ask_media(self, text: str, chat_id: int = 1, timeout: float = 10) -> dict:
+        """
+        Writes a message and waits for the answer's parameters, which contain uploads as form fields
+        """
+
+        self.server.push_message(chat_id, text)
+        method, params = await self.receive(timeout)
+        return params
+
+
+@pytest.fixture
+def run_bot(tmp_path):
+    """
+    Runs a coroutine function receiving a started BotProcess, which is stopped afterwards
+    """
+
+    def run(source: str, config: Dict[str, Dict[str, Any]] = None, test=None):
+        async def main():
+            bot = BotProcess(str(tmp_path), source, config)
+            await bot.start()
+            try:
+                return await test(bot)
+            finally:
+                await bot.close()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from samt.bot import (BadRequest, Conflict, Forbidden, LowerBot, NetworkError, NotFound, RetryAfter, ServerError,
+                      TelegramError, Unauthorized, _error)
+from samt.simulator import FakeTelegram
+
+
+@pytest.mark.parametrize("error_code, error_type", [(400, BadRequest), (401, Unauthorized), (403, Forbidden),
+                                                     (404, NotFound), (409, Conflict), (429, RetryAfter),
+                                                     (502, ServerError), (418, TelegramError)])
+def test_errors_are_mapped_by_their_code(error_code, error_type):
+    error = _error(error_code, "description")
+    assert type(error) is error_type
+    assert (error.description, error.error_code) == ("description", error_code)
+
+
+def test_requests_raise_the_mapped_errors():
+    async def test():
+        server = FakeTelegram()
+        url = await server.start()
+        bot, wrong = LowerBot(server.token, url), LowerBot("wrong", url)
+        try:
+            server.fail("sendMessage", 429, "Too Many Requests: retry after 3", retry_after=3)
+            with pytest.raises(RetryAfter) as error:
+                await bot.send_message(1, "hi")
+            assert error.value.retry_after == 3
+
+            server.fail("sendMessage", 403, "Forbidden: bot was blocked by the user")
+            with pytest.raises(Forbidden):
+                await bot.send_message(1, "hi")
+
+            with pytest.raises(Unauthorized):
+                await wrong.get_me()
+        finally:
+            await bot.close()
+            await wrong.close()
+            await server.stop()
+
+        # The stopped server cannot be reached anymore
+        with pytest.raises(NetworkError):
+            await bot.get_me()
+        await bot.close()
+
+    asyncio.run(test())
+
+
+def test_updates_are_confirmed_only_once_processed():
+    async def test():
+        bot = LowerBot("token")
+        updates, requested = [{"update_id": 1}, {"update_id": 2}], []
+        processed = None
+
+        async def get_updates(offset, limit, timeout, allowed_updates):
+            # Telegram returns the updates from the offset on, until they are confirmed
+            requested.append(offset)
+            return [update for update in updates if offset is None or update['update_id'] >= offset]
+
+        bot.get_updates = get_updates
+        received = bot.updates(prefetch=False, confirmed=lambda: processed)
+        assert [(await received.__anext__())['update_id'] for _ in range(2)] == [1, 2]
+
+        # Nothing is confirmed while no update is processed, the updates received again are skipped
+        updates.append({"update_id": 3})
+        assert (await received.__anext__())['update_id'] == 3
+        assert set(requested) == {None}
+
+        processed = 1
+        updates.append({"update_id": 4})
+        assert (await received.__anext__())['update_id'] == 4
+        assert requested[-1] == 2
+        await received.aclose()
+
+    asyncio.run(test())
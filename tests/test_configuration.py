@@ -0,0 +1,50 @@
+import os
+
+import toml
+
+RELOAD = """
+    from samt import Bot
+    from samt.samt import _config_value
+
+    bot = Bot()
+
+
+    @bot.answer("/reload")
+    def reload():
+        bot.reload_configuration()
+        return "reloaded"
+
+
+    @bot.answer("/value")
+    def value():
+        return str(_config_value("custom", "value"))
+
+
+    @bot.answer("/fail")
+    def fail():
+        raise RuntimeError("failed")
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_failed_reload_keeps_the_previous_configuration(run_bot, tmp_path):
+    async def test(bot):
+        assert await bot.ask("/value") == "1"
+
+        # The new configuration is readable, but its snapshot cannot be taken, as the allowed IDs are no list
+        filename = os.path.join(tmp_path, "config", "config.toml")
+        config = toml.load(filename)
+        config["custom"]["value"] = 2
+        config["bot"]["error_reply"] = "new"
+        config["general"]["allowed_ids"] = 5
+        with open(filename, "w") as file:
+            toml.dump(config, file)
+
+        assert await bot.ask("/reload") == "reloaded"
+        assert await bot.ask("/value") == "1"
+        assert await bot.ask("/fail") == "old"
+
+    run_bot(RELOAD, {"bot": {"error_reply": "old"}, "custom": {"value": 1}}, test)
@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+from samt.samt import _Session
+from samt.storage import TrackedDict
+
+CONVERSATION = """
+    from samt import Bot, Conversation
+
+    bot = Bot()
+    order = Conversation("order")
+
+
+    @bot.answer("/order")
+    def start():
+        return order.start("size", "Which size?")
+
+
+    @order.step("size")
+    def size(text, data):
+        data["size"] = text
+        return order.goto("address", "Where to?")
+
+
+    @order.step("address")
+    def address(text, data):
+        if text == "nowhere":
+            raise ValueError(text)
+        return order.end(f"{data['size']} to {text}")
+
+
+    @bot.answer("/greet")
+    @bot.ensure_parameter("name", "Who?")
+    def greet(name):
+        return f"Hello {name}"
+
+
+    @bot.default_answer
+    def default():
+        return "default"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+PERSISTENT = {"general": {"persistent_storage": True}, "bot": {"max_sessions": 1, "error_reply": "oops"}}
+
+
+def test_conversations_survive_eviction_and_restarts(run_bot):
+    async def test(bot):
+        assert await bot.ask("/order") == "Which size?"
+
+        # The session is evicted by the one of another chat
+        assert await bot.ask("/order", chat_id=2) == "Which size?"
+        assert await bot.ask("large") == "Where to?"
+
+        await bot.stop()
+        await bot.restart()
+        assert await bot.ask("home") == "large to home"
+        assert await bot.ask("home") == "default"
+
+    run_bot(CONVERSATION, PERSISTENT, test)
+
+
+def test_ensure_parameter_asks_by_a_stored_conversation(run_bot):
+    async def test(bot):
+        assert await bot.ask("/greet") == "Who?"
+
+        await bot.stop()
+        await bot.restart()
+        assert await bot.ask("Ada") == "Hello Ada"
+        assert await bot.ask("Ada") == "default"
+
+    run_bot(CONVERSATION, PERSISTENT, test)
+
+
+def test_unknown_steps_are_dropped(run_bot, tmp_path):
+    async def test(bot):
+        assert await bot.ask("/order") == "Which size?"
+        assert await bot.ask("large") == "Where to?"
+
+        # The bot is updated and the step the user is at does not exist anymore
+        await bot.stop()
+        (tmp_path / "bot.py").write_text(bot.source.replace('@order.step("address")', '@order.step("street")'))
+        await bot.restart()
+        assert await bot.ask("home") == "default"
+
+    run_bot(CONVERSATION, PERSISTENT, test)
+
+
+def test_failing_steps_end_the_conversation(run_bot):
+    async def test(bot):
+        assert await bot.ask("/order") == "Which size?"
+        assert await bot.ask("large") == "Where to?"
+        assert await bot.ask("nowhere") == "oops"
+        assert await bot.ask("home") == "default"
+
+    run_bot(CONVERSATION, PERSISTENT, test)
+
+
+def test_leaving_without_a_conversation_does_not_mark_the_storage():
+    session = SimpleNamespace(storage=TrackedDict({"name": "alice"}))
+
+    _Session.leave_conversation(session)
+    assert session.storage.pop_dirty() == set()
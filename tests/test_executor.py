@@ -0,0 +1,85 @@
+import pytest
+
+PROCESS = """
+    from multiprocessing import current_process
+
+    from samt import Bot, Conversation
+
+    bot = Bot()
+    bot.access_checker["anyone"] = lambda: True
+    order = Conversation("order")
+
+
+    @bot.answer("/order")
+    def start_order():
+        return order.start("item", "What?", items=[])
+
+
+    @order.step("item")
+    def item(text, data):
+        if text == "done":
+            return order.end(", ".join(data["items"]))
+        data["items"].append(text)
+        data["count"] = len(data["items"])
+        return f"{data['count']} items"
+
+
+    @bot.answer("/where")
+    def where():
+        return current_process().name
+
+
+    @bot.answer("/resources")
+    def resources():
+        from samt.samt import _Session, Answer
+        return f"{_Session.database is None} {Answer.media_cache is None} {Bot._log_handler is None}"
+
+
+    @bot.answer("/guarded")
+    @bot.access_level("anyone")
+    def guarded():
+        return "guarded"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_process_steps_change_the_conversation_data(run_bot):
+    async def test(bot):
+        assert await bot.ask("/where") != "MainProcess"
+        assert await bot.ask("/order") == "What?"
+        assert await bot.ask("tea") == "1 items"
+        assert await bot.ask("cake") == "2 items"
+        assert await bot.ask("done") == "tea, cake"
+
+    run_bot(PROCESS, {"bot": {"executor": "process", "handler_processes": 1}}, test)
+
+
+def test_wrapped_handlers_run_by_threads_instead_of_processes(run_bot):
+    async def test(bot):
+        assert await bot.ask("/guarded") == "guarded"
+
+    run_bot(PROCESS, {"bot": {"executor": "process", "handler_processes": 1}}, test)
+
+
+def test_wrapped_handlers_cannot_be_run_by_processes():
+    from samt import Bot
+
+    bot = Bot.__new__(Bot)
+    bot.access_checker = dict()
+
+    with pytest.raises(ValueError, match="cannot be run by a process"):
+        @Bot.answer("/wrapped", executor="process")
+        @bot.access_level("anyone")
+        def wrapped():
+            return "wrapped"
+
+
+def test_pool_processes_neither_open_the_storage_nor_write_the_log(run_bot):
+    async def test(bot):
+        assert await bot.ask("/resources") == "True True True"
+
+    run_bot(PROCESS, {"bot": {"executor": "process", "handler_processes": 1},
+                      "general": {"persistent_storage": True, "storage_backend": "sqlite"}}, test)
@@ -0,0 +1,94 @@
+import re
+from datetime import datetime
+
+from samt.helper import LRUCache, Message, ParsingDict, RegExDict, Sticker, User, deep_sizeof
+
+
+def test_compiled_routes_keep_registration_priority():
+    routes = RegExDict(cache_size=0)
+    routes[r"/order (?P<amount>\d+)"] = "order"
+    routes[r"/order (?P<amount>\w+)"] = "clashing"
+    routes[r"/(\w+) \1"] = "backref"
+    routes[r"/.*"] = "fallback"
+
+    value, match = routes["/order 42"]
+    assert (value, match.group("amount")) == ("order", "42")
+    assert routes["/order tea"][0] == "clashing"
+    assert routes["/echo echo"][0] == "backref"
+    assert routes["/echo"][0] == "fallback"
+    assert routes.lookup("nothing") is None
+
+
+def test_routes_keep_their_flags():
+    routes = RegExDict(cache_size=0)
+    routes[re.compile(r"/hello", re.IGNORECASE)] = "hello"
+    routes[re.compile(r"/lines .+", re.DOTALL)] = "lines"
+
+    assert routes["/HeLLo"][0] == "hello"
+    assert routes["/lines a\nb"][0] == "lines"
+
+
+def test_routes_are_bucketed_by_their_literal_prefix():
+    routes = RegExDict()
+    for index in range(500):
+        routes[rf"/command{index} (?P<value{index}>\d+)"] = index
+    routes[r"(?:/command|/other)\d+"] = "any"
+    routes.compile()
+
+    value, match = routes["/command499 7"]
+    assert (value, match.group("value499")) == (499, "7")
+    assert routes["/command5"][0] == "any"
+
+    # Only the route with the matching prefix and the one without a prefix are tested
+    assert list(routes._merged) == [(499, 500), (500,)]
+    assert RegExDict._literal_prefix(re.compile(r"^/a\.b+c")) == "/a.b"
+    assert RegExDict._literal_prefix(re.compile(r"/ab?")) == "/a"
+    assert RegExDict._literal_prefix(re.compile(r"/a|/b")) == ""
+
+
+def test_lru_cache_discards_the_least_recently_used_entries():
+    cache = LRUCache(2)
+    cache["a"], cache["b"] = 1, 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_route_lookups_are_cached_until_a_route_is_added():
+    for routes, pattern in ((RegExDict(), r"/order (?P<amount>\d+)"), (ParsingDict(), "/order {amount:d}")):
+        assert routes.lookup("/order 42") is None
+        assert routes.lookup("/order 42") is None
+        assert (routes.cache.hits, routes.cache.misses) == (1, 1)
+
+        # The cached miss is forgotten, once the route is registered
+        routes[pattern] = "order"
+        value, match = routes.lookup("/order 42")
+        assert (value, int(match["amount"])) == ("order", 42)
+        assert routes.lookup("/order 42")[1] is match
+        assert (routes.cache.hits, routes.cache.misses) == (2, 2)
+
+
+def test_wrappers_read_the_update_on_access():
+    user = User({"id": 1, "is_bot": False, "first_name": "Ada"})
+    assert (user.id, user.first_name, user.last_name, user.username, user.language_code) == (1, "Ada", "", "", "")
+    assert not hasattr(user, "__dict__")
+
+    sticker = Sticker({"emoji": "x", "file_id": "id", "file_size": 3, "height": 512, "set_name": "set"})
+    assert (sticker.emoji, sticker.file_id, sticker.height) == ("x", "id", 512)
+    assert not hasattr(sticker, "__dict__")
+
+
+def test_message_dates_are_decoded_once_when_used():
+    update = {"message_id": 5, "date": 1700000000, "text": "hi"}
+    message = Message(update)
+    assert (message.id, message.text, message._date) == (5, "hi", None)
+
+    assert message.date == datetime.fromtimestamp(1700000000)
+    assert message.date is message.date
+    assert Message({"message_id": 6, "date": 0}).text is None
+
+    # The slots are measured with the update they refer to
+    assert deep_sizeof(message) > deep_sizeof(update)
@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+from samt.ingest import Ingest, Checkpoint
+
+ECHO = """
+    from samt import Bot, Context
+
+    bot = Bot()
+
+
+    @bot.default_answer
+    def echo():
+        return Context.get('message').text
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def _run(updates, **kwargs):
+    dispatched = []
+
+    async def main():
+        ingest = Ingest(lambda update, done: (dispatched.append(update['update_id']), done()), **kwargs)
+        ingest.start()
+        for update_id in updates:
+            await ingest.put({"update_id": update_id})
+        await asyncio.sleep(0.01)
+        await ingest.drain(1)
+        return ingest
+
+    return asyncio.run(main()), dispatched
+
+
+def test_out_of_order_updates_are_dispatched():
+    ingest, dispatched = _run([11, 10, 12])
+    assert dispatched == [11, 10, 12]
+    assert ingest.processed == 12
+
+
+def test_redelivered_updates_are_dropped():
+    ingest, dispatched = _run([11, 12, 11, 13, 12])
+    assert dispatched == [11, 12, 13]
+    assert ingest.dropped == 0
+
+
+def test_checkpoint_drops_only_recent_ids():
+    ingest, dispatched = _run([99, 100, 101, 7], processed=100, window=50)
+    assert dispatched == [101, 7]
+
+
+def test_corrupt_checkpoint_is_ignored(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    assert checkpoint.load() is None
+
+    for content in ('{"update_id": 1', '[]', '{"update_id": "x"}', ''):
+        (tmp_path / "checkpoint.json").write_text(content)
+        assert checkpoint.load() is None
+
+    assert checkpoint.write(5)
+    assert Checkpoint(checkpoint.filename).load() == 5
+
+
+def test_rejected_token_shuts_the_bot_down(run_bot, tmp_path):
+    async def test(bot):
+        assert await bot.ask("hello") == "hello"
+
+        # The next poll is rejected, as if the token was revoked
+        bot.server.fail("getUpdates", 401, "Unauthorized")
+        for _ in range(100):
+            if bot.process.poll() is not None:
+                break
+            await asyncio.sleep(0.1)
+
+        assert bot.process.poll() == 1
+        with open(os.path.join(tmp_path, "Bot.log")) as file:
+            assert "please check the token" in file.read()
+
+    run_bot(ECHO, {"bot": {"poll_timeout": 1}}, test)
+
@@ -0,0 +1,28 @@
+import json
+
+from samt.samt import Keyboard
+
+
+def test_keyboards_are_built_once_per_layout():
+    keyboard = Keyboard.of([["Yes", "No"]])
+    assert Keyboard.of([["Yes", "No"]]) is keyboard
+    assert Keyboard.of(keyboard) is keyboard
+    assert Keyboard.of([["Yes", "No"]], inline=True) is not keyboard
+    assert json.loads(keyboard.markup) == {"keyboard": [[{"text": "Yes"}, {"text": "No"}]], "one_time_keyboard": True}
+
+
+def test_inline_buttons_with_callback_data_are_cached_apart_from_rows():
+    row = Keyboard.of([["Yes", "No"]], inline=True)
+    button = Keyboard.of([("Yes", "No")], inline=True)
+
+    assert json.loads(row.markup) == {"inline_keyboard": [[{"text": "Yes", "callback_data": "Yes"},
+                                                           {"text": "No", "callback_data": "No"}]]}
+    assert json.loads(button.markup) == {"inline_keyboard": [[{"text": "Yes", "callback_data": "No"}]]}
+
+
+def test_unhashable_layouts_are_built_without_the_cache():
+    size = len(Keyboard.cache)
+    buttons = [[{"text": "Yes"}]]
+
+    assert Keyboard.of(buttons) is not Keyboard.of(buttons)
+    assert len(Keyboard.cache) == size
@@ -0,0 +1,79 @@
+import asyncio
+
+import toml
+
+GREETER = """
+    from samt import Bot, Context
+
+    bot = Bot()
+
+
+    @bot.answer("/hello")
+    def hello():
+        return "hello", Context.get('user').first_name
+
+
+    @bot.answer("/bye")
+    def bye():
+        return "bye"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+LANGUAGE = {
+    "default": {"hello": "Hello {}", "bye": "Bye"},
+    "de": {"hello": "Hallo {}", "bye": "Tschüss"},
+    "de_at": {"hello": "Servus {}"},
+}
+
+
+def test_answers_are_rendered_by_the_catalog_with_fallbacks(run_bot, tmp_path):
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "lang.toml").write_text(toml.dumps(LANGUAGE))
+
+    async def ask(bot, text, language_code):
+        # The user is kept by the session, so every language is spoken in a chat of its own
+        bot.server.push_message(["de-AT", "de", "en-GB"].index(language_code) + 1, text, first_name="Ada", language_code=language_code)
+        method, params = await asyncio.wait_for(bot.sent.get(), 10)
+        return params["text"]
+
+    async def test(bot):
+        assert await ask(bot, "/hello", "de-AT") == "Servus Ada"
+        assert await ask(bot, "/bye", "de-AT") == "Tschüss"
+        assert await ask(bot, "/hello", "de") == "Hallo Ada"
+        assert await ask(bot, "/bye", "en-GB") == "Bye"
+
+    run_bot(GREETER, {"bot": {"language_feature": True}}, test)
+
+
+BROADCAST = """
+    from samt import Bot, Answer, User
+
+    bot = Bot()
+
+
+    @bot.answer("/broadcast")
+    async def broadcast():
+        receivers = [2, User({"id": 3, "first_name": "User", "language_code": "de"})]
+        report = await bot.broadcast(Answer("bye"), receivers, concurrency=1)
+        return f"{report.sent} sent"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_broadcasts_to_ids_use_the_default_language(run_bot, tmp_path):
+    (tmp_path / "config").mkdir()
+    (tmp_path / "config" / "lang.toml").write_text(toml.dumps(dict(LANGUAGE, en={"bye": "Goodbye"})))
+
+    async def test(bot):
+        bot.server.push_message(1, "/broadcast")
+        sent = [(await bot.receive())[1] for _ in range(3)]
+        assert [(params["chat_id"], params["text"]) for params in sent] == [("2", "Bye"), ("3", "Tschüss"),
+                                                                           ("1", "2 sent")]
+
+    run_bot(BROADCAST, {"bot": {"language_feature": True}}, test)
@@ -0,0 +1,23 @@
+import logging
+
+from samt.log import DroppingQueueHandler
+
+
+def test_overflowing_records_are_dropped_and_reported():
+    handler = DroppingQueueHandler(maxsize=2)
+    logger = logging.getLogger("samt.test_log")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for index in range(5):
+            logger.warning("record %d", index)
+        assert handler.dropped == 3
+        assert [handler.queue.get_nowait().getMessage() for _ in range(2)] == ["record 0", "record 1"]
+
+        # The number of dropped records is written in front of the next one, which fits
+        logger.warning("record 5")
+        assert [handler.queue.get_nowait().getMessage() for _ in range(2)] == [
+            "3 log records were dropped, as they could not be written fast enough", "record 5"]
+        assert handler.queue.empty()
+    finally:
+        logger.removeHandler(handler)
@@ -0,0 +1,79 @@
+import asyncio
+import os
+
+from samt.helper import Media
+from samt.media import MediaCache
+
+PHOTO = """
+    import os
+    from samt import Bot, Answer, Media
+
+    bot = Bot()
+    PHOTO = os.path.join(os.path.dirname(os.path.realpath(__file__)), "photo.png")
+
+
+    @bot.answer("/photo")
+    def photo():
+        return Answer(media_type=Media.PHOTO, media=PHOTO)
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_cached_file_id_is_kept_on_errors_other_than_bad_request(run_bot, tmp_path):
+    with open(os.path.join(tmp_path, "photo.png"), "wb") as file:
+        file.write(b"\x89PNG not really")
+
+    async def test(bot):
+        assert not isinstance((await bot.ask_media("/photo"))["photo"], str)
+        assert bot.server.uploads == 1
+
+        # The flood control fails the answer, but the file ID stays valid
+        bot.server.fail("sendPhoto", 429, "Too Many Requests", retry_after=0)
+        bot.server.push_message(1, "/photo")
+        await asyncio.sleep(0.5)
+        assert (await bot.ask_media("/photo"))["photo"] == "simulated-1"
+        assert bot.server.uploads == 1
+
+        # A rejected file ID is replaced by uploading the file again
+        bot.server.fail("sendPhoto", 400, "Bad Request: wrong file identifier")
+        assert not isinstance((await bot.ask_media("/photo"))["photo"], str)
+        assert bot.server.uploads == 2
+        assert (await bot.ask_media("/photo"))["photo"] == "simulated-2"
+
+    run_bot(PHOTO, {}, test)
+
+
+def test_processes_sharing_the_media_cache_keep_each_others_files(tmp_path):
+    photo, document = os.path.join(tmp_path, "photo.png"), os.path.join(tmp_path, "document.txt")
+    for filename in (photo, document):
+        with open(filename, "wb") as file:
+            file.write(b"content")
+
+    filename = os.path.join(tmp_path, "media_cache.json")
+    first, second = MediaCache(filename), MediaCache(filename)
+    first.put(Media.PHOTO, photo, {"photo": [{"file_id": "small"}, {"file_id": "photo-id"}]})
+    second.put(Media.DOCUMENT, document, {"document": {"file_id": "document-id"}})
+
+    cache = MediaCache(filename)
+    assert cache.get(Media.PHOTO, photo) == "photo-id"
+    assert cache.get(Media.DOCUMENT, document) == "document-id"
+
+
+def test_discarded_files_are_not_adopted_from_the_file_again(tmp_path):
+    photo, document = os.path.join(tmp_path, "photo.png"), os.path.join(tmp_path, "document.txt")
+    for filename in (photo, document):
+        with open(filename, "wb") as file:
+            file.write(b"content")
+
+    filename = os.path.join(tmp_path, "media_cache.json")
+    cache = MediaCache(filename)
+    cache.put(Media.PHOTO, photo, {"photo": [{"file_id": "photo-id"}]})
+    cache.discard(Media.PHOTO, photo)
+    cache.put(Media.DOCUMENT, document, {"document": {"file_id": "document-id"}})
+
+    assert cache.get(Media.PHOTO, photo) is None
+    assert MediaCache(filename).get(Media.PHOTO, photo) is None
+    assert MediaCache(filename).get(Media.DOCUMENT, document) == "document-id"
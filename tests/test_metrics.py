@@ -0,0 +1,54 @@
+import socket
+
+import aiohttp
+
+GUARDED = """
+    from samt import Bot
+
+    bot = Bot()
+    bot.access_checker["anyone"] = lambda: True
+
+
+    @bot.answer("/fast")
+    @bot.access_level("anyone")
+    def fast():
+        return "fast"
+
+
+    @bot.answer("/slow")
+    @bot.access_level("anyone")
+    def slow():
+        return "slow"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_guarded_routes_are_labelled_apart(run_bot):
+    port = _free_port()
+
+    async def test(bot):
+        assert await bot.ask("/fast") == "fast"
+        assert await bot.ask("/slow") == "slow"
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                metrics = await response.text()
+
+        assert 'route="/fast"' in metrics
+        assert 'route="/slow"' in metrics
+        assert "/fast | /slow" not in metrics
+
+        # The sessions are measured when scraped
+        size = next(line for line in metrics.splitlines() if line.startswith("samt_bytes_per_session "))
+        assert float(size.split()[1]) > 0
+
+    run_bot(GUARDED, {"metrics": {"enabled": True, "port": port}}, test)
@@ -0,0 +1,35 @@
+SESSIONS = """
+    import asyncio
+    from samt import Bot, Context
+
+    bot = Bot()
+
+
+    @bot.answer("/slow")
+    async def slow():
+        Context.set("value", 1)
+        await asyncio.sleep(0.5)
+        return "slow"
+
+
+    @bot.answer("/get")
+    def get_value():
+        return str(Context.get("value"))
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_busy_sessions_are_not_evicted(run_bot):
+    async def test(bot):
+        bot.server.push_message(1, "/slow")
+        assert await bot.ask("/get", chat_id=2) == "None"
+        method, params = await bot.receive()
+        assert (params["chat_id"], params["text"]) == ("1", "slow")
+
+        # The idle session of the second chat is evicted instead
+        assert await bot.ask("/get", chat_id=1) == "1"
+
+    run_bot(SESSIONS, {"bot": {"max_sessions": 1}}, test)
@@ -0,0 +1,39 @@
+import asyncio
+import os
+
+ECHO = """
+    import logging
+
+    from samt import Bot, Context
+
+    bot = Bot()
+
+
+    @bot.answer("/handlers")
+    def handlers():
+        return ", ".join(type(handler).__name__ for handler in logging.getLogger("samt.samt").handlers)
+
+
+    @bot.default_answer
+    def echo():
+        return Context.get('message').text
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_workers_hand_their_log_records_to_the_main_process(run_bot, tmp_path):
+    async def test(bot):
+        assert await bot.ask("hello", chat_id=1) == "hello"
+        assert await bot.ask("hello", chat_id=2) == "hello"
+        assert await bot.ask("/handlers") == "QueueHandler"
+        await asyncio.sleep(0.5)
+
+        with open(os.path.join(tmp_path, "Bot.log")) as file:
+            log = file.read()
+        assert "Worker 0 started" in log
+        assert "Worker 1 started" in log
+
+    run_bot(ECHO, {"bot": {"workers": 2}, "general": {"logging": "info"}}, test)
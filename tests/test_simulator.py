@@ -0,0 +1,35 @@
+import asyncio
+import os
+
+from samt.simulator import Benchmark
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "examples")
+
+
+def test_scheduler_sustains_the_global_rate_without_flood_errors():
+    benchmark = Benchmark(os.path.join(EXAMPLES, "00 echo", "Echo.py"), chats=120, rate_limit=True)
+    results = asyncio.run(benchmark.run())
+
+    assert results["answered"] == 120
+    assert results["flood_errors"] == 0
+    assert 25 <= results["updates_per_second"] <= 31
+
+
+def test_pressed_inline_buttons_are_answered_and_replaced():
+    benchmark = Benchmark(os.path.join(EXAMPLES, "06 inline keyboard", "InlineBot.py"), chats=20, texts=["/Query"],
+                          press=True)
+    results = asyncio.run(benchmark.run())
+
+    assert (results["updates"], results["answered"]) == (40, 40)
+    assert results["requests"]["answerCallbackQuery"] == 20
+    assert results["requests"]["editMessageText"] == 20
+
+
+def test_local_media_is_uploaded_once_and_sent_by_its_file_id():
+    benchmark = Benchmark(os.path.join(EXAMPLES, "02 media", "MediaBot.py"), chats=1, messages=3, texts=["Get me!"],
+                          rate=5)
+    results = asyncio.run(benchmark.run())
+
+    assert results["answered"] == 3
+    assert results["requests"]["sendDocument"] == 3
+    assert results["uploads"] == 1
@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import os
+
+import pytest
+
+from samt.metrics import Metrics
+from samt.storage import SQLiteStorage, TinyDBStorage, TrackedDict, WriteBehind
+
+
+@pytest.mark.parametrize("backend", [SQLiteStorage, TinyDBStorage])
+def test_unserializable_storage_does_not_block_the_batch(tmp_path, backend):
+    async def test():
+        database = backend(str(tmp_path / "storage.db"))
+        write_behind = WriteBehind(database.update_many)
+
+        good, bad = TrackedDict(), TrackedDict()
+        good.update(name="alice")
+        bad.update(name="bob", since=datetime.datetime.now())
+        write_behind.mark_dirty(1, good)
+        write_behind.mark_dirty(2, bad)
+        await write_behind.flush()
+
+        assert len(write_behind) == 0
+        assert await database.load(1) == {"name": "alice"}
+        assert (await database.load(2)).get("since") is None
+        await database.close()
+
+    asyncio.run(test())
+
+
+def test_skipped_writes_are_counted_once_per_update():
+    async def test():
+        written = []
+
+        async def write(batch, changed):
+            written.extend(batch)
+
+        metrics = Metrics()
+        write_behind = WriteBehind(write, metrics)
+        storage = TrackedDict()
+
+        # An unchanged storage is marked several times while processing an update
+        for _ in range(3):
+            write_behind.mark_dirty(1, storage)
+        write_behind.count_update(1)
+
+        storage["name"] = "alice"
+        write_behind.mark_dirty(1, storage)
+        write_behind.count_update(1)
+        await write_behind.flush()
+
+        assert written == [1]
+        assert (write_behind.skipped, write_behind.performed) == (1, 1)
+        assert "samt_storage_writes_skipped_total 1" in metrics.render()
+        assert "samt_storage_writes_total 1" in metrics.render()
+
+    asyncio.run(test())
+
+
+def test_popping_absent_keys_does_not_mark_the_storage():
+    storage = TrackedDict({"name": "alice"})
+
+    assert storage.pop("state", None) is None
+    assert storage.dirty == set()
+    assert storage.pop("name") == "alice"
+    assert storage.pop_dirty() == {"name"}
+
+
+def test_tinydb_writes_a_batch_at_once(tmp_path):
+    from tinydb import TinyDB
+    from tinydb.storages import JSONStorage
+
+    writes = []
+
+    class CountingStorage(JSONStorage):
+        def write(self, data):
+            writes.append(len(data.get("_default", {})))
+            super().write(data)
+
+    async def test():
+        database = TinyDBStorage(TinyDB(str(tmp_path / "db.json"), storage=CountingStorage))
+        for user in (1, 2, 3):
+            await database.load(user)
+        writes.clear()
+
+        await database.update_many({user: {"name": f"user {user}"} for user in (1, 2, 3, 4)})
+        assert [(await database.load(user))["name"] for user in (1, 2, 3, 4)] == ["user 1", "user 2", "user 3",
+                                                                                   "user 4"]
+        await database.close()
+
+    asyncio.run(test())
+
+    # The known users are written at once, the unknown one is inserted
+    assert writes == [3, 4]
+
+
+COUNTER = """
+    from tinydb import TinyDB
+
+    from samt import Bot, Context
+
+
+    @Bot.init_storage
+    def open_storage(*args):
+        return TinyDB("custom.json")
+
+
+    bot = Bot()
+
+
+    @bot.answer("/count")
+    def count():
+        Context.set("count", Context.get("count", 0) + 1)
+        return str(Context.get("count"))
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_custom_tinydb_storage_is_used_by_the_default_functions(run_bot, tmp_path):
+    async def test(bot):
+        assert await bot.ask("/count") == "1"
+        assert await bot.ask("/count") == "2"
+
+        await bot.stop()
+        await bot.restart()
+        assert await bot.ask("/count") == "3"
+
+    run_bot(COUNTER, {"general": {"persistent_storage": True}}, test)
+    assert os.path.exists(tmp_path / "custom.json")
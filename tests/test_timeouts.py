@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiotask_context as Context
+
+from samt import samt
+from samt.samt import _Session
+
+GUARDED = """
+    import asyncio
+    from samt import Bot, Context
+
+    bot = Bot()
+    bot.access_checker["anyone"] = lambda: True
+
+
+    @bot.answer("/set", timeout=5)
+    async def set_value():
+        Context.set("value", 42)
+        return "set"
+
+
+    @bot.answer("/get")
+    async def get_value():
+        return str(Context.get("value"))
+
+
+    @bot.answer("/fast", timeout=0.1)
+    @bot.access_level("anyone")
+    async def fast():
+        return "fast"
+
+
+    @bot.answer("/slow")
+    @bot.access_level("anyone")
+    async def slow():
+        await asyncio.sleep(0.5)
+        return "slow"
+
+
+    @bot.answer("/hang", timeout=0.2)
+    async def hang():
+        await asyncio.sleep(5)
+        return "late"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+CONFIG = {"bot": {"handler_timeout": 5, "error_reply": "oops"}}
+
+
+def test_context_changes_under_timeout_last(run_bot):
+    async def test(bot):
+        assert await bot.ask("/set") == "set"
+        assert await bot.ask("/get") == "42"
+
+    run_bot(GUARDED, CONFIG, test)
+
+
+def test_route_timeout_does_not_apply_to_other_guarded_routes(run_bot):
+    async def test(bot):
+        assert await bot.ask("/fast") == "fast"
+        assert await bot.ask("/slow") == "slow"
+
+    run_bot(GUARDED, CONFIG, test)
+
+
+def test_exceeded_timeout_sends_error_reply(run_bot):
+    async def test(bot):
+        assert await bot.ask("/hang") == "oops"
+
+    run_bot(GUARDED, CONFIG, test)
+
+
+def test_timed_handlers_share_the_context_without_copying_it(monkeypatch):
+    copies = []
+
+    class Storage(dict):
+        def __deepcopy__(self, memo):
+            copies.append(self)
+            return Storage(self)
+
+    async def handler():
+        Context.get("storage")["seen"] = True
+
+    async def session():
+        Context.set("storage", Storage())
+        await _Session.within_timeout(handler, handler())
+        return Context.get("storage")
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        loop.set_task_factory(Context.copying_task_factory)
+        return await loop.create_task(session())
+
+    monkeypatch.setattr(samt, "_settings", SimpleNamespace(handler_timeout=None), raising=False)
+    monkeypatch.setitem(_Session.timeouts, handler, 1)
+    storage = asyncio.run(main())
+
+    assert storage == {"seen": True}
+    assert copies == []
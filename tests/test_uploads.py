@@ -0,0 +1,87 @@
+import asyncio
+import tracemalloc
+
+from samt.media import Upload
+
+BROADCAST = """
+    from samt import Bot, Answer, Media, User
+
+    bot = Bot()
+
+
+    async def chunks():
+        for _ in range(4):
+            yield b"x" * 1000
+
+
+    @bot.answer("/broadcast")
+    async def broadcast():
+        receivers = [User({"id": chat_id, "first_name": "User", "language_code": language})
+                     for chat_id, language in ((2, "en"), (3, "en"), (4, "de"))]
+        report = await bot.broadcast(Answer(media_type=Media.PHOTO, media=("photo.png", chunks())), receivers,
+                                     concurrency=1)
+        return f"{report.sent} sent"
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def test_streamed_media_is_uploaded_once_after_a_failed_upload(run_bot):
+    async def test(bot):
+
+        # The first receiver blocked the bot, so the stream is uploaded to the next one
+        bot.server.fail("sendPhoto", 403, "Forbidden: bot was blocked by the user")
+        bot.server.push_message(1, "/broadcast")
+
+        method, params = await bot.receive()
+        assert params["chat_id"] == "3"
+        assert len(params["photo"].file.read()) == 4000
+
+        method, params = await bot.receive()
+        assert params["chat_id"] == "4"
+        assert params["photo"] == "simulated-1"
+
+        method, params = await bot.receive()
+        assert params["text"] == "2 sent"
+        assert bot.server.uploads == 1
+
+    run_bot(BROADCAST, {}, test)
+
+
+def test_large_streams_are_spooled_with_bounded_memory():
+    chunk_size, chunks = 64 * 1024, 64
+
+    async def stream():
+        for _ in range(chunks):
+            yield b"x" * chunk_size
+
+    async def read(content, limit=None):
+        size = 0
+        async for chunk in content:
+            size += len(chunk)
+            if limit is not None and size >= limit:
+                break
+        return size
+
+    async def main():
+        upload = Upload(spool_size=256 * 1024)
+        source = stream()
+
+        # The first attempt fails halfway, so the second one sends the spooled chunks and the rest of the stream
+        await read(await upload.content(source), chunk_size * chunks // 2)
+        size = await read(await upload.content(source))
+        upload.done("file-id")
+        return size
+
+    tracemalloc.start()
+    try:
+        size = asyncio.run(main())
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert size == chunk_size * chunks
+    assert peak < chunk_size * chunks / 4
+
@@ -0,0 +1,55 @@
+import socket
+import time
+
+import aiohttp
+
+ECHO = """
+    from samt import Bot, Context
+
+    bot = Bot()
+
+
+    @bot.default_answer
+    def echo():
+        return Context.get('message').text
+
+
+    if __name__ == "__main__":
+        bot.listen()
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _update(update_id: int, chat_id: int, text: str) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "from": user, "date": int(time.time()),
+                                                 "chat": {"id": chat_id, "type": "private"}, "text": text}}
+
+
+def test_posted_updates_are_answered_only_with_the_secret_token(run_bot):
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/hook"
+    config = {"bot": {"mode": "webhook"},
+              "webhook": {"port": port, "path": "/hook", "secret_token": "s3cret", "url": "https://example.org/hook"}}
+
+    async def test(bot):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(url, json=_update(1, 1, "forged"),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                assert response.status == 403
+
+            async with session.post(url, json=_update(2, 1, "hello"),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"}) as response:
+                assert response.status == 200
+
+        method, params = await bot.receive()
+        assert (method, params["text"]) == ("sendMessage", "hello")
+        assert bot.server.requests["setWebhook"] == 1
+        assert bot.server.requests["getUpdates"] == 0
+
+    run_bot(ECHO, config, test)